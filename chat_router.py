@@ -0,0 +1,134 @@
+"""Handles the updates of each chat in order, and different chats in parallel
+
+The dispatcher handles updates one at a time, on a single thread, so a slow
+handler in one chat held up every other chat; handing handlers over to a thread
+pool instead would let fast taps in one chat (on Join, Start, or an answer) race
+each other through the same game. The router gives each chat a mailbox, like an
+actor: the dispatcher only drops the update in its chat's mailbox, and a pool of
+workers handles the mailboxes, each mailbox on one worker at a time. A chat's
+updates are handled in the order they arrived, while other chats carry on.
+
+A worker handles one update of a chat, then puts the chat at the back of the line
+if it has more, so a busy chat cannot starve the others. Updates without a chat
+(e.g. inline queries) are handled by the dispatcher as before.
+
+At most `max_pending` updates are held in the mailboxes: beyond that, the
+dispatcher waits for the workers to catch up, so updates stay with Telegram (or
+the webhook refuses them; see is_full) instead of piling up in memory.
+"""
+import queue
+import threading
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Dispatcher, DispatcherHandlerStop, Handler
+
+import logger
+
+
+kookiie_logger = logger.get_logger(__name__)
+ROUTER_GROUP = -1  # before the handlers of the bot, which then run on the router's workers
+
+
+class ChatRouter:
+	"""Serialises the updates of each chat, over a pool of worker threads"""
+
+	def __init__(self, workers: int = 8, max_pending: int = 1000) -> None:
+		self.workers: int = workers
+		self.max_pending: int = max_pending
+		self.dispatcher: Dispatcher | None = None
+		self.routed: int = 0  # updates handed over to the workers so far
+		self._mailboxes: dict[int, deque[Update]] = {}  # chat ID: pending updates; only chats in line or being handled
+		self._ready: queue.SimpleQueue[int | None] = queue.SimpleQueue()  # chats whose next update can be handled
+		self._pending: int = 0
+		self._lock = threading.Lock()
+		self._drained = threading.Condition(self._lock)
+		self._room = threading.Condition(self._lock)  # notified when an update has been handled
+		self._local = threading.local()  # marks the router's own workers
+		self._threads: list[threading.Thread] = []
+
+	def attach(self, dispatcher: Dispatcher) -> None:
+		"""Route the updates of a dispatcher through the workers, which are started"""
+		self.dispatcher = dispatcher
+		dispatcher.add_handler(ChatRouterHandler(self), group=ROUTER_GROUP)
+		for number in range(self.workers):
+			thread = threading.Thread(target=self._work, name=f"chat_router_{number}", daemon=True)
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, chat_id: int, update: Update) -> None:
+		"""Queue an update of a chat, behind the chat's earlier updates; waits while the mailboxes are full"""
+		with self._lock:
+			self._room.wait_for(lambda: self._pending < self.max_pending)
+			self.routed += 1
+			self._pending += 1
+			mailbox = self._mailboxes.get(chat_id)
+			if mailbox is not None:  # the chat is already in line, or being handled; its worker will get to it
+				mailbox.append(update)
+				return
+			self._mailboxes[chat_id] = deque((update,))
+		self._ready.put(chat_id)
+
+	def pending(self) -> int:
+		"""The number of updates queued or being handled"""
+		return self._pending
+
+	def is_full(self) -> bool:
+		"""Whether new updates would have to wait for the workers"""
+		return self._pending >= self.max_pending
+
+	def is_worker(self) -> bool:
+		"""Whether the current thread is one of the router's workers"""
+		return getattr(self._local, "is_worker", False)
+
+	def stop(self, timeout: float = 10) -> None:
+		"""Handle the updates already queued, then stop the workers"""
+		with self._drained:
+			if not self._drained.wait_for(lambda: not self._mailboxes, timeout):
+				kookiie_logger.error("Stopped the chat router with %d updates still pending.", self._pending)
+		for _ in self._threads:
+			self._ready.put(None)
+		for thread in self._threads:
+			thread.join(timeout)
+		self._threads.clear()
+
+	def _work(self) -> None:
+		self._local.is_worker = True
+		while (chat_id := self._ready.get()) is not None:
+			with self._lock:
+				update = self._mailboxes[chat_id].popleft()
+			try:
+				self.dispatcher.process_update(update)
+			except Exception as e:  # the dispatcher handles handler errors; this is anything beyond that
+				kookiie_logger.error("Error! The following exception was encountered while routing an update: %s", e)
+			with self._lock:
+				self._pending -= 1
+				self._room.notify()
+				if self._mailboxes[chat_id]:
+					requeue = True
+				else:
+					requeue = False
+					del self._mailboxes[chat_id]
+					if not self._mailboxes:
+						self._drained.notify_all()
+			if requeue:
+				self._ready.put(chat_id)  # at the back of the line
+
+
+class ChatRouterHandler(Handler):
+	"""Takes the updates of chats off the dispatcher's thread, and into the router
+
+	Once a worker handles the update, the dispatcher's handlers run as usual
+	(this handler lets the worker's own updates through).
+	"""
+
+	def __init__(self, router: ChatRouter) -> None:
+		super().__init__(lambda *_: None)
+		self.router: ChatRouter = router
+
+	def check_update(self, update: object) -> bool:
+		return isinstance(update, Update) and update.effective_chat is not None and not self.router.is_worker()
+
+	def handle_update(self, update: Update, dispatcher: Dispatcher, check_result: object, context: object = None) -> None:
+		self.router.submit(update.effective_chat.id, update)
+		raise DispatcherHandlerStop  # the rest of the handlers run on the worker
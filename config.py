@@ -0,0 +1,71 @@
+"""Bot configuration, loaded from config.yaml, with defaults for anything not set"""
+from copy import deepcopy
+from pathlib import Path
+
+import data_handler
+import logger
+
+
+kookiie_logger = logger.get_logger(__name__)
+CONFIG_DIRECTORY = Path(".", "config.yaml")
+DEFAULTS = {
+	"mode": "polling",  # polling or webhook
+	"update_workers": 8,  # threads handling updates; each chat's updates are still handled in order
+	"max_pending_updates": 1000,  # received, but not handled yet, before the bot stops taking new ones
+	"state_backend": "memory",  # memory, or sqlite to share games between worker processes
+	"state_database": "game_state.db",
+	"snapshot_file": "games.snapshot",  # active games, restored on startup (memory backend only)
+	"snapshot_interval": 30,  # seconds
+	"player_cache": {  # player records kept in memory; the rest are read from the database when needed
+		"size": 10000,
+		"ttl": 600,  # seconds, so that changes by other worker processes are picked up
+	},
+	"stats_interval": 60,  # seconds between rollups of the per-chat and per-word statistics
+	"questions": {
+		"composer_ratio": 0.5,  # share of the questions that are composers
+		"weight_by_difficulty": False,  # ask the words that are often answered wrongly more often
+		"min_answers": 10,  # answers to a word before its difficulty counts
+	},
+	"word_banks": {  # YAML files, or directories of them, for each category
+		"composer": [str(data_handler.COMPOSER_DATA_DIRECTORY)],
+		"pasta": [str(data_handler.PASTA_DATA_DIRECTORY)],
+		"reload_interval": 10,  # seconds between checks for changes; 0 to load them once
+	},
+	"check_word_banks": False,  # log clashing composer and pasta names on startup
+	"admins": [],  # user IDs allowed to use /stats
+	"metrics": {
+		"listen": "127.0.0.1",
+		"port": 0,  # for Prometheus to scrape /metrics; 0 to disable
+	},
+	"logging": {
+		"level": "ERROR",
+		"levels": {},  # levels of particular loggers, e.g. {"telegram": "WARNING"}
+		"json": False,  # one JSON object per line, instead of plain text
+	},
+	"webhook": {
+		"listen": "127.0.0.1",
+		"port": 8443,
+		"url_path": "/telegram",
+		"url": "",  # public URL that Telegram should post updates to; empty if set up elsewhere
+		"secret_token": "",
+	},
+}
+
+
+def merge(defaults: dict, overrides: dict) -> dict:
+	"""Recursively overlay the overrides on (a copy of) the defaults"""
+	merged = deepcopy(defaults)
+	for key, value in overrides.items():
+		if isinstance(value, dict) and isinstance(merged.get(key), dict):
+			merged[key] = merge(merged[key], value)
+		else:
+			merged[key] = value
+	return merged
+
+
+def load_config() -> dict:
+	kookiie_logger.info("Loading configuration from file...")
+	if not CONFIG_DIRECTORY.is_file():
+		kookiie_logger.debug("No configuration found; using defaults.")
+		return deepcopy(DEFAULTS)
+	return merge(DEFAULTS, data_handler.load_data(CONFIG_DIRECTORY))
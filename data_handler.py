@@ -1,18 +1,28 @@
 """Handle player data load/saves"""
 from pathlib import Path
 
-from ruamel.yaml import YAML
-
 import logger
-from player_data import PlayerData
+import word_bank
+from player_data import CACHE_SIZE, CACHE_TTL, PlayerData
+from player_store import PlayerStore
 
 
 kookiie_logger = logger.get_logger(__name__)
 kookiie_logger.info("Logger successfully loaded in data handler.")
-PLAYER_DATA_DIRECTORY = Path(".", "player_data.yaml")
+PLAYER_DATA_DIRECTORY = Path(".", "player_data.yaml")  # legacy format; imported into the database
+PLAYER_DATABASE_DIRECTORY = Path(".", "player_data.db")
 COMPOSER_DATA_DIRECTORY = Path(".", "composer_data.yaml")
 PASTA_DATA_DIRECTORY = Path(".", "pasta_data.yaml")
-yaml = YAML(typ="safe", pure=True)
+yaml = None  # the YAML loader, created on first use; ruamel is slow to import
+player_store: PlayerStore | None = None
+
+
+def get_yaml():
+	global yaml
+	if yaml is None:
+		from ruamel.yaml import YAML
+		yaml = YAML(typ="safe", pure=True)
+	return yaml
 
 
 def load_data(path: Path) -> dict:
@@ -20,42 +30,87 @@ def load_data(path: Path) -> dict:
 
 	try:
 		with open(path, "r", encoding="utf-8") as file_data:
-			data = yaml.load(file_data)
+			data = get_yaml().load(file_data)
 			data = data if data is not None else {}
 		kookiie_logger.debug("Data loaded from file.")
 		return data
 	except Exception as e:
-		kookiie_logger.error(f"Error! The following exception was encountered while trying to read a YAML file: {e}")
+		kookiie_logger.error("Error! The following exception was encountered while trying to read a YAML file: %s", e)
 		return {}
 
 
-def load_player_data() -> PlayerData:
-	kookiie_logger.info("Loading player save data from file...")
-	if not PLAYER_DATA_DIRECTORY.is_file():
-		kookiie_logger.debug("No save data found!")
-		return PlayerData({})  # No save data
-	return PlayerData(load_data(PLAYER_DATA_DIRECTORY))
+def get_player_store() -> PlayerStore:
+	"""Open the player database, importing the legacy YAML save data into a new one"""
+	global player_store
+	if player_store is None:
+		player_store = PlayerStore(PLAYER_DATABASE_DIRECTORY)
+		if player_store.is_new and PLAYER_DATA_DIRECTORY.is_file():
+			kookiie_logger.info("Importing legacy player save data...")
+			player_store.import_players(load_data(PLAYER_DATA_DIRECTORY))
+	return player_store
 
 
-def load_composer() -> dict:
+def load_player_data(cache_size: int = CACHE_SIZE, cache_ttl: float = CACHE_TTL) -> PlayerData:
+	"""Open the player data; records are read from the database as they are needed, not up front"""
+	kookiie_logger.info("Opening player save data...")
+	try:
+		return PlayerData(get_player_store(), cache_size, cache_ttl)
+	except Exception as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to open the player database: %s", e)
+		return PlayerData(PlayerStore(Path(":memory:")), cache_size, cache_ttl)  # scores won't be kept
+
+
+def load_word_bank(path: Path) -> word_bank.WordBank | dict:
+	"""Load a word bank from its snapshot, falling back to (and recompiling from) the YAML file"""
+	source_hash = word_bank.get_source_hash(path)
+	bank = word_bank.read_snapshot(path, source_hash)
+	if bank is not None:
+		return bank
+	data = load_data(path)
+	if not data:
+		return data
+	word_bank.write_snapshot(path, source_hash, data)
+	bank = word_bank.read_snapshot(path, source_hash)
+	return bank if bank is not None else data  # snapshot could not be written; keep the data in memory
+
+
+def compile_word_banks() -> None:
+	"""Build step: compile the snapshots of all word banks"""
+	for path in (COMPOSER_DATA_DIRECTORY, PASTA_DATA_DIRECTORY):
+		word_bank.write_snapshot(path, word_bank.get_source_hash(path), load_data(path))
+
+
+def load_composer() -> word_bank.WordBank | dict:
 	kookiie_logger.info("Loading composer data from file...")
 	if not COMPOSER_DATA_DIRECTORY.is_file():
 		kookiie_logger.error("No composer data found!")
 		return {}
-	return load_data(COMPOSER_DATA_DIRECTORY)
+	return load_word_bank(COMPOSER_DATA_DIRECTORY)
 
 
-def load_pasta() -> dict:
+def load_pasta() -> word_bank.WordBank | dict:
 	kookiie_logger.info("Loading pasta data from file...")
 	if not PASTA_DATA_DIRECTORY.is_file():
 		kookiie_logger.error("No pasta data found!")
 		return {}
-	return load_data(PASTA_DATA_DIRECTORY)
+	return load_word_bank(PASTA_DATA_DIRECTORY)
 
 
 def save_player_data(player_data: PlayerData) -> None:
-	try:
-		yaml.dump(dict(player_data), PLAYER_DATA_DIRECTORY)
-		kookiie_logger.debug("Data saved to file.")
-	except Exception as e:
-		kookiie_logger.error(f"Error! The following exception was encountered while trying to dump a YAML file: {e}")
+	"""Write the results recorded since the last save to the player database
+
+	The player data is not locked while the results are written, so the games carry
+	on meanwhile; the results stay pending (and part of the records read from the
+	database) until they are committed.
+	"""
+	with player_data.save_lock:
+		pending = player_data.copy_pending()
+		try:
+			player_data.store.upsert(pending, on_commit=lambda: player_data.remove_saved(pending))
+			kookiie_logger.debug("Data saved to file.")
+		except Exception as e:  # the results are still pending, for the next save
+			kookiie_logger.error("Error! The following exception was encountered while trying to write to the player database: %s", e)
+
+
+if __name__ == "__main__":
+	compile_word_banks()
@@ -1,14 +1,246 @@
-"""This module checks if there are clashing composer and pasta names"""
+"""This module checks if there are clashing composer and pasta names
+
+Besides exact clashes, it finds near-collisions, which make questions ambiguous:
+- names that are the same once accents, case and punctuation are removed (`Dvořák`/`dvorak`)
+- names one edit apart, i.e. one letter added, removed, changed or swapped (`barbine`/`barbina`)
+- names that sound alike, by a simple phonetic key (`filippi`/`phillipi`)
+
+Names are compared through indexes (of their normalised forms, of their one-letter
+deletions, and of their phonetic keys), so the cost grows with the number of names,
+rather than with the number of pairs. Collisions are reported across the lists, and
+within each list.
+
+Usage:
+	python duplicate_checker.py [--strict] [--json]
+Exits with 1 if composer and pasta names collide (or, with --strict, if any names do).
+
+	python duplicate_checker.py --benchmark N
+Times the check on N random names instead, and exits with 1 if it takes over BENCHMARK_BUDGET.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import string
+import sys
+import unicodedata
+from time import perf_counter
+from collections import Counter
+from dataclasses import asdict, dataclass
+from itertools import chain, combinations, compress, count, repeat
+from operator import ne
+from pathlib import Path
+from typing import Sequence
+
 import logger
 
 
-def check(composer_keys: list, pasta_keys: list) -> None:
-	kookiie_logger = logger.get_logger(__name__)
-	kookiie_logger.info("Logger successfully loaded in checker.")
-	composers = set(composer_keys)
-	pastas = set(pasta_keys)
-	clashing_names = composers.intersection(pastas)
-	if clashing_names:
-		kookiie_logger.error(f"There are clashing composer and pasta names: {str(clashing_names)}")
+kookiie_logger = logger.get_logger(__name__)
+CACHE_DIRECTORY = Path(".", "duplicate_check.json")
+CHECK_VERSION = 2  # part of the cache key; bump it when the check finds different collisions for the same names
+MIN_FUZZY_LENGTH = 5  # shorter names are one edit away from too many others to be worth reporting
+PHONETIC_DIGRAPHS = (("sch", "s"), ("sh", "s"), ("ph", "f"), ("ck", "k"))  # applied in order, to normalised names
+PHONETIC_LETTERS = str.maketrans({"c": "k", "q": "k", "x": "ks", "z": "s", "w": "v", "y": "i"})
+SILENT_H = re.compile(r"(?<!\n)h")  # but the first letter of a name
+BENCHMARK_BUDGET = 1.0  # seconds for 100k random names
+KINDS = ("exact", "normalised", "spelling", "phonetic")  # from the strongest kind of collision to the weakest
+
+
+@dataclass(frozen=True)
+class Collision:
+	kind: str  # one of KINDS
+	first_bank: str
+	first: str
+	second_bank: str
+	second: str
+
+	@property
+	def is_cross(self) -> bool:
+		"""Whether the names are in different word banks"""
+		return self.first_bank != self.second_bank
+
+	def __str__(self) -> str:
+		return f"{self.kind}: {self.first_bank} '{self.first}' / {self.second_bank} '{self.second}'"
+
+
+def normalise(name: str) -> str:
+	"""Strip accents, case, and anything that isn't a letter or digit"""
+	folded = name.casefold()
+	if folded.isascii() and folded.isalnum():  # most names; no need to decompose them
+		return folded
+	decomposed = unicodedata.normalize("NFKD", folded)
+	return "".join(character for character in decomposed if character.isalnum() and not unicodedata.combining(character))
+
+
+def deletions(word: str) -> list[str]:
+	"""The word, and every way of removing one letter from it (repeated for repeated letters)
+
+	The letter removed from the i-th variant is at position i - 1; none from the word itself.
+	"""
+	return [word, *[word[:i] + word[i + 1:] for i in range(len(word))]]
+
+
+def is_one_edit(first: str, first_deleted: int, second: str, second_deleted: int) -> bool:
+	"""Whether two names with a deletion in common (of the letters at these positions, -1 for none) are an edit apart
+
+	Names can share a deletion and still be two edits apart, e.g. `rossi`/`ossia`
+	(a letter removed at the front, and another added at the back).
+	"""
+	if first_deleted == second_deleted or -1 in (first_deleted, second_deleted):
+		return True  # a letter changed, or one added or removed
+	# Two letters swapped: each name lost the letter that the other has in its place
+	return abs(first_deleted - second_deleted) == 1 and first[first_deleted] == second[second_deleted]
+
+
+def phonetic_keys(words: list[str]) -> list[str]:
+	"""Rough keys of how (Italian-ish) names sound: similar consonants merged, silent h and double letters dropped
+
+	The names are normalised, so they can be joined by line breaks and keyed all at once, in C.
+	"""
+	text = "\n" + "\n".join(words)
+	for digraph, replacement in PHONETIC_DIGRAPHS:
+		text = text.replace(digraph, replacement)
+	text = SILENT_H.sub("", text).translate(PHONETIC_LETTERS)
+	return "".join(compress(text, map(ne, text, f" {text}"))).split("\n")[1:]  # without repeated letters
+
+
+def find_collisions(banks: dict[str, list[str]], fuzzy: bool = True) -> list[Collision]:
+	"""Find the exact and near-collisions between the names of the word banks, and within each one
+
+	Two names sharing a one-letter deletion (or being one) are an edit apart if the
+	letters were removed at the same position, or next to each other (see
+	is_one_edit). Each pair of names is reported once, as its strongest kind of
+	collision.
+	"""
+	entries = [(bank, name, normalise(name)) for bank, names in banks.items() for name in names]
+	# The keys are built a column at a time, rather than an entry at a time, to keep the work in C
+	fuzzy_entries = [i for i, entry in enumerate(entries) if len(entry[2]) >= MIN_FUZZY_LENGTH] if fuzzy else []
+	words = [entries[i][2] for i in fuzzy_entries]
+	lengths = list(map(len, words))
+	keys: dict[str, list[str]] = {  # the keys of the entries, for each index
+		"exact": [name for _, name, _ in entries],
+		"normalised": [normalised for _, _, normalised in entries],
+		"spelling": list(chain.from_iterable(map(deletions, words))),
+		"phonetic": phonetic_keys(words),
+	}
+	owners: dict[str, Sequence[int]] = {  # the entry of each key
+		"exact": range(len(entries)),
+		"normalised": range(len(entries)),
+		"spelling": list(chain.from_iterable(map(repeat, fuzzy_entries, map((1).__add__, lengths)))),
+		"phonetic": fuzzy_entries,
+	}
+	deleted = list(chain.from_iterable(map(range, repeat(-1), lengths)))  # the position of the letter removed for each spelling key, -1 for none
+	indexes: dict[str, dict[str, list[int]]] = {}  # key: the keys' places in keys[kind], for the keys of several entries
+	for kind in KINDS:
+		# Only the keys shared by several entries need a bucket; they are picked out in C
+		shared = {key for key, times in Counter(keys[kind]).items() if times > 1}
+		index = indexes[kind] = {}
+		for place in compress(count(), map(shared.__contains__, keys[kind])):
+			index.setdefault(keys[kind][place], []).append(place)
+
+	found: dict[tuple[int, int], str] = {}  # pair of entries: strongest kind of collision
+	for kind in KINDS:
+		for bucket in indexes[kind].values():
+			for k, l in combinations(bucket, 2):
+				i, j = owners[kind][k], owners[kind][l]
+				if i == j:  # a name's own deletions can repeat
+					continue
+				if kind != "spelling" or is_one_edit(entries[i][2], deleted[k], entries[j][2], deleted[l]):
+					found.setdefault((i, j), kind)
+	collisions = []
+	for (i, j), kind in found.items():
+		if kind != "exact" and entries[i][1] == entries[j][1]:
+			continue  # the same name, in the same bank, reached through another index
+		collisions.append(Collision(kind, entries[i][0], entries[i][1], entries[j][0], entries[j][1]))
+	collisions.sort(key=lambda collision: (not collision.is_cross, KINDS.index(collision.kind), collision.first))
+	return collisions
+
+
+def get_banks_hash(banks: dict[str, list[str]]) -> str:
+	digest = hashlib.sha256(str(CHECK_VERSION).encode())
+	for bank, names in banks.items():
+		digest.update(bank.encode())
+		digest.update("\0".join(names).encode())
+		digest.update(b"\1")
+	return digest.hexdigest()
+
+
+def load_cache(banks_hash: str) -> list[Collision] | None:
+	"""Get the collisions found for the same names before, if any"""
+	try:
+		with open(CACHE_DIRECTORY, "r", encoding="utf-8") as cache_file:
+			cache = json.load(cache_file)
+	except (FileNotFoundError, ValueError):
+		return None
+	if cache.get("hash") != banks_hash:
+		return None
+	return [Collision(**collision) for collision in cache["collisions"]]
+
+
+def save_cache(banks_hash: str, collisions: list[Collision]) -> None:
+	try:
+		with open(CACHE_DIRECTORY, "w", encoding="utf-8") as cache_file:
+			json.dump({"hash": banks_hash, "collisions": [asdict(collision) for collision in collisions]}, cache_file)
+	except OSError as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to cache the name check: %s", e)
+
+
+def check(composer_keys: list, pasta_keys: list) -> list[Collision]:
+	"""Log the collisions between and within the composer and pasta names; cached until the names change"""
+	banks = {"composer": composer_keys, "pasta": pasta_keys}
+	banks_hash = get_banks_hash(banks)
+	collisions = load_cache(banks_hash)
+	if collisions is None:
+		collisions = find_collisions(banks)
+		save_cache(banks_hash, collisions)
+	cross = [collision for collision in collisions if collision.is_cross]
+	if cross:
+		kookiie_logger.error("There are clashing composer and pasta names: %s", ", ".join(map(str, cross)))
 	else:
 		kookiie_logger.debug("No clashing composer and pasta names found.")
+	if len(cross) < len(collisions):
+		kookiie_logger.warning("There are %d near-duplicate names within the word banks.", len(collisions) - len(cross))
+	return collisions
+
+
+def benchmark(names: int) -> None:
+	"""Time the check on random names, half of them composers and half pastas"""
+	rng = random.Random(0)
+	words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 14))).capitalize() for _ in range(names)]
+	start = perf_counter()
+	collisions = find_collisions({"composer": words[:names // 2], "pasta": words[names // 2:]})
+	seconds = perf_counter() - start
+	budget = BENCHMARK_BUDGET * names / 100000
+	print(f"{names} random names checked in {seconds:.2f}s (budget {budget:.2f}s): {len(collisions)} collisions")
+	if seconds > budget:
+		print(f"FAILED: the check took {seconds:.2f}s, over the {budget:.2f}s budget")
+	sys.exit(1 if seconds > budget else 0)
+
+
+def main() -> None:
+	import data_handler  # only needed for the command line
+
+	parser = argparse.ArgumentParser(description="Check the word banks for clashing composer and pasta names.")
+	parser.add_argument("--strict", action="store_true", help="also fail on near-duplicates within a word bank")
+	parser.add_argument("--json", action="store_true", help="print the collisions as JSON")
+	parser.add_argument("--benchmark", type=int, metavar="N", help="time the check on N random names instead")
+	args = parser.parse_args()
+	if args.benchmark:
+		benchmark(args.benchmark)
+
+	banks = {"composer": list(data_handler.load_composer().keys()), "pasta": list(data_handler.load_pasta().keys())}
+	collisions = find_collisions(banks)
+	if args.json:
+		print(json.dumps([asdict(collision) for collision in collisions], indent="\t", ensure_ascii=False))
+	else:
+		for collision in collisions:
+			print(collision)
+		cross = sum(collision.is_cross for collision in collisions)
+		print(f"{cross} clashes between the word banks, {len(collisions) - cross} near-duplicates within them.")
+	failed = any(collision.is_cross or args.strict for collision in collisions)
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,8 @@
 """This module contains representation of game attributes"""
+import secrets
 from enum import Enum
+from functools import lru_cache
+from typing import Sequence
 
 
 class GameLength(Enum):
@@ -19,43 +22,120 @@ class States(Enum):
 	CHECK_ANSWER: int = 2
 
 
+@lru_cache(maxsize=1024)
+def get_outcome(answers: int, correct: int) -> tuple[int, int]:
+	"""The shared (answers, correct answers) of a round; only a few are possible, and every game keeps one per round"""
+	return answers, correct
+
+
 class Game:
 	"""This class models individual game rounds"""
 
-	def __init__(self, chat_id: int) -> None:
-		self.chat_id: int = chat_id
+	__slots__ = (
+		"chat_id", "state", "total_rounds", "current_round", "players", "scores", "order", "questions", "bank_version",
+		"blitz", "round_answers", "outcomes", "game_id",
+	)
 
-	total_rounds: int
-	current_round: int = 0
-	players: dict[int, str] = {}
-	scores: dict[int, int] = {}
-	order: dict[int, int] = {}
-	correct_answer: tuple[str, str]
+	def __init__(self, chat_id: int, blitz: bool = False) -> None:
+		self.chat_id: int = chat_id
+		self.state: States = States.SEND_INVITE
+		self.total_rounds: int = 0  # 0 until the game length is chosen
+		self.current_round: int = 0
+		self.players: dict[int, str] = {}
+		self.scores: dict[int, int] = {}
+		self.order: tuple[int, ...] = ()  # player IDs, in the order of their turns
+		self.questions: Sequence[tuple[Enum, str]] = ()  # (correct category, word) for each round
+		self.bank_version: str = ""  # of the word banks the questions were drawn from
+		self.blitz: bool = blitz  # everyone answers every question, instead of taking turns
+		self.round_answers: dict[int, str] = {}  # player ID: answer, in this round
+		self.outcomes: list[tuple[int, int]] = []  # (answers, correct answers) of each round played
+		self.game_id: str = secrets.token_hex(4)  # tells the buttons of this game from those of earlier games in the chat
 
 	def set_total_rounds(self, length: str) -> None:
-		self.total_rounds = len(self.players) * GameLength[length].value
+		# In a blitz game, everyone plays every round
+		self.total_rounds = GameLength[length].value * (1 if self.blitz else len(self.players))
 
 	def initialise_order(self) -> None:
-		player_ids = self.players.keys()
-		for base_counter in range(0, self.total_rounds, len(player_ids)):
-			for offset, player_id in enumerate(player_ids):
-				self.order[base_counter + offset]: int = player_id
+		self.order = tuple(self.players)
 
 	def initialise_scores(self) -> None:
-		for player_id in self.players.keys():
-			self.scores[player_id]: int = 0
+		self.scores = dict.fromkeys(self.players, 0)
+
+	def is_started(self) -> bool:
+		return self.total_rounds > 0
+
+	@property
+	def correct_answer(self) -> tuple[Enum, str]:
+		return self.questions[self.current_round]
 
 	def increment_round_number(self) -> None:
+		correct = self.correct_answer[0].value
+		self.outcomes.append(
+			get_outcome(len(self.round_answers), sum(answer == correct for answer in self.round_answers.values()))
+		)
 		self.current_round += 1
+		self.round_answers = {}
+
+	def record_answer(self, player_id: int, answer: str) -> bool:
+		"""Record a player's answer in this round; False if the player has already answered"""
+		if player_id in self.round_answers:
+			return False
+		self.round_answers[player_id] = answer
+		return True
+
+	def is_round_answered(self) -> bool:
+		"""Whether every player has answered this round of a blitz game"""
+		return len(self.round_answers) >= len(self.players)
+
+	def increment_player_score(self, player_id: int) -> None:
+		self.scores[player_id] += 1
 
 	def is_ended(self) -> bool:
 		return self.total_rounds == self.current_round
 
-	def get_current_player(self) -> int:
-		return self.order.get(self.current_round)
+	def get_current_player(self) -> int | None:
+		if not self.order:
+			return None
+		return self.order[self.current_round % len(self.order)]
 
 	def get_current_player_name(self) -> str:
 		return self.players.get(self.get_current_player())
 
 	def increment_current_player_score(self) -> None:
 		self.scores[self.get_current_player()] += 1
+
+	def to_dict(self) -> dict:
+		"""Serialise the game into JSON-compatible data"""
+		return {
+			"chat_id": self.chat_id,
+			"state": self.state.name,
+			"total_rounds": self.total_rounds,
+			"current_round": self.current_round,
+			"players": list(self.players.items()),  # as pairs, to keep the order and the integer IDs
+			"scores": list(self.scores.items()),
+			"order": list(self.order),
+			"questions": [(category.value, word) for category, word in self.questions],
+			"bank_version": self.bank_version,
+			"blitz": self.blitz,
+			"round_answers": list(self.round_answers.items()),
+			"outcomes": list(self.outcomes),
+			"game_id": self.game_id,
+		}
+
+	@classmethod
+	def from_dict(cls, data: dict, categories: type[Enum]) -> "Game":
+		"""Deserialise a game; `categories` is the enum of the question categories"""
+		game = cls(data["chat_id"])
+		game.state = States[data["state"]]
+		game.total_rounds = data["total_rounds"]
+		game.current_round = data["current_round"]
+		game.players = dict(map(tuple, data["players"]))
+		game.scores = dict(map(tuple, data["scores"]))
+		game.order = tuple(data["order"])
+		game.questions = tuple((categories(category), word) for category, word in data["questions"])
+		game.bank_version = data.get("bank_version", "")
+		game.blitz = data.get("blitz", False)
+		game.round_answers = dict(map(tuple, data.get("round_answers", ())))
+		game.outcomes = [get_outcome(*outcome) for outcome in data.get("outcomes", ())]
+		game.game_id = data.get("game_id", game.game_id)  # the buttons of older snapshots are sent again anyway
+		return game
@@ -0,0 +1,134 @@
+"""This module keeps track of the active games, indexed by chat
+
+Handlers work on a game within a session on its chat, which serialises the
+handlers of a chat. A registry can keep its games in memory (GameRegistry), or
+share them between worker processes (see game_store.SQLiteGameRegistry).
+"""
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic
+from typing import Iterator
+
+from game import Game
+
+
+LOBBY_TTL = 15 * 60  # seconds before an unstarted game is considered abandoned
+GAME_TTL = 60 * 60  # seconds before a started game is considered abandoned
+STATS_WINDOW = 60  # seconds; the window used for the per-minute statistics
+LOCK_STRIPES = 64  # chats share this many session locks
+
+
+class GameRegistry:
+	"""A thread-safe mapping of chat IDs to their active games"""
+
+	def __init__(self) -> None:
+		self._games: dict[int, Game] = {}
+		self._last_seen: dict[int, float] = {}  # chat ID: time of the last lookup
+		self._created: deque[float] = deque()
+		self._ended: deque[float] = deque()
+		self._lock = threading.Lock()
+		self._chat_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+		self.changes: int = 0  # sessions and removals so far; tells snapshots whether anything changed
+
+	def __len__(self) -> int:
+		return len(self._games)
+
+	def __contains__(self, chat_id: int) -> bool:
+		return chat_id in self._games
+
+	def add(self, game: Game) -> bool:
+		"""Register a new game; returns False if the chat already has one"""
+		with self._lock:
+			if game.chat_id in self._games:
+				return False
+			now = monotonic()
+			self._games[game.chat_id] = game
+			self._last_seen[game.chat_id] = now
+			self._created.append(now)
+			return True
+
+	def get(self, chat_id: int) -> Game | None:
+		"""Get the active game of a chat, and mark it as recently used"""
+		with self._lock:
+			game = self._games.get(chat_id)
+			if game:
+				self._last_seen[chat_id] = monotonic()
+			return game
+
+	def remove(self, chat_id: int) -> Game | None:
+		"""Remove the active game of a chat, if any"""
+		with self._lock:
+			self._last_seen.pop(chat_id, None)
+			game = self._games.pop(chat_id, None)
+			if game:
+				self._ended.append(monotonic())
+				self.changes += 1
+			return game
+
+	def save(self, game: Game) -> None:
+		"""Persist changes to a game; games in memory are always up to date"""
+
+	@contextmanager
+	def session(self, chat_id: int) -> Iterator[None]:
+		"""Hold the chat for the duration of a handler, so that its updates are handled one at a time"""
+		with self._chat_locks[hash(chat_id) % LOCK_STRIPES]:
+			try:
+				yield
+			finally:
+				with self._lock:
+					self.changes += 1
+
+	def chat_ids(self) -> list[int]:
+		return list(self._games)
+
+	def snapshot(self) -> list[tuple[dict, float]]:
+		"""Serialise every game, with the seconds since it was last used
+
+		Each game is serialised within a session on its chat, so that it is never
+		caught halfway through a handler; other chats carry on in the meantime.
+		"""
+		entries = []
+		for chat_id in self.chat_ids():
+			with self._chat_locks[hash(chat_id) % LOCK_STRIPES]:
+				with self._lock:
+					game = self._games.get(chat_id)
+					last_seen = self._last_seen.get(chat_id)
+				if game:
+					entries.append((game.to_dict(), monotonic() - last_seen))
+		return entries
+
+	def restore(self, entries: list[tuple[Game, float]]) -> int:
+		"""Register games from a snapshot, keeping how long they have been idle; returns the number restored"""
+		now = monotonic()
+		restored = 0
+		with self._lock:
+			for game, idle in entries:
+				if game.chat_id not in self._games:
+					self._games[game.chat_id] = game
+					self._last_seen[game.chat_id] = now - idle
+					restored += 1
+		return restored
+
+	def evict_idle(self, lobby_ttl: float = LOBBY_TTL, game_ttl: float = GAME_TTL) -> list[Game]:
+		"""Remove games that have not been used within their time-to-live"""
+		now = monotonic()
+		with self._lock:
+			stale = [
+				chat_id for chat_id, game in self._games.items()
+				if now - self._last_seen[chat_id] > (game_ttl if game.is_started() else lobby_ttl)
+			]
+		return [game for game in map(self.remove, stale) if game]
+
+	def stats(self) -> dict[str, int]:
+		"""Get the number of active games, and the games created/ended in the last minute"""
+		with self._lock:
+			cutoff = monotonic() - STATS_WINDOW
+			for timestamps in (self._created, self._ended):
+				while timestamps and timestamps[0] < cutoff:
+					timestamps.popleft()
+			return {
+				"Active games": len(self._games),
+				"Games created per minute": len(self._created),
+				"Games ended per minute": len(self._ended),
+			}
@@ -0,0 +1,132 @@
+"""Snapshots of the active games, so that they survive restarts and crashes
+
+A snapshot is a single marshal file of the serialised games (see Game.to_dict),
+each with the seconds since it was last used. To keep it compact, and quick to
+load, the questions of each game are packed into arrays of indices into tables of
+the categories and words, which are shared by all games. The snapshot is written
+to a temporary file first, so that a crash while writing leaves the previous one.
+"""
+import marshal
+from array import array
+import os
+from enum import Enum
+from pathlib import Path
+from time import time
+from typing import Any, Sequence
+
+import logger
+from game import Game
+from game_registry import GAME_TTL, LOBBY_TTL, GameRegistry
+
+
+kookiie_logger = logger.get_logger(__name__)
+SNAPSHOT_VERSION = 1  # bump when the snapshot layout changes
+
+
+def pack_questions(entries: list[tuple[dict, float]]) -> tuple[list, list[str], list[tuple[dict, bytes, bytes, float]]]:
+	"""Replace the questions of each game with (category indices, word indices)"""
+	categories: dict = {}
+	words: dict[str, int] = {}
+	packed = []
+	for data, idle in entries:
+		questions = data.pop("questions")
+		category_indices = bytes(categories.setdefault(category, len(categories)) for category, _ in questions)
+		word_indices = array("I", [words.setdefault(word, len(words)) for _, word in questions])
+		packed.append((data, category_indices, word_indices.tobytes(), idle))
+	return list(categories), list(words), packed
+
+
+class PackedQuestions(Sequence):
+	"""The questions of a restored game, read straight from the packed indices
+
+	Restoring a game then costs the same however long it is, and the questions
+	stay compact in memory.
+	"""
+
+	__slots__ = ("categories", "words", "category_indices", "word_indices")
+
+	def __init__(self, categories: list[Enum], words: list[str], category_indices: bytes, word_indices: bytes) -> None:
+		self.categories: list[Enum] = categories
+		self.words: list[str] = words
+		self.category_indices: bytes = category_indices
+		self.word_indices: array = array("I")
+		self.word_indices.frombytes(word_indices)
+
+	def __len__(self) -> int:
+		return len(self.category_indices)
+
+	def __getitem__(self, index: int) -> tuple[Enum, str]:
+		return self.categories[self.category_indices[index]], self.words[self.word_indices[index]]
+
+
+def save_snapshot(entries: list[tuple[dict, float]], path: Path) -> None:
+	"""Write the serialised games, and their idle times, to the snapshot file"""
+	temp = path.with_name(f"{path.name}.tmp")
+	try:
+		with open(temp, "wb") as snapshot:
+			marshal.dump((SNAPSHOT_VERSION, time(), *pack_questions(entries)), snapshot)
+		os.replace(temp, path)
+		kookiie_logger.debug("Snapshot of %d games written.", len(entries))
+	except Exception as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to write a game snapshot: %s", e)
+
+
+def load_snapshot(
+		path: Path,
+		categories: type[Enum],
+		lobby_ttl: float = LOBBY_TTL,
+		game_ttl: float = GAME_TTL,
+) -> list[tuple[Game, float]]:
+	"""Get the games in the snapshot, with their idle times (including the downtime)
+
+	Games that would have been evicted in the meantime are skipped before being
+	deserialised, and the questions of the others are left packed, so that the
+	cost of a restore does not grow with the length of the games.
+	"""
+	try:
+		with open(path, "rb") as snapshot:
+			version, saved_at, *tables = marshal.load(snapshot)
+	except FileNotFoundError:
+		return []
+	except Exception as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to read a game snapshot: %s", e)
+		return []
+	if version != SNAPSHOT_VERSION:
+		kookiie_logger.warning("Game snapshot version %s is not supported; not restoring it.", version)
+		return []
+	category_values, words, entries = tables
+	members = [categories(value) for value in category_values]
+	downtime = max(0.0, time() - saved_at)
+	games = []
+	for data, category_indices, word_indices, idle in entries:
+		idle += downtime
+		if idle <= (game_ttl if data["total_rounds"] else lobby_ttl):
+			game = Game.from_dict({**data, "questions": ()}, categories)
+			game.questions = PackedQuestions(members, words, category_indices, word_indices)
+			games.append((game, idle))
+	kookiie_logger.info("%d of %d games in the snapshot are still active.", len(games), len(entries))
+	return games
+
+
+class GameSnapshotter:
+	"""Writes snapshots of a registry's games; meant to run as a repeating job, off the handler threads"""
+
+	def __init__(self, registry: GameRegistry, path: Path) -> None:
+		self.registry: GameRegistry = registry
+		self.path: Path = path
+		self._saved_changes: int = -1  # registry changes as of the last snapshot
+
+	def save(self, _: Any = None) -> None:
+		"""Write a snapshot, unless no game has changed since the last one"""
+		changes = self.registry.changes
+		if changes == self._saved_changes:
+			return
+		save_snapshot(self.registry.snapshot(), self.path)
+		self._saved_changes = changes
+
+	def restore(self, categories: type[Enum]) -> list[Game]:
+		"""Register the games from the last snapshot; returns the games restored"""
+		entries = [(game, idle) for game, idle in load_snapshot(self.path, categories) if game.chat_id not in self.registry]
+		self.registry.restore(entries)
+		self._saved_changes = self.registry.changes
+		return [game for game, _ in entries]
@@ -0,0 +1,65 @@
+"""Per-chat leaderboards and per-word answer statistics, rolled up in the background
+
+When a game ends, it is only queued here, so that the handlers do no extra work.
+A repeating job rolls the queued games up, into the results of each player in
+each chat, and the answers given to each word (e.g. which pastas keep being
+taken for composers), and merges them into the player database in a single
+transaction. The word statistics can then be used to weight the questions by
+difficulty (see question_deck.build_deck).
+"""
+from collections import deque
+from typing import Any
+
+import logger
+from game import Game
+from player_store import PlayerStore
+
+
+kookiie_logger = logger.get_logger(__name__)
+
+
+def roll_up(games: list[Game]) -> tuple[dict[tuple[int, int], tuple[str, int, int]], dict[tuple[str, str], tuple[int, int]]]:
+	"""Total the games into per-chat (name, high score, games played), and per-word (answers, correct answers)"""
+	chat_results: dict[tuple[int, int], tuple[str, int, int]] = {}
+	word_results: dict[tuple[str, str], tuple[int, int]] = {}
+	for game in games:
+		for user_id, name in game.players.items():
+			key = (game.chat_id, user_id)
+			high_score, plays = game.scores.get(user_id, 0), 1
+			if key in chat_results:
+				_, old_score, old_plays = chat_results[key]
+				high_score, plays = max(high_score, old_score), plays + old_plays
+			chat_results[key] = (name, high_score, plays)
+		for (category, word), (answers, correct) in zip(game.questions, game.outcomes):
+			key = (category.value, word)
+			old_answers, old_correct = word_results.get(key, (0, 0))
+			word_results[key] = (old_answers + answers, old_correct + correct)
+	return chat_results, word_results
+
+
+class GameStatsRollup:
+	"""Queues finished games, and rolls them up into the database; meant to run as a repeating job"""
+
+	def __init__(self, store: PlayerStore) -> None:
+		self.store: PlayerStore = store
+		self._games: deque[Game] = deque()  # finished games, not rolled up yet
+		self.rollups: int = 0
+
+	def record(self, game: Game) -> None:
+		"""Queue a finished game"""
+		self._games.append(game)
+
+	def flush(self, _: Any = None) -> None:
+		"""Roll up the queued games, and merge them into the database"""
+		games = []
+		while self._games:
+			games.append(self._games.popleft())
+		if not games:
+			return
+		try:
+			self.store.add_game_stats(*roll_up(games))
+			self.rollups += 1
+			kookiie_logger.debug("Rolled up the statistics of %d games.", len(games))
+		except Exception as e:
+			self._games.extendleft(reversed(games))  # kept for the next rollup
+			kookiie_logger.error("Error! The following exception was encountered while rolling up game statistics: %s", e)
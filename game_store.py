@@ -0,0 +1,187 @@
+"""Games shared between worker processes, in an SQLite database
+
+Each game is stored as JSON, keyed by chat. A worker holds a lease on a chat for
+the duration of a session, so that only one worker (and one thread in it) handles
+the updates of a chat at a time. Leases expire, so a crashed worker does not hold
+on to its chats.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from time import monotonic, sleep, time
+from typing import Iterator
+from uuid import uuid4
+
+import logger
+from game import Game
+from game_registry import GAME_TTL, LOBBY_TTL, LOCK_STRIPES, STATS_WINDOW
+from keyboard_model import KeyboardText
+
+
+kookiie_logger = logger.get_logger(__name__)
+LEASE_DURATION = 30  # seconds; longer than any handler should take
+LEASE_TIMEOUT = 10  # seconds to wait for another worker to release a chat
+LEASE_POLL_INTERVAL = 0.01  # seconds
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+	chat_id INTEGER PRIMARY KEY,
+	data TEXT NOT NULL,
+	started INTEGER NOT NULL,
+	last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_leases (
+	chat_id INTEGER PRIMARY KEY,
+	owner TEXT NOT NULL,
+	lease_until REAL NOT NULL
+);
+"""
+ACQUIRE_LEASE = """
+INSERT INTO chat_leases (chat_id, owner, lease_until) VALUES (?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until
+WHERE owner = excluded.owner OR lease_until < ?
+"""
+
+
+class SQLiteGameRegistry:
+	"""A registry of active games, shared by every worker using the same database
+
+	Within a session, a game is loaded once and saved when the session ends, so
+	handlers can change it like a game in memory.
+	"""
+
+	def __init__(self, path: Path) -> None:
+		self.path: Path = path
+		self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=LEASE_TIMEOUT)
+		self._connection.execute("PRAGMA journal_mode=WAL")
+		self._connection.executescript(SCHEMA)
+		self._owner: str = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+		self._local = threading.local()  # the sessions of each thread
+		self._created: deque[float] = deque()
+		self._ended: deque[float] = deque()
+		self._lock = threading.Lock()
+		self._database_lock = threading.Lock()
+		self._chat_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+	def __len__(self) -> int:
+		return self._query("SELECT COUNT(*) FROM games")[0][0]
+
+	def __contains__(self, chat_id: int) -> bool:
+		return self.get(chat_id) is not None
+
+	def add(self, game: Game) -> bool:
+		"""Register a new game; returns False if the chat already has one"""
+		if not self._execute(
+			"INSERT OR IGNORE INTO games (chat_id, data, started, last_seen) VALUES (?, ?, ?, ?)",
+			(game.chat_id, json.dumps(game.to_dict()), game.is_started(), time()),
+		):
+			return False
+		self._sessions().get(game.chat_id, {})["game"] = game
+		with self._lock:
+			self._created.append(monotonic())
+		return True
+
+	def get(self, chat_id: int) -> Game | None:
+		"""Get the active game of a chat; the same object throughout a session"""
+		session = self._sessions().get(chat_id)
+		if session is not None and "game" in session:
+			return session["game"]
+		rows = self._query("SELECT data FROM games WHERE chat_id = ?", (chat_id,))
+		game = Game.from_dict(json.loads(rows[0][0]), KeyboardText) if rows else None
+		if session is not None:
+			session["game"] = game
+		return game
+
+	def save(self, game: Game) -> None:
+		self._execute(
+			"UPDATE games SET data = ?, started = ?, last_seen = ? WHERE chat_id = ?",
+			(json.dumps(game.to_dict()), game.is_started(), time(), game.chat_id),
+		)
+
+	def remove(self, chat_id: int) -> Game | None:
+		"""Remove the active game of a chat, if any"""
+		game = self.get(chat_id)
+		session = self._sessions().get(chat_id)
+		if session is not None:
+			session["game"] = None
+		if game and self._execute("DELETE FROM games WHERE chat_id = ?", (chat_id,)):
+			with self._lock:
+				self._ended.append(monotonic())
+		return game
+
+	@contextmanager
+	def session(self, chat_id: int) -> Iterator[None]:
+		"""Hold the chat (across all workers) for the duration of a handler, and save its game afterwards"""
+		sessions = self._sessions()
+		if chat_id in sessions:  # nested session
+			yield
+			return
+		with self._chat_locks[hash(chat_id) % LOCK_STRIPES]:
+			self._acquire_lease(chat_id)
+			sessions[chat_id] = {}
+			try:
+				yield
+				game = sessions[chat_id].get("game")
+				if game:
+					self.save(game)
+			finally:
+				del sessions[chat_id]
+				self._execute("DELETE FROM chat_leases WHERE chat_id = ? AND owner = ?", (chat_id, self._owner))
+
+	def chat_ids(self) -> list[int]:
+		return [chat_id for chat_id, in self._query("SELECT chat_id FROM games")]
+
+	def evict_idle(self, lobby_ttl: float = LOBBY_TTL, game_ttl: float = GAME_TTL) -> list[Game]:
+		"""Remove games that have not been used within their time-to-live"""
+		now = time()
+		rows = self._query(
+			"SELECT chat_id FROM games WHERE last_seen < CASE WHEN started THEN ? ELSE ? END",
+			(now - game_ttl, now - lobby_ttl),
+		)
+		return [game for game in (self.remove(chat_id) for chat_id, in rows) if game]
+
+	def stats(self) -> dict[str, int]:
+		"""Get the number of active games, and the games created/ended by this worker in the last minute"""
+		active = len(self)
+		with self._lock:
+			cutoff = monotonic() - STATS_WINDOW
+			for timestamps in (self._created, self._ended):
+				while timestamps and timestamps[0] < cutoff:
+					timestamps.popleft()
+			return {
+				"Active games": active,
+				"Games created per minute": len(self._created),
+				"Games ended per minute": len(self._ended),
+			}
+
+	def close(self) -> None:
+		with self._database_lock:
+			self._connection.close()
+
+	def _sessions(self) -> dict[int, dict]:
+		if not hasattr(self._local, "sessions"):
+			self._local.sessions = {}
+		return self._local.sessions
+
+	def _acquire_lease(self, chat_id: int) -> None:
+		deadline = monotonic() + LEASE_TIMEOUT
+		while True:
+			now = time()
+			if self._execute(ACQUIRE_LEASE, (chat_id, self._owner, now + LEASE_DURATION, now)):
+				return
+			if monotonic() > deadline:
+				raise TimeoutError(f"Chat {chat_id} is held by another worker")
+			sleep(LEASE_POLL_INTERVAL)
+
+	def _execute(self, sql: str, parameters: tuple = ()) -> int:
+		"""Run a statement; returns the number of rows changed"""
+		with self._database_lock:
+			return self._connection.execute(sql, parameters).rowcount
+
+	def _query(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+		with self._database_lock:
+			return self._connection.execute(sql, parameters).fetchall()
@@ -1,5 +1,6 @@
 """This module represents the inline keyboard templates used for the game"""
 from enum import Enum
+from functools import lru_cache
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
@@ -32,9 +33,26 @@ GAME_LENGTH_MENU = InlineKeyboardMarkup(
 )
 
 
-GAME_ANSWER_MENU = InlineKeyboardMarkup(
-	[[
-		InlineKeyboardButton("Composer", callback_data=KeyboardText.COMPOSER.value),
-		InlineKeyboardButton("Pasta", callback_data=KeyboardText.PASTA.value),
-	]]
-)
+ANSWER_SEPARATOR = ":"  # between the answer, the game and the round in the callback data, e.g. "PASTA:1f2e3d4c:3"
+
+
+def get_answer_data(answer: str, game_id: str, round_number: int) -> str:
+	"""The callback data of an answer button"""
+	return ANSWER_SEPARATOR.join((answer, game_id, str(round_number)))
+
+
+def parse_answer_data(data: str) -> tuple[str, str, str]:
+	"""The (answer, game ID, round number) of an answer button's callback data"""
+	answer, game_id, round_number = data.split(ANSWER_SEPARATOR, 2)
+	return answer, game_id, round_number
+
+
+@lru_cache(maxsize=1024)
+def get_answer_menu(game_id: str, round_number: int) -> InlineKeyboardMarkup:
+	"""The answer buttons of a round; presses of an earlier round's, or an earlier game's, buttons can then be told apart"""
+	return InlineKeyboardMarkup(
+		[[
+			InlineKeyboardButton("Composer", callback_data=get_answer_data(KeyboardText.COMPOSER.value, game_id, round_number)),
+			InlineKeyboardButton("Pasta", callback_data=get_answer_data(KeyboardText.PASTA.value, game_id, round_number)),
+		]]
+	)
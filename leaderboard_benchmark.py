@@ -0,0 +1,114 @@
+"""Benchmark of the leaderboard queries at scale, against a full scan of the players
+
+Fills a player database with many players, then times /hiscore (the top players)
+and /rank (a player's rank, and the number of players) as PlayerData answers them,
+through the indexes of the player store. For comparison, the same answers are
+worked out by a full scan of every player in memory, as the bot used to do.
+
+Exits with 1 if a rank query takes longer than the budget, so that it can be run in CI.
+
+Usage:
+	python leaderboard_benchmark.py [--players N] [--queries N] [--rank-budget MS]
+"""
+import argparse
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+from player_data import PlayerData
+from player_store import PlayerStore, to_player
+
+
+RANK_BUDGET = 5  # milliseconds for the slowest rank query, at the default 1M players
+MAX_HIGH_SCORE = 50  # points in the longest game for a single player
+BATCH_SIZE = 100000  # players written per transaction
+
+
+def fill(store: PlayerStore, players: int, rng: random.Random) -> None:
+	for start in range(0, players, BATCH_SIZE):
+		store.upsert({
+			user_id: (f"Player {user_id}", rng.randint(0, MAX_HIGH_SCORE), rng.randint(1, 20))
+			for user_id in range(start, min(start + BATCH_SIZE, players))
+		})
+
+
+def load_all(path: Path) -> dict[int, dict]:
+	"""Every player, in memory, as the bot used to load them"""
+	connection = sqlite3.connect(path)
+	try:
+		return {
+			user_id: to_player(*player)
+			for user_id, *player in connection.execute("SELECT user_id, name, high_score, games_played FROM players")
+		}
+	finally:
+		connection.close()
+
+
+def time_queries(query: Callable[[int], object], user_ids: list[int]) -> tuple[float, float]:
+	"""The median and the slowest of the queries, in milliseconds"""
+	timings = []
+	for user_id in user_ids:
+		start = perf_counter()
+		query(user_id)
+		timings.append((perf_counter() - start) * 1000)
+	return statistics.median(timings), max(timings)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--players", type=int, default=1000000)
+	parser.add_argument("--queries", type=int, default=50, help="queries of each kind, for random players")
+	parser.add_argument("--rank-budget", type=float, default=RANK_BUDGET, help="milliseconds for the slowest rank query")
+	args = parser.parse_args()
+	rng = random.Random(0)
+
+	with tempfile.TemporaryDirectory() as directory:
+		path = Path(directory, "player_data.db")
+		store = PlayerStore(path)
+		start = perf_counter()
+		fill(store, args.players, rng)
+		print(f"Filled the player database with {args.players} players in {perf_counter() - start:.1f}s")
+		data = PlayerData(store, cache_size=0)  # every query goes to the store
+		user_ids = [rng.randrange(args.players) for _ in range(args.queries)]
+
+		def rank(user_id: int) -> tuple[int, int]:
+			return data.get_player_rank(user_id), data.count_players()
+
+		indexed = {
+			"/hiscore (top 10)": time_queries(lambda _: data.get_top_players(10), user_ids),
+			"/rank": time_queries(rank, user_ids),
+		}
+		store.close()
+
+		start = perf_counter()
+		players = load_all(path)
+		load_seconds = perf_counter() - start
+
+	def scan_rank(user_id: int) -> tuple[int, int]:
+		high_score = players[user_id]["High score"]
+		return 1 + sum(player["High score"] > high_score for player in players.values()), len(players)
+
+	scanned = {
+		"/hiscore (top 10)": time_queries(
+			lambda _: sorted(players.values(), key=lambda player: player["High score"], reverse=True)[:10], user_ids[:5],
+		),
+		"/rank": time_queries(scan_rank, user_ids[:5]),
+	}
+	print(f"Full scan: loading every player took {load_seconds:.1f}s")
+	print(f"{'Query':<20}{'indexed p50':>14}{'indexed max':>14}{'full scan p50':>16}")
+	for name, (median, slowest) in indexed.items():
+		print(f"{name:<20}{median:>12.2f}ms{slowest:>12.2f}ms{scanned[name][0]:>14.1f}ms")
+
+	slowest_rank = indexed["/rank"][1]
+	if slowest_rank > args.rank_budget:
+		print(f"FAILED: a rank query took {slowest_rank:.1f}ms, over the {args.rank_budget:.0f}ms budget")
+	sys.exit(1 if slowest_rank > args.rank_budget else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,464 @@
+"""Offline end-to-end load test of the bot, against a local fake Bot API
+
+Simulates group chats, each with a number of players who join, start a game,
+choose its length and answer every question, as fast as the bot handles their
+updates. The updates go through the real handlers (see main.register_handlers),
+and every Bot API request goes over HTTP to a local stand-in for Telegram, so no
+token is needed. Telegram's rate limits are turned off, and so are the pauses
+between messages, so that the bot itself is measured.
+
+With --pauses, the pauses are kept (scaled by --pause-scale), and the players
+wait for the bot's messages before answering, as real players would. They are
+either paced (the PacingScheduler, as the bot does), or slept in the handlers,
+holding a worker, as the bot used to; see pacing_benchmark.py.
+
+With --flood-rate, the fake Bot API refuses that share of the messages with a 429
+(flood control), so that the retries of the outbound queue are exercised.
+
+Reports the throughput, the per-update latency percentiles (from the update
+being queued to the dispatcher being done with it), the game durations and the
+peak memory, and saves them as JSON in load_test_results/, so that versions can
+be compared.
+
+Usage:
+	python load_test.py [--chats N] [--players M] [--length SHORT|MEDIUM|LONG] [--workers N]
+		[--api-latency MS] [--pauses off|paced|sleep] [--pause-scale X] [--flood-rate X] [--retry-after S]
+		[--label NAME] [--compare RESULTS_FILE]
+Exits with 1 if any message was lost, or sent out of order in its chat.
+"""
+import argparse
+import itertools
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Queue
+from time import monotonic, perf_counter, sleep, time
+from typing import Iterator
+
+try:
+	import resource
+except ImportError:  # Windows
+	resource = None
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, TypeHandler
+from telegram.utils.request import Request
+
+import data_handler
+import keyboard_model
+
+
+STAND_IN_TOKEN = "123456:load-test-token"  # never sent to Telegram; only needs to look like a token
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Composer or Pasta", "username": "composer_or_pasta_bot"}
+RESULTS_DIRECTORY = Path(".", "load_test_results")
+UNLIMITED_RATE = 1e9  # messages per second; effectively no rate limit
+TIMEOUT = 600  # seconds before a run is abandoned
+PAUSES = ("off", "paced", "sleep")
+
+
+class FakeBotApi(ThreadingHTTPServer):
+	"""Answers Bot API requests as Telegram would, after an optional delay, and counts them
+
+	With a flood rate, that share of the messages sent or edited is refused with a 429
+	(flood control), asking for them to be sent again after `retry_after` seconds.
+	The texts of the messages accepted are kept per chat, in the order they arrived.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, latency: float = 0.0, flood_rate: float = 0.0, retry_after: int = 1) -> None:
+		super().__init__(("127.0.0.1", 0), FakeBotApiHandler)
+		self.latency: float = latency
+		self.flood_rate: float = flood_rate
+		self.retry_after: int = retry_after
+		self.calls: dict[str, int] = {}
+		self.floods: int = 0
+		self.texts: dict[int, list[str]] = {}  # chat ID: texts of the messages sent or edited
+		self.message_ids = itertools.count(1)
+		self.random = random.Random(0)
+		self.lock = threading.Lock()
+
+	@property
+	def base_url(self) -> str:
+		return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+	def respond(self, method: str, data: dict) -> dict:
+		"""The response to a request: its result, or a refusal by flood control"""
+		if method in ("sendMessage", "editMessageText") and self.flood_rate:
+			with self.lock:
+				flooded = self.random.random() < self.flood_rate
+				self.floods += flooded
+			if flooded:
+				return {
+					"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+					"parameters": {"retry_after": self.retry_after},
+				}
+		return {"ok": True, "result": self.call(method, data)}
+
+	def call(self, method: str, data: dict) -> object:
+		with self.lock:
+			self.calls[method] = self.calls.get(method, 0) + 1
+			if method in ("sendMessage", "editMessageText"):
+				self.texts.setdefault(int(data["chat_id"]), []).append(data.get("text", ""))
+		if self.latency:
+			sleep(self.latency)
+		if method == "getMe":
+			return BOT_USER
+		if method in ("sendMessage", "editMessageText"):
+			return {
+				"message_id": int(data.get("message_id", 0)) or next(self.message_ids),
+				"date": int(time()),
+				"chat": {"id": int(data["chat_id"]), "type": "group", "title": "Load test"},
+				"from": BOT_USER,
+				"text": data.get("text", ""),
+			}
+		return True
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"  # keep-alive, as with Telegram
+	disable_nagle_algorithm = True  # or each response waits on the client's delayed acknowledgement
+
+	def do_POST(self) -> None:
+		length = int(self.headers.get("Content-Length", 0))
+		data = json.loads(self.rfile.read(length) or b"{}")
+		method = self.path.rsplit("/", 1)[-1]
+		response = self.server.respond(method, data)
+		body = json.dumps(response).encode()
+		self.send_response(response.get("error_code", 200))
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	do_GET = do_POST
+
+	def log_message(self, *_) -> None:
+		pass
+
+
+class ChatDriver:
+	"""The players of a group chat, who send their next update once the last one has been handled"""
+
+	update_ids = itertools.count(1)
+
+	def __init__(self, main_module, chat_id: int, players: int, length: str) -> None:
+		self.main = main_module
+		self.chat_id: int = chat_id
+		self.users: list[dict] = [
+			{"id": chat_id * -1000 + i, "is_bot": False, "first_name": f"Player {i}"} for i in range(players)
+		]
+		self.length: str = length
+		self.steps: Iterator[tuple[str, dict]] = self._steps()
+		self.sent_at: float = 0.0
+		self.kind: str = ""
+		self.started_at: float | None = None
+		self.finished_at: float | None = None
+
+	def next_update(self) -> dict | None:
+		"""The next update to send, and what kind of update it is; None once the game is over"""
+		step = next(self.steps, None)
+		self.sent_at = perf_counter()
+		if step is None:
+			self.finished_at = self.sent_at
+			return None
+		if self.started_at is None:
+			self.started_at = self.sent_at
+		self.kind, update = step
+		return update
+
+	def _steps(self) -> Iterator[tuple[str, dict]]:
+		yield "newgame", self._command(self.users[0], "/newgame")
+		for user in self.users:
+			yield "join", self._press(user, "JOIN")
+		yield "start", self._press(self.users[0], "START")
+		yield "length", self._press(self.users[0], self.length)
+		while game := self.main.get_game(self.chat_id):  # read once the previous update has been handled
+			player = game.get_current_player()
+			user = next(user for user in self.users if user["id"] == player)
+			answer = "COMPOSER" if next(self.update_ids) % 2 else "PASTA"
+			yield "answer", self._press(user, keyboard_model.get_answer_data(answer, game.game_id, game.current_round))
+
+	def _chat(self) -> dict:
+		return {"id": self.chat_id, "type": "group", "title": "Load test"}
+
+	def _command(self, user: dict, text: str) -> dict:
+		return {
+			"update_id": next(self.update_ids),
+			"message": {
+				"message_id": next(self.update_ids),
+				"date": int(time()),
+				"chat": self._chat(),
+				"from": user,
+				"text": text,
+				"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+			},
+		}
+
+	def _press(self, user: dict, data: str) -> dict:
+		return {
+			"update_id": next(self.update_ids),
+			"callback_query": {
+				"id": str(next(self.update_ids)),
+				"from": user,
+				"chat_instance": str(self.chat_id),
+				"data": data,
+				"message": {"message_id": 1, "date": int(time()), "chat": self._chat(), "from": BOT_USER, "text": "..."},
+			},
+		}
+
+
+def make_sleeping_pacer(pause_scale: float):
+	"""A pacer that pauses as the handlers used to: by sleeping after each message, holding the worker"""
+	import pacing
+
+	class SleepingPacer(pacing.PacingScheduler):
+		def schedule(self, chat_id: int, callback, pause: float = 0) -> None:
+			self._run(callback)
+			sleep(pause * self.pause_scale)
+
+	return SleepingPacer(pause_scale=pause_scale)
+
+
+def isolate_player_data(directory: str) -> None:
+	"""Keep the load test's scores out of the real player database"""
+	data_handler.PLAYER_DATA_DIRECTORY = Path(directory, "player_data.yaml")
+	data_handler.PLAYER_DATABASE_DIRECTORY = Path(directory, "player_data.db")
+
+
+def peak_memory_mb() -> float | None:
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+	"""p50/p90/p99/max, in milliseconds"""
+	if not values:
+		return {}
+	ordered = sorted(values)
+	pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+	return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": ordered[-1] * 1000}
+
+
+def get_version() -> str:
+	try:
+		return subprocess.run(
+			["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+
+def set_up_bot(main, api: FakeBotApi, update_queue: Queue, workers: int) -> Dispatcher:
+	"""The bot's handlers on a dispatcher of the update queue, sending to the fake Bot API without rate limits
+
+	Handlers for measuring can be added to the dispatcher before it is started,
+	with main.router.attach(dispatcher), then dispatcher.start().
+	"""
+	import chat_router
+	import outbound
+
+	bot = Bot(STAND_IN_TOKEN, base_url=api.base_url, request=Request(con_pool_size=workers + outbound.SENDER_THREADS + 2))
+	main.outbox = outbound.OutboundQueue(
+		bot, per_chat_rate=UNLIMITED_RATE, global_rate=UNLIMITED_RATE, global_burst=UNLIMITED_RATE,
+	)
+	main.outbox.start()
+	main.saver.start()
+	main.router = chat_router.ChatRouter(workers)
+	dispatcher = Dispatcher(bot, update_queue, workers=workers, use_context=True)
+	main.register_handlers(dispatcher)
+	return dispatcher
+
+
+def stop_bot(main, dispatcher: Dispatcher) -> None:
+	"""Stop the dispatcher, then let the bot finish what it has started"""
+	dispatcher.stop()
+	main.router.stop()
+	main.outbox.stop()
+	main.saver.stop()
+
+
+def run(
+		chats: int, players: int, length: str, workers: int, api_latency: float, pauses: str = "off", pause_scale: float = 1.0,
+		flood_rate: float = 0.0, retry_after: int = 1,
+) -> dict:
+	import main
+	import pacing
+
+	main.create_app()  # after isolate_player_data(), as it opens the player database
+	api = FakeBotApi(api_latency, flood_rate, retry_after)
+	threading.Thread(target=api.serve_forever, name="fake_bot_api", daemon=True).start()
+	if pauses == "sleep":
+		main.pacer = make_sleeping_pacer(pause_scale)
+	else:
+		main.pacer = pacing.PacingScheduler(pause_scale=pause_scale if pauses == "paced" else 0)
+	update_queue = Queue()
+	dispatcher = set_up_bot(main, api, update_queue, workers)
+	bot = dispatcher.bot
+	submitted: dict[int, list[str]] = {}  # chat ID: texts of the messages sent or edited, in the order they were queued
+	submit = main.outbox.submit
+	submit_lock = threading.Lock()
+
+	def record_and_submit(method: str, chat_id: int, **kwargs) -> None:
+		with submit_lock:
+			if method in ("send_message", "edit_message_text"):
+				submitted.setdefault(chat_id, []).append(kwargs.get("text", ""))
+			submit(method, chat_id, **kwargs)
+
+	main.outbox.submit = record_and_submit
+	drivers = {-1000 - i: ChatDriver(main, -1000 - i, players, length) for i in range(chats)}
+	latencies: dict[str, list[float]] = {}
+	finished = threading.Event()
+	remaining = [chats]
+	lock = threading.Lock()
+
+	def send_next(driver: ChatDriver) -> None:
+		next_update = driver.next_update()
+		if next_update:
+			update_queue.put(Update.de_json(next_update, bot))
+		else:
+			with lock:
+				remaining[0] -= 1
+				if not remaining[0]:
+					finished.set()
+
+	def handled(update: Update, _) -> None:
+		"""Runs after the bot's handlers for each update; sends the chat's next update, once the bot's messages are out"""
+		driver = drivers[update.effective_chat.id]
+		latencies.setdefault(driver.kind, []).append(perf_counter() - driver.sent_at)
+		delay = main.pacer.free_at(driver.chat_id) - monotonic()
+		if delay > 0:  # the players read the paced messages first
+			threading.Timer(delay, send_next, args=(driver,)).start()
+		else:
+			send_next(driver)
+
+	dispatcher.add_handler(TypeHandler(Update, handled), group=1)
+	main.router.attach(dispatcher)
+	threading.Thread(target=dispatcher.start, name="dispatcher", daemon=True).start()
+	start = perf_counter()
+	for driver in drivers.values():
+		update_queue.put(Update.de_json(driver.next_update(), bot))
+	completed = finished.wait(TIMEOUT)
+	elapsed = perf_counter() - start
+	stop_bot(main, dispatcher)
+	api.shutdown()
+
+	updates = sum(map(len, latencies.values()))
+	return {
+		"Version": get_version(),
+		"Date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+		"Parameters": {
+			"Chats": chats, "Players": players, "Length": length, "Workers": workers, "API latency": api_latency,
+			"Pauses": pauses, "Pause scale": pause_scale,
+		},
+		"Completed": completed,
+		"Updates": updates,
+		"Seconds": elapsed,
+		"Updates per second": updates / elapsed,
+		"Latency (ms)": percentiles([value for values in latencies.values() for value in values]),
+		"Latency by update (ms)": {kind: percentiles(values) for kind, values in latencies.items()},
+		"Game duration (ms)": percentiles([
+			driver.finished_at - driver.started_at for driver in drivers.values() if driver.finished_at is not None
+		]),
+		"Bot API calls": api.calls,
+		"Outbound": {
+			"Refused by flood control": api.floods,
+			"Retried": main.outbox.retried,
+			"Failed": main.outbox.failed,
+			"Merged": main.outbox.merged,
+			# Merged messages are joined by a blank line, so the joined texts of each chat are the same if none were lost or reordered
+			"Delivered in order": all(
+				"\n\n".join(api.texts.get(chat_id, [])) == "\n\n".join(texts) for chat_id, texts in submitted.items()
+			),
+		},
+		"Peak memory (MB)": peak_memory_mb(),
+	}
+
+
+def report(results: dict, baseline: dict | None = None) -> None:
+	def compare(key: str, value: float, higher_is_better: bool) -> str:
+		if not baseline or not baseline.get(key):
+			return ""
+		change = value / baseline[key] - 1
+		better = (change > 0) == higher_is_better
+		return f" ({change:+.1%} vs {baseline['Version']}, {'better' if better else 'worse'})"
+
+	print(f"Version {results['Version']}; {results['Parameters']}")
+	if not results["Completed"]:
+		print(f"WARNING: not every game finished within {TIMEOUT}s")
+	print(
+		f"Updates: {results['Updates']} in {results['Seconds']:.2f}s, "
+		f"{results['Updates per second']:.0f} updates/sec"
+		f"{compare('Updates per second', results['Updates per second'], True)}"
+	)
+	latency = results["Latency (ms)"]
+	baseline_latency = (baseline or {}).get("Latency (ms)", {})
+	for name, value in latency.items():
+		change = f" ({value / baseline_latency[name] - 1:+.1%})" if baseline_latency.get(name) else ""
+		print(f"  {name} latency: {value:.2f}ms{change}")
+	for kind, values in results["Latency by update (ms)"].items():
+		print(f"  {kind}: p50 {values['p50']:.2f}ms, p99 {values['p99']:.2f}ms")
+	duration = results.get("Game duration (ms)")
+	if duration:
+		print(f"Game duration: p50 {duration['p50'] / 1000:.2f}s, max {duration['max'] / 1000:.2f}s")
+	print(f"Bot API calls: {results['Bot API calls']}")
+	outbound = results["Outbound"]
+	print(
+		f"Outbound: {outbound['Refused by flood control']} refused by flood control, {outbound['Retried']} retried, "
+		f"{outbound['Failed']} failed, {outbound['Merged']} merged; "
+		f"{'every message delivered in order' if outbound['Delivered in order'] else 'messages LOST OR REORDERED'}"
+	)
+	if results["Peak memory (MB)"] is not None:
+		memory = results["Peak memory (MB)"]
+		print(f"Peak memory: {memory:.1f}MB{compare('Peak memory (MB)', memory, False)}")
+
+
+def save_results(results: dict, label: str | None) -> Path:
+	RESULTS_DIRECTORY.mkdir(exist_ok=True)
+	path = RESULTS_DIRECTORY / f"{label or results['Version']}.json"
+	with open(path, "w", encoding="utf-8") as results_file:
+		json.dump(results, results_file, indent="\t")
+	return path
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--chats", type=int, default=100, help="concurrent group chats")
+	parser.add_argument("--players", type=int, default=4, help="players in each chat")
+	parser.add_argument("--length", choices=("SHORT", "MEDIUM", "LONG"), default="SHORT", help="game length")
+	parser.add_argument("--workers", type=int, default=4, help="threads handling updates (see chat_router)")
+	parser.add_argument("--api-latency", type=float, default=0.0, help="milliseconds the fake Bot API takes per request")
+	parser.add_argument("--pauses", choices=PAUSES, default="off", help="keep the pauses between messages, paced or slept")
+	parser.add_argument("--pause-scale", type=float, default=1.0, help="factor for the pauses, e.g. 0.1 for shorter runs")
+	parser.add_argument("--flood-rate", type=float, default=0.0, help="share of messages the fake Bot API refuses with a 429")
+	parser.add_argument("--retry-after", type=int, default=1, help="seconds the 429 responses ask to wait")
+	parser.add_argument("--label", help="name of the results file; the git version by default")
+	parser.add_argument("--compare", help="results file of an earlier run, to compare against")
+	args = parser.parse_args()
+
+	baseline = None
+	if args.compare:
+		with open(args.compare, "r", encoding="utf-8") as baseline_file:
+			baseline = json.load(baseline_file)
+	with tempfile.TemporaryDirectory() as directory:
+		isolate_player_data(directory)
+		results = run(
+			args.chats, args.players, args.length, args.workers, args.api_latency / 1000, args.pauses, args.pause_scale,
+			args.flood_rate, args.retry_after,
+		)
+		data_handler.get_player_store().close()
+	report(results, baseline)
+	print(f"Results saved to {save_results(results, args.label)}")
+	sys.exit(0 if results["Outbound"]["Delivered in order"] else 1)
+
+
+if __name__ == "__main__":
+	main()
@@ -2,15 +2,49 @@
 
 Business logic obtained from https://www.toptal.com/python/in-depth-python-logging
 This is a logger wrapper to log the operations of the program, for debug purposes
+
+Records from every module go through a queue to a single set of handlers (console
+and file), which format and write them on a background thread, so that handler
+threads never wait on the disk. Use %-style arguments in log calls, so that the
+message is only built if the record is actually logged.
+
+Getting a logger has no side effects: the queue, its thread and the log file are
+only set up by configure() (e.g. from main.create_app()). Until then, records go
+wherever the program importing the modules has set up logging, or to Python's
+last resort handler (warnings and errors, to stderr).
 """
-import sys
+import atexit
+import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from queue import SimpleQueue
 
 # Use a config file for these, in larger projects:
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 FORMATTER = logging.Formatter(LOG_FORMAT)
 LOG_FILE = "composer_or_pasta.log"
+DEFAULT_LEVEL = "ERROR"  # until configure() is called with the configured level
+_listener: QueueListener | None = None
+_queue_handler: QueueHandler | None = None
+_setup_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+	"""Formats each record as a single line of JSON, for log collectors
+
+	Tracebacks are part of the message, as the queue handler has already appended them.
+	"""
+
+	def format(self, record: logging.LogRecord) -> str:
+		return json.dumps({
+			"time": self.formatTime(record),
+			"logger": record.name,
+			"level": record.levelname,
+			"thread": record.threadName,
+			"message": record.getMessage(),
+		}, ensure_ascii=False)
 
 
 def get_console_handler() -> logging.Handler:
@@ -32,20 +66,49 @@ class NullHandler(logging.Handler):
 		pass
 
 
-def get_logger(logger_name: str) -> logging.Logger:
-	logger = logging.getLogger(logger_name)
-	logger.setLevel(logging.ERROR)  # better to have too much log than not enough
+def setup_logging() -> None:
+	"""Route all records through a queue to the console and file handlers; only the first call has any effect"""
+	global _listener, _queue_handler
+	with _setup_lock:
+		if _listener:
+			return
+		log_queue = SimpleQueue()
+		_queue_handler = QueueHandler(log_queue)
+		root = logging.getLogger()
+		root.setLevel(DEFAULT_LEVEL)
+		root.addHandler(_queue_handler)
+		_listener = QueueListener(log_queue, get_console_handler(), get_file_handler(), respect_handler_level=True)
+		_listener.start()
+		atexit.register(stop_listener)  # runs before logging's own clean-up, which flushes the handlers
+
+
+def configure(level: str = DEFAULT_LEVEL, levels: dict[str, str] | None = None, json_format: bool = False) -> None:
+	"""Set the level of all loggers, the levels of particular loggers (e.g. {"telegram": "WARNING"}), and the output format"""
+	setup_logging()
+	logging.getLogger().setLevel(level.upper())
+	for logger_name, logger_level in (levels or {}).items():
+		logging.getLogger(logger_name).setLevel(logger_level.upper())
+	formatter = JsonFormatter() if json_format else FORMATTER
+	for handler in _listener.handlers:
+		handler.setFormatter(formatter)
 
-	# Use silent handler if you want to be able to turn logging on and off
-	# h = NullHandler()  # Instantiate with a silent handler that doesn't return anything, since
-	# logger.addHandler(h)  # the logger object from the logging module REQUIRES at least ONE handler
 
-	# Use default handler in this method, to always have logging on by default:
-	logger.addHandler(get_console_handler())
-	logger.addHandler(get_file_handler())
+def get_logger(logger_name: str) -> logging.Logger:
+	# Loggers inherit the level and the (shared) handlers of the root logger, so that
+	# each record is written once, however many modules ask for a logger
+	return logging.getLogger(logger_name)
+
 
-	return logger
+def stop_listener() -> None:
+	"""Write out the records still in the queue, and stop the background thread"""
+	global _listener, _queue_handler
+	with _setup_lock:
+		if _listener:
+			logging.getLogger().removeHandler(_queue_handler)
+			_listener.stop()
+			_listener = _queue_handler = None
 
 
 def shutdown_logger() -> None:
+	stop_listener()
 	logging.shutdown()
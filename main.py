@@ -1,55 +1,197 @@
-"""Simple bot implementation for the Composer or Pasta game"""
-import random
-from time import sleep
-
-from telegram import Update
-from telegram.ext import (
-	CallbackContext,
-	CallbackQueryHandler,
-	CommandHandler,
-	ConversationHandler,
-	Filters,
-	MessageHandler,
-	Updater,
-)
-
+"""Simple bot implementation for the Composer or Pasta game
+
+Importing this module has no side effects: create_app() loads the settings and the
+data, and sets up the components of the bot, and main() runs it. Scripts, tools
+and health checks can then import the module cheaply. The heavier parts of
+python-telegram-bot (telegram.ext) are only imported once the bot is run.
+"""
+from __future__ import annotations
+
+import logging
+import signal
+import threading
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Callable
+
+from telegram import Chat, Update
+
+import config
 import data_handler
-# import duplicate_checker
+import game_snapshot
+import game_stats
+import duplicate_checker
+import game_store
 import logger
 import keyboard_model
+import message_renderer
+import metrics
+import outbound
+import pacing
+import question_deck
+import webhook_server
+import word_bank_manager
+import write_behind
 from game import (
+	GameLength,
 	States,
 	Game,
 )
+from game_registry import GameRegistry
+from player_data import PlayerData
+
+if TYPE_CHECKING:
+	import chat_router
+	from telegram.ext import CallbackContext, Dispatcher, Updater
 
 
 kookiie_logger = logger.get_logger(__name__)
-kookiie_logger.info("COMPOSER OR PASTA TELEGRAM BOT")
-kookiie_logger.info("===============================")
-kookiie_logger.info("Logger successfully loaded in main.")
-data = data_handler.load_player_data()
-COMPOSERS = data_handler.load_composer()
-COMPOSER_KEYS = list(COMPOSERS.keys())
-kookiie_logger.info("Composer keys cached.")
-PASTAS = data_handler.load_pasta()
-PASTA_KEYS = list(PASTAS.keys())
-kookiie_logger.info("Pasta keys cached.")
-kookiie_logger.info("Data loaded.")
-active_games: list[Game] = []
+# The components of the bot, set up by create_app():
+settings: dict = {}
+data: PlayerData | None = None
+saver: write_behind.WriteBehindSaver | None = None
+stats: game_stats.GameStatsRollup | None = None
+word_banks: word_bank_manager.WordBankManager | None = None
+active_games: GameRegistry | game_store.SQLiteGameRegistry | None = None
+snapshotter: game_snapshot.GameSnapshotter | None = None
+question_weights: dict[tuple[str, str], float] | None = None  # by difficulty, if enabled; see refresh_question_weights()
+router: chat_router.ChatRouter | None = None  # set up by main(), as it needs telegram.ext
+pacer = pacing.PacingScheduler()
+outbox = outbound.OutboundQueue()
+HANDLER_SECONDS = metrics.REGISTRY.histogram("handler_seconds", "Duration of update handlers.", "handler")
+GAMES_STARTED = metrics.REGISTRY.counter("games_started_total", "Games started with /newgame.")
+GAMES_FINISHED = metrics.REGISTRY.counter("games_finished_total", "Games played to the end.")
+GAMES_CANCELLED = metrics.REGISTRY.counter("games_cancelled_total", "Games cancelled with /cancel.")
+GAMES_EVICTED = metrics.REGISTRY.counter("games_evicted_total", "Abandoned games evicted from the registry.")
+metrics.REGISTRY.gauge("active_games", "Games in progress or waiting for players.", lambda: len(active_games))
+metrics.REGISTRY.gauge(
+	"updates_pending", "Updates waiting for, or being handled by, a chat router worker.", lambda: router.pending() if router else 0,
+)
+metrics.REGISTRY.gauge("outbound_queued", "Bot API requests waiting to be sent.", lambda: outbox.pending())
+metrics.REGISTRY.gauge("outbound_sent_total", "Bot API requests sent.", lambda: outbox.sent)
+metrics.REGISTRY.gauge("outbound_retried_total", "Bot API requests retried.", lambda: outbox.retried)
+metrics.REGISTRY.gauge("outbound_failed_total", "Bot API requests given up on.", lambda: outbox.failed)
+metrics.REGISTRY.gauge("outbound_merged_total", "Messages merged into the message before them.", lambda: outbox.merged)
+metrics.REGISTRY.gauge("player_cache_hits_total", "Player lookups served from the cache.", lambda: data.cache.hits)
+metrics.REGISTRY.gauge("player_cache_misses_total", "Player lookups read from the database.", lambda: data.cache.misses)
+metrics.REGISTRY.gauge("player_cache_evictions_total", "Players evicted from the cache.", lambda: data.cache.evictions)
+metrics.REGISTRY.gauge("player_cache_size", "Players in the cache.", lambda: len(data.cache))
+metrics.REGISTRY.gauge("player_data_flushes_total", "Writes of player data to the database.", lambda: saver.flushes)
 JOIN_MENU_STOCK_TEXT = "Tap 'Join' to join the game, and 'Start' once all players have joined."
+LEADERBOARD_LENGTH = 10
+BLITZ_PLAYER_NAME = "Everyone"
+END = -1  # returned by a handler once there is no game left (the value of ConversationHandler.END)
+
+
+def create_app() -> None:
+	"""Load the settings and the data, and set up the components of the bot; only the first call has any effect"""
+	global settings, data, saver, stats, word_banks, active_games, snapshotter
+	if settings:
+		return
+	loaded_settings = config.load_config()
+	logger.configure(
+		loaded_settings["logging"]["level"], loaded_settings["logging"]["levels"], loaded_settings["logging"]["json"],
+	)
+	kookiie_logger.info("COMPOSER OR PASTA TELEGRAM BOT")
+	kookiie_logger.info("===============================")
+	data = data_handler.load_player_data(loaded_settings["player_cache"]["size"], loaded_settings["player_cache"]["ttl"])
+	saver = write_behind.WriteBehindSaver(data)
+	stats = game_stats.GameStatsRollup(data.store)
+	word_banks = word_bank_manager.WordBankManager(
+		{"composer": loaded_settings["word_banks"]["composer"], "pasta": loaded_settings["word_banks"]["pasta"]},
+		on_reload=(
+			(lambda banks: duplicate_checker.check(banks.composer_keys, banks.pasta_keys))
+			if loaded_settings["check_word_banks"]
+			else None
+		),
+	)
+	kookiie_logger.info("Data loaded.")
+	active_games = (
+		game_store.SQLiteGameRegistry(Path(loaded_settings["state_database"]))
+		if loaded_settings["state_backend"] == "sqlite"
+		else GameRegistry()
+	)
+	snapshotter = (
+		game_snapshot.GameSnapshotter(active_games, Path(loaded_settings["snapshot_file"]))
+		if isinstance(active_games, GameRegistry)
+		else None  # games in the shared database already survive restarts
+	)
+	settings = loaded_settings
 
 
-# Active game list-related functions ------------------------------------------
+# Active game registry-related functions --------------------------------------
 def get_game(chat_id: int) -> Game | None:
-	"""Get a particular game from the list of active games"""
-	for game in active_games:
-		if game.chat_id == chat_id:
-			return game
-	return None
+	"""Get a particular game from the registry of active games"""
+	return active_games.get(chat_id)
 
 
 def remove_current_game(chat_id: int) -> None:
-	active_games.remove(get_game(chat_id))
+	active_games.remove(chat_id)
+
+
+def game_handler(*states: States) -> Callable:
+	"""Run the handler within a session on the chat's game, while the game is in one of the states
+
+	The state returned by the handler becomes the state of the game. This replaces the
+	in-memory ConversationHandler, so that the state can be shared between workers.
+	Without states, the handler runs whether or not there is a game (e.g. to start one).
+	"""
+	def decorator(handler: Callable[[Update, CallbackContext], int | None]) -> Callable:
+		@wraps(handler)
+		def wrapper(update: Update, context: CallbackContext) -> int | None:
+			chat_id = update.effective_chat.id
+			with active_games.session(chat_id):
+				game = get_game(chat_id)
+				if states and (not game or game.state not in states):  # stale button, or cancelled/evicted game
+					if update.callback_query:
+						answer_query(update)  # clear the progress bar
+					return None
+				result = handler(update, context)
+				game = get_game(chat_id)  # the handler could have started or ended the game
+				if game and isinstance(result, States):
+					game.state = result
+			return result
+		return wrapper
+	return decorator
+
+
+def evict_idle_games(_: CallbackContext) -> None:
+	"""Remove abandoned games from the registry"""
+	for game in active_games.evict_idle():
+		GAMES_EVICTED.increment()
+		kookiie_logger.info("Evicted abandoned game in chat %s.", game.chat_id)
+	kookiie_logger.debug("Game registry stats: %s", active_games.stats())
+
+
+def refresh_question_weights(_: CallbackContext | None = None) -> None:
+	"""Weight the questions of new games by difficulty, from the latest word statistics"""
+	global question_weights
+	try:
+		word_stats = data.store.get_word_stats(settings["questions"]["min_answers"])
+	except Exception as e:  # the last weights are kept
+		kookiie_logger.error("Error! The following exception was encountered while reading the word statistics: %s", e)
+		return
+	question_weights = question_deck.get_difficulty_weights(word_stats)
+
+
+def restore_games() -> None:
+	"""Restore the games of the last snapshot, and ask the current question of started games again
+
+	The question may have been lost in flight, or the snapshot may predate the last answer;
+	either way, the players can carry on from the round the game was saved at.
+	"""
+	games = snapshotter.restore(keyboard_model.KeyboardText)
+	for game in games:
+		if game.state == States.CHECK_ANSWER:
+			outbox.submit(
+				"send_message",
+				game.chat_id,
+				text=render_question(game),
+				parse_mode="MarkdownV2",
+				reply_markup=keyboard_model.get_answer_menu(game.game_id, game.current_round),
+			)
+	kookiie_logger.info("Restored %d games from the snapshot.", len(games))
 
 
 def get_user(chat_id: int, user_id: int) -> int | None:
@@ -66,26 +208,43 @@ def get_players(chat_id: int) -> list:
 	return list(get_game(chat_id).players.values())
 
 
-# Question/Answer generation: -------------------------------------------------
-def set_question(game: Game) -> None:
-	first_roll = random.randint(1, 100)
-	if first_roll > 50:  # arbitrary number; pasta
-		pasta = random.choice(PASTA_KEYS)
-		game.correct_answer = (keyboard_model.KeyboardText.PASTA, pasta)
-		return
-	composer = random.choice(COMPOSER_KEYS)
-	game.correct_answer = (keyboard_model.KeyboardText.COMPOSER, composer)
+# Paced messaging: -------------------------------------------------------------
+def reply_text(update: Update, text: str, pause: float = 0, **kwargs) -> None:
+	"""Reply to the message in the update, once the chat is free"""
+	chat = update.effective_chat
+	if chat.type != Chat.PRIVATE:  # quote the message in groups, as Message.reply_text() would
+		kwargs.setdefault("reply_to_message_id", update.message.message_id)
+	pacer.schedule(chat.id, lambda: outbox.submit("send_message", chat.id, text=text, **kwargs), pause)
 
 
-def format_composer_answer(game: Game) -> str:
-	composers = COMPOSERS.get(game.correct_answer[1])
-	kookiie_logger.debug(f"Composers: {str(composers)}")
-	if len(composers) == 1:
-		return f"{composers[0]} is a composer."
-	
-	temp = composers.copy()
-	temp[-1] = f"and {temp[-1]}"
-	return f"{game.correct_answer[1].capitalize()} is the last name for the following composers: {', '.join(temp)}."
+def send_message(update: Update, text: str, pause: float = 0, **kwargs) -> None:
+	"""Send a message to the chat in the update, once the chat is free"""
+	chat_id = update.effective_chat.id
+	pacer.schedule(chat_id, lambda: outbox.submit("send_message", chat_id, text=text, **kwargs), pause)
+
+
+def edit_message_text(update: Update, text: str, pause: float = 0, **kwargs) -> None:
+	"""Edit the message of the callback query in the update, once the chat is free"""
+	chat_id = update.effective_chat.id
+	message_id = update.callback_query.message.message_id
+	pacer.schedule(
+		chat_id,
+		lambda: outbox.submit("edit_message_text", chat_id, text=text, message_id=message_id, **kwargs),
+		pause,
+	)
+
+
+def answer_query(update: Update, text: str | None = None) -> None:
+	"""Answer the callback query in the update (clearing its progress bar), timed as the other Bot API requests
+
+	Answered at once, rather than through the outbox, as Telegram expects an answer
+	within seconds, and it is not a message in the chat.
+	"""
+	start = perf_counter()
+	try:
+		update.callback_query.answer(text)
+	finally:
+		outbound.API_SECONDS.observe("answer_callback_query", perf_counter() - start)
 
 
 # Main bot sequence -----------------------------------------------------------
@@ -102,98 +261,158 @@ def fetch_token() -> str:
 
 def start(update: Update, _: CallbackContext) -> None:
 	"""Greet user when a user first talks to the bot"""
-	update.message.reply_text("To start a game, use the command /newgame")
-	sleep(1)
+	reply_text(update, "To start a game, use the command /newgame", pause=1)
 
 
 def get_player_high_score(update: Update, _: CallbackContext) -> None:
 	"""Send the highest score recorded for the player"""
 	player = data.get_player(update.message.from_user.id)
 	if not player:
-		update.message.reply_text(
+		reply_text(
+			update,
 			f"Hi, {update.message.from_user.full_name}.\n"
-			"Your high score is: 0, through a total of 0 games."
+			"Your high score is: 0, through a total of 0 games.",
+			pause=2,
 		)
 	else:
-		update.message.reply_text(
+		reply_text(
+			update,
 			f"Hi, {player.get('Name')}.\n"
 			f"Your high score is: {player.get('High score')}, "
-			f"through a total of {player.get('Number of games played')} games."
+			f"through a total of {player.get('Number of games played')} games.",
+			pause=2,
 		)
-	sleep(2)
 
 
 def get_high_score(update: Update, _: CallbackContext) -> None:
-	"""Send the highest score in the leaderboard"""
-	update.message.reply_text(
-		f"*The highest score in the leaderboard is:*\n{data.get_highest_score()}",
-		parse_mode="MarkdownV2",
+	"""Send the highest scores in the leaderboard"""
+	players = data.get_top_players(LEADERBOARD_LENGTH)
+	if not players:
+		reply_text(update, "There are no scores in the leaderboard yet.", pause=2)
+		return
+	message = "<b>The highest scores in the leaderboard are:</b>\n"
+	for position, player in enumerate(players, start=1):
+		message += f"{position}. <i>{message_renderer.escape_html(player.get('Name'))}</i>: {player.get('High score')}\n"
+	reply_text(update, message, pause=2, parse_mode="HTML")
+
+
+def get_chat_high_score(update: Update, _: CallbackContext) -> None:
+	"""Send the highest scores of the players in this chat"""
+	players = data.store.top_in_chat(update.effective_chat.id, LEADERBOARD_LENGTH)
+	if not players:
+		reply_text(update, "There are no scores in this chat's leaderboard yet.", pause=2)
+		return
+	message = "<b>The highest scores in this chat are:</b>\n"
+	for position, (_, player) in enumerate(players, start=1):
+		message += (
+			f"{position}. <i>{message_renderer.escape_html(player.get('Name'))}</i>: {player.get('High score')} "
+			f"({player.get('Number of games played')} games)\n"
+		)
+	reply_text(update, message, pause=2, parse_mode="HTML")
+
+
+def get_player_rank(update: Update, _: CallbackContext) -> None:
+	"""Send the leaderboard rank of the player"""
+	user = update.message.from_user
+	rank = data.get_player_rank(user.id)
+	if rank is None:
+		reply_text(
+			update,
+			f"Hi, {user.full_name}.\n"
+			"You are not on the leaderboard yet. Use the command /newgame to play!",
+			pause=2,
+		)
+		return
+	reply_text(
+		update,
+		f"Hi, {user.full_name}.\n"
+		f"You are ranked #{rank} of {data.count_players()} players, "
+		f"with a high score of {data.get_player_high_score(user.id)}.",
+		pause=2,
 	)
-	sleep(2)
 
 
+@game_handler(States.SEND_INVITE)
 def handle_join_button(update: Update, _: CallbackContext) -> int:
 	"""Join button clicked"""
 	query = update.callback_query
 	user = query.from_user
 	chat_id = update.effective_chat.id
 
-	query.answer()  # clear the progress bar, if there was a query
+	answer_query(update)  # clear the progress bar, if there was a query
 	add_player(chat_id, user.id, user.full_name)
-	query.edit_message_text(
-		f"{JOIN_MENU_STOCK_TEXT}\n\n<b>Players:</b>\n<pre>{', '.join(get_players(chat_id))}</pre>",
+	edit_message_text(
+		update,
+		f"{JOIN_MENU_STOCK_TEXT}\n\n<b>Players:</b>\n<pre>{message_renderer.escape_html(', '.join(get_players(chat_id)))}</pre>",
 		parse_mode="HTML",
 		reply_markup=keyboard_model.JOIN_INVITE_MENU,
 	)
 	return States.SEND_INVITE  # continue checking for joins
 
 
+@game_handler(States.SEND_INVITE)
 def handle_start_button(update: Update, _: CallbackContext) -> int:
 	"""Start button clicked"""
 	query = update.callback_query
 	user = query.from_user
 	chat_id = update.effective_chat.id
 
-	query.answer()  # clear the progress bar, if there was a query
+	answer_query(update)  # clear the progress bar, if there was a query
 	if not get_user(chat_id, user.id):  # if player isn't in the game, assume they want to join
 		add_player(chat_id, user.id, user.full_name)
-	query.edit_message_text("Game started.")
+	edit_message_text(update, "Game started.")
 
 	return send_duration_menu(update)
 
 
 def send_duration_menu(update: Update) -> int:
 	"""Let the user choose how many rounds to play"""
-	update.effective_chat.send_message(
+	send_message(
+		update,
 		"Select the length/duration that you would like to play.",
 		reply_markup=keyboard_model.GAME_LENGTH_MENU,
 	)
 	return States.GET_GAME_LENGTH
 
 
+@game_handler()
 def start_new_game(update: Update, _: CallbackContext) -> int:
-	"""Start a new game
+	"""Start a new game, where the players take turns"""
+	return open_game(update, blitz=False)
+
+
+@game_handler()
+def start_new_blitz_game(update: Update, _: CallbackContext) -> int:
+	"""Start a new blitz game, where every player answers every question, and the first correct answer scores"""
+	return open_game(update, blitz=True)
+
+
+def open_game(update: Update, blitz: bool) -> int:
+	"""Open a new game
 
 	Determine the chat type, and direct the bot to the appropriate course of action
 	"""
 	# Sanity checks:
 	if get_game(update.message.chat_id):
-		update.message.reply_text(
+		reply_text(
+			update,
 			"There is already an active game in this chat.\n"
-			"Use the /cancel command, if you would like to terminate the current game."
+			"Use the /cancel command, if you would like to terminate the current game.",
+			pause=1,
 		)
-		sleep(1)
-		return ConversationHandler.END
+		return END
 	chat_type = update.message.chat.type
 	if chat_type == "channel":
-		update.message.reply_text(
-			"ERROR: This feature is not intended for use in channels."
+		reply_text(
+			update,
+			"ERROR: This feature is not intended for use in channels.",
+			pause=1,
 		)
-		sleep(1)
-		return ConversationHandler.END
+		return END
 
 	# Start new game sequence:
-	active_games.append(Game(update.message.chat_id))
+	active_games.add(Game(update.message.chat_id, blitz))
+	GAMES_STARTED.increment()
 	if chat_type == "private":
 		add_player(
 			update.message.chat_id,
@@ -202,19 +421,21 @@ def start_new_game(update: Update, _: CallbackContext) -> int:
 		)
 		return send_duration_menu(update)
 	# if group/supergroup chat, offer multiplayer options:
-	update.message.reply_text(
+	reply_text(
+		update,
 		JOIN_MENU_STOCK_TEXT,
 		reply_markup=keyboard_model.JOIN_INVITE_MENU,
 	)
 	return States.SEND_INVITE
 
 
+@game_handler(States.GET_GAME_LENGTH)
 def get_length(update: Update, _: CallbackContext) -> int:
 	"""Determine the duration of the game"""
 	query = update.callback_query
 	chat_id = update.effective_chat.id
 
-	query.answer()  # clear the progress bar, if there was a query
+	answer_query(update)  # clear the progress bar, if there was a query
 	rounds_per_player = query.data
 	game = get_game(chat_id)
 	try:
@@ -224,20 +445,36 @@ def get_length(update: Update, _: CallbackContext) -> int:
 		return States.GET_GAME_LENGTH
 	game.initialise_order()
 	game.initialise_scores()
+	banks = word_banks.current  # the game keeps this build, even if the word banks are reloaded
+	game.bank_version = banks.version
+	game.questions = question_deck.build_deck(
+		game.total_rounds,
+		banks.composer_keys,
+		banks.pasta_keys,
+		settings["questions"]["composer_ratio"],
+		question_weights,
+	)
 
 	new_message = f"*Game Duration:* {rounds_per_player}\n*Players:*\n```\n"
 	for player in game.players.values():
-		new_message += f"{player}\n"
+		new_message += f"{message_renderer.escape_markdown_v2_pre(player)}\n"
 	new_message += "```"
 
-	query.edit_message_text(
+	edit_message_text(
+		update,
 		new_message,
+		pause=2,
 		parse_mode="MarkdownV2",
 	)
-	sleep(2)
 	return send_question(update)
 
 
+def render_question(game: Game) -> str:
+	"""The current question of a game, addressed to the player whose turn it is (or everyone, in blitz)"""
+	player_name = BLITZ_PLAYER_NAME if game.blitz else game.get_current_player_name()
+	return word_banks.get(game.bank_version).renderer.render_question(player_name, game.correct_answer[1])
+
+
 def send_question(update: Update) -> int:
 	"""Generate a question, and send it to the chat"""
 	game = get_game(update.effective_chat.id)
@@ -246,67 +483,115 @@ def send_question(update: Update) -> int:
 	if game.is_ended():
 		return end_game(update)
 
-	set_question(game)
-	update.effective_chat.send_message(
-		f"*{game.get_current_player_name()}*, is '_{game.correct_answer[1]}_' the name of a composer or a type of pasta?",
+	send_message(
+		update,
+		render_question(game),
+		pause=1,
 		parse_mode="MarkdownV2",
-		reply_markup=keyboard_model.GAME_ANSWER_MENU,
+		reply_markup=keyboard_model.get_answer_menu(game.game_id, game.current_round),
 	)
-	sleep(1)
 	return States.CHECK_ANSWER
 
 
+@game_handler(States.CHECK_ANSWER)
 def check_answer(update: Update, _: CallbackContext) -> int:
 	"""Check if the answer is correct, and handle the scoring"""
 	query = update.callback_query
 	user = query.from_user
 	game = get_game(update.effective_chat.id)
 
-	query.answer()  # clear the progress bar, if there was a query
+	answer, game_id, round_number = keyboard_model.parse_answer_data(query.data)
+	if game_id != game.game_id or round_number != str(game.current_round):  # a late press, on an earlier question
+		answer_query(update)
+		return States.CHECK_ANSWER
+	if game.blitz:
+		return check_blitz_answer(update, game, answer)
+	answer_query(update)  # clear the progress bar, if there was a query
 	if not user.id == game.get_current_player():
-		kookiie_logger.debug(f"Wrong player clicked on an answer. Expected {game.get_current_player_name()}, Received {user.full_name} for Round {game.current_round}")
-		sleep(1)
+		kookiie_logger.debug(
+			"Wrong player clicked on an answer. Expected %s, Received %s for Round %s",
+			game.get_current_player_name(), user.full_name, game.current_round,
+		)
 		return States.CHECK_ANSWER  # not the intended player for the round
+	game.record_answer(user.id, answer)
 
 	# Process composer/pasta details:
-	if game.correct_answer[0] == keyboard_model.KeyboardText.COMPOSER:
-		addon = format_composer_answer(game)
-	else:
-		addon = f"<b>{game.correct_answer[1].capitalize()}:</b>\n{PASTAS.get(game.correct_answer[1])}"
+	addon = word_banks.get(game.bank_version).renderer.render_answer(*game.correct_answer)
 	# Process whether the provided answer is correct:
-	# kookiie_logger.debug(f"Expected: {game.correct_answer[0]}, received: {query.data}")
-	if query.data == game.correct_answer[0].value:
+	# kookiie_logger.debug("Expected: %s, received: %s", game.correct_answer[0], answer)
+	if answer == game.correct_answer[0].value:
 		game.increment_current_player_score()
 		base = "<i>That is the correct answer!</i>\n"
 	else:
 		base = "<i>Aww... I'm afraid that's not correct.</i>\n"
 	# Feedback:
-	query.edit_message_text(
+	edit_message_text(
+		update,
 		base + addon,
+		pause=3,
+		parse_mode="HTML",
+	)
+
+	game.increment_round_number()
+	return send_question(update)
+
+
+def check_blitz_answer(update: Update, game: Game, answer: str) -> int:
+	"""Score the first correct answer to a blitz question; each player gets one answer per question
+
+	Answers are handled in the order they arrive, one at a time (within the chat's session),
+	so the first correct one wins.
+	"""
+	query = update.callback_query
+	user = query.from_user
+	if user.id not in game.players:
+		answer_query(update, "You're not playing in this game.")
+		return States.CHECK_ANSWER
+	if not game.record_answer(user.id, answer):
+		answer_query(update, "You've already answered this one.")
+		return States.CHECK_ANSWER
+
+	if answer == game.correct_answer[0].value:
+		answer_query(update, "That is the correct answer!")
+		game.increment_player_score(user.id)
+		base = f"<i>{message_renderer.escape_html(user.full_name)} got it first!</i>\n"
+	else:
+		answer_query(update, "Aww... I'm afraid that's not correct.")
+		if not game.is_round_answered():
+			return States.CHECK_ANSWER  # the others can still get it
+		base = "<i>Nobody got that one.</i>\n"
+	# Feedback, once for the whole round:
+	edit_message_text(
+		update,
+		base + word_banks.get(game.bank_version).renderer.render_answer(*game.correct_answer),
+		pause=3,
 		parse_mode="HTML",
 	)
 
 	game.increment_round_number()
-	sleep(3)
 	return send_question(update)
 
 
+@HANDLER_SECONDS.time
 def end_game(update: Update) -> int:
 	"""Tabulate the results, and save it"""
 	game = get_game(update.effective_chat.id)
+	# update scores to IO, as one batch; per-chat and per-word statistics are rolled up later
+	new_high_scores = data.update_players({
+		player_id: (player_name, game.scores.get(player_id)) for player_id, player_name in game.players.items()
+	})
+	saver.mark_dirty(len(game.players))
+	stats.record(game)
+
 	message = f"<b>GAME OVER</b>\nScores:\n"
 	for player_id, player_name in game.players.items():
-		optional = "    <i><u>New High Score!</u></i>" if game.scores.get(player_id) > data.get_player_high_score(player_id) else ""
-		message += f"<i>{player_name}</i>: {game.scores.get(player_id)}{optional}\n"
+		optional = "    <i><u>New High Score!</u></i>" if player_id in new_high_scores else ""
+		message += f"<i>{message_renderer.escape_html(player_name)}</i>: {game.scores.get(player_id)}{optional}\n"
 	message += "\nThank you for playing!"
-	update.effective_chat.send_message(message, parse_mode="HTML")
-
-	# update scores to IO
-	for player_id, player_name in game.players.items():
-		data.update_player(player_id, player_name, game.scores.get(player_id))
-	data_handler.save_player_data(data)
-	sleep(2)
-	return ConversationHandler.END
+	send_message(update, message, pause=2, parse_mode="HTML")
+	remove_current_game(game.chat_id)
+	GAMES_FINISHED.increment()
+	return END
 
 
 def is_player(user_id: int, chat_id: int) -> bool:
@@ -320,6 +605,7 @@ def is_player(user_id: int, chat_id: int) -> bool:
 	return False
 
 
+@game_handler()
 def cancel(update: Update, _: CallbackContext) -> int | None:
 	"""Cancels and ends the game/conversation."""
 	chat_id = update.message.chat_id
@@ -327,79 +613,204 @@ def cancel(update: Update, _: CallbackContext) -> int | None:
 
 	# Nothing to cancel:
 	if not get_game(chat_id):
-		update.message.reply_text(
+		reply_text(
+			update,
 			"There is no active game in this chat.\n"
-			"Please use the /newgame command to start a new game."
+			"Please use the /newgame command to start a new game.",
+			pause=1,
 		)
-		sleep(1)
-		return ConversationHandler.END
+		return END
 
 	# Cancel the current active game in the chat:
 	if is_player(user.id, chat_id):
 		remove_current_game(chat_id)
-		kookiie_logger.debug(f"Games: {', '.join([str(game.chat_id) for game in active_games])}")
+		GAMES_CANCELLED.increment()
+		if kookiie_logger.isEnabledFor(logging.DEBUG):  # listing the games is not free
+			kookiie_logger.debug("Games: %s", ", ".join(map(str, active_games.chat_ids())))
 		kookiie_logger.info("User %s canceled the game/conversation.", user.full_name)
-		update.message.reply_text("The active game has been terminated.")
-		sleep(2)
-		return ConversationHandler.END
+		reply_text(update, "The active game has been terminated.", pause=2)
+		return END
 
-	update.message.reply_text(
+	reply_text(
+		update,
 		f"I'm sorry, {user.first_name}, "
-		"but only people who are playing the game can cancel it."
+		"but only people who are playing the game can cancel it.",
+		pause=2,
 	)  # catch-all
-	sleep(2)
 	return
 
 
-def unknown(update: Update, context: CallbackContext) -> None:
+def format_latencies(histogram: metrics.Histogram) -> str:
+	return "".join(
+		f"  {name}: {count} calls, mean {mean * 1000:.2f}ms, p95 under {p95 * 1000:.0f}ms\n"
+		for name, (count, mean, p95) in sorted(histogram.summary().items())
+	)
+
+
+def get_stats(update: Update, context: CallbackContext) -> None:
+	"""Send a summary of the metrics; for admins only"""
+	if update.message.from_user.id not in settings["admins"]:
+		unknown(update, context)
+		return
+	registry_stats = active_games.stats()
+	message = (
+		f"Active games: {registry_stats['Active games']}\n"
+		f"Games created/ended in the last minute: "
+		f"{registry_stats['Games created per minute']}/{registry_stats['Games ended per minute']}\n"
+		f"Games started: {GAMES_STARTED.value}, finished: {GAMES_FINISHED.value}, "
+		f"cancelled: {GAMES_CANCELLED.value}, evicted: {GAMES_EVICTED.value}\n"
+		f"Player cache: {len(data.cache)} players, {data.cache.hit_rate():.1%} hit rate\n"
+		f"Messages sent: {outbox.sent}, retried: {outbox.retried}, failed: {outbox.failed}, queued: {outbox.pending()}\n"
+		f"Handler latency:\n{format_latencies(HANDLER_SECONDS)}"
+		f"Telegram API latency:\n{format_latencies(outbound.API_SECONDS)}"
+	)
+	reply_text(update, message)
+
+
+def unknown(update: Update, _: CallbackContext) -> None:
 	"""Handle unknown commands"""
-	context.bot.send_message(
-		chat_id=update.effective_chat.id,
-		text=(
-			"Hmm... I don't seem to recognise this command!\n"
-			"Perhaps I'm under the influence of the Confundus Charm..."
-		)
+	send_message(
+		update,
+		"Hmm... I don't seem to recognise this command!\n"
+		"Perhaps I'm under the influence of the Confundus Charm...",
+		pause=2,
+	)
+
+
+def start_webhook(updater: Updater) -> None:
+	"""Receive updates through the webhook receiver, instead of polling"""
+	webhook = settings["webhook"]
+	updater.running = True  # so that Updater.idle() stops everything on exit
+	updater.job_queue.start()
+	threading.Thread(target=updater.dispatcher.start, name="dispatcher").start()
+	updater.httpd = webhook_server.WebhookServer(  # stopped by Updater.stop()
+		updater.bot,
+		updater.update_queue,
+		webhook["listen"],
+		webhook["port"],
+		webhook["url_path"],
+		webhook["secret_token"],
+		settings["max_pending_updates"],
+		router.pending,  # updates already taken off the queue, into the chats' mailboxes
 	)
-	sleep(2)
+	updater.httpd.start()
+	if webhook["url"]:
+		api_kwargs = {"secret_token": webhook["secret_token"]} if webhook["secret_token"] else None
+		updater.bot.set_webhook(webhook["url"], api_kwargs=api_kwargs)
+
+
+def wait_for_stop_signal() -> None:
+	"""Block until Ctrl-C, SIGTERM or SIGABRT, as Updater.idle() does, but without stopping the updater"""
+	stopping = threading.Event()
+	for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+		signal.signal(signum, lambda *_: stopping.set())
+	while not stopping.wait(1):  # in short waits, so that the signal handlers get to run
+		pass
+
+
+def stop_updater(updater: Updater) -> None:
+	"""Stop taking updates, and handle those already received, before the job queue is stopped
+
+	Updater.stop() stops the job queue first, so the messages paced by the updates
+	still in the router would be scheduled on a stopped job queue, and never sent.
+	"""
+	updater.running = False  # polling leaves any further updates with Telegram
+	if updater.httpd:  # the webhook receiver
+		updater.httpd.shutdown()
+		updater.httpd = None
+	updater.update_queue.join()  # every update received is with the router
+	router.stop()
+	updater.stop()
+
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+	"""Register the command and button handlers of the bot, each timed"""
+	from telegram.ext import CallbackQueryHandler, CommandHandler, Filters, MessageHandler
+
+	timed = HANDLER_SECONDS.time
+	dispatcher.add_handler(CommandHandler("start", timed(start)))
+	dispatcher.add_handler(CommandHandler("myhiscore", timed(get_player_high_score)))
+	dispatcher.add_handler(CommandHandler("hiscore", timed(get_high_score)))
+	dispatcher.add_handler(CommandHandler("chathiscore", timed(get_chat_high_score)))
+	dispatcher.add_handler(CommandHandler("rank", timed(get_player_rank)))
+	dispatcher.add_handler(CommandHandler("stats", timed(get_stats)))
+	# Game handlers; each only acts while the chat's game is in the matching state
+	dispatcher.add_handler(CommandHandler("newgame", timed(start_new_game)))
+	dispatcher.add_handler(CommandHandler("blitz", timed(start_new_blitz_game)))
+	dispatcher.add_handler(CommandHandler("cancel", timed(cancel)))
+	dispatcher.add_handler(CallbackQueryHandler(timed(handle_join_button), pattern=f"^{keyboard_model.KeyboardText.JOIN.value}$"))
+	dispatcher.add_handler(CallbackQueryHandler(timed(handle_start_button), pattern=f"^{keyboard_model.KeyboardText.START.value}$"))
+	dispatcher.add_handler(CallbackQueryHandler(timed(get_length), pattern=f"^({'|'.join(GameLength.__members__)})$"))
+	dispatcher.add_handler(CallbackQueryHandler(
+		timed(check_answer),
+		pattern=(
+			f"^({keyboard_model.KeyboardText.COMPOSER.value}|{keyboard_model.KeyboardText.PASTA.value})"
+			f"{keyboard_model.ANSWER_SEPARATOR}[0-9a-f]+{keyboard_model.ANSWER_SEPARATOR}[0-9]+$"
+		),
+	))
+	dispatcher.add_handler(MessageHandler(Filters.command, timed(unknown)))
 
 
 def main() -> None:
 	"""Main sequence of the bot"""
+	global router
+	create_app()
+	import chat_router  # these import telegram.ext, which is only needed to run the bot
+	from telegram.ext import Updater
+
 	# Start the updater/dispatcher to listen for messages
 	# Create the Updater and pass it your bot token.
 	updater = Updater(fetch_token(), use_context=True)
 	# Get the dispatcher to register handlers
 	dispatcher = updater.dispatcher
-
-	dispatcher.add_handler(CommandHandler("start", start))
-	dispatcher.add_handler(CommandHandler("myhiscore", get_player_high_score))
-	dispatcher.add_handler(CommandHandler("hiscore", get_high_score))
-	conversation_handler = ConversationHandler(
-		entry_points=[CommandHandler("newgame", start_new_game)],
-		states={
-			States.SEND_INVITE: [
-				CallbackQueryHandler(handle_join_button, pattern=f"^{keyboard_model.KeyboardText.JOIN.value}$"),
-				CallbackQueryHandler(handle_start_button, pattern=f"^{keyboard_model.KeyboardText.START.value}$"),
-			],
-			States.GET_GAME_LENGTH: [CallbackQueryHandler(get_length)],
-			States.CHECK_ANSWER: [CallbackQueryHandler(check_answer)],
-		},
-		fallbacks=[CommandHandler('cancel', cancel)],
-		per_user=False,
-	)
-	dispatcher.add_handler(conversation_handler)  # For update-handling
-	dispatcher.add_handler(MessageHandler(Filters.command, unknown))
+	saver.start()
+	# Pause between messages through the job queue, instead of blocking workers
+	pacer.attach(updater.job_queue)
+	updater.job_queue.run_repeating(pacer.prune, interval=600)
+	# Send messages within Telegram's rate limits
+	outbox.attach(updater.bot)
+	outbox.start()
+	updater.job_queue.run_repeating(outbox.prune, interval=600)
+	updater.job_queue.run_repeating(evict_idle_games, interval=60)
+	updater.job_queue.run_repeating(stats.flush, interval=settings["stats_interval"])
+	if settings["questions"]["weight_by_difficulty"]:
+		updater.job_queue.run_repeating(refresh_question_weights, interval=settings["stats_interval"], first=0)
+	if settings["word_banks"]["reload_interval"]:
+		updater.job_queue.run_repeating(word_banks.check, interval=settings["word_banks"]["reload_interval"])
+	if snapshotter:
+		restore_games()
+		updater.job_queue.run_repeating(snapshotter.save, interval=settings["snapshot_interval"])
+
+	register_handlers(dispatcher)
+	# Handle each chat's updates in order, on a pool of workers, instead of all of them on the dispatcher's thread
+	router = chat_router.ChatRouter(settings["update_workers"], settings["max_pending_updates"])
+	router.attach(dispatcher)
+	# Once the router is full, the dispatcher waits for it; bound the queue behind it too, so that polling pauses
+	updater.update_queue.maxsize = settings["max_pending_updates"]
+	if settings["metrics"]["port"]:
+		metrics.start_server(metrics.REGISTRY, settings["metrics"]["listen"], settings["metrics"]["port"])
 
 	# Start the Bot
-	updater.start_polling()
+	if settings["mode"] == "webhook":
+		start_webhook(updater)
+	else:
+		updater.start_polling()
 
 	# Run the bot until you press Ctrl-C or the process receives SIGINT,
-	# SIGTERM or SIGABRT. This should be used most of the time, since
-	# start_polling() is non-blocking and will stop the bot gracefully.
-	updater.idle()
+	# SIGTERM or SIGABRT, then stop it gracefully, finishing the updates already received
+	wait_for_stop_signal()
+	stop_updater(updater)
+	pacer.flush()  # the job queue has stopped; hand the paced messages still waiting to the outbox
+	if snapshotter:
+		snapshotter.save()  # so that the games carry on after the restart
+	outbox.stop()  # send what is still queued
+	saver.stop()  # final flush, so no scores are lost
+	stats.flush()
 
 
 if __name__ == "__main__":
-	# duplicate_checker.check(COMPOSER_KEYS, PASTA_KEYS)
+	create_app()
+	if settings["check_word_banks"]:
+		duplicate_checker.check(word_banks.current.composer_keys, word_banks.current.pasta_keys)
 	main()
 	logger.shutdown_logger()
@@ -0,0 +1,77 @@
+"""Memory benchmark of concurrent games, with a memory budget
+
+Sets up many LONG games at once, as the bot holds them in its game registry:
+each with its players joined, its questions drawn from the word banks, and half
+of its rounds played. The memory they take is measured with tracemalloc, so
+that a change to the Game model (e.g. a field that grows with the rounds) shows
+up as more memory per game.
+
+Exits with 1 if the games take more than the budget, so that it can be run in CI.
+
+Usage:
+	python memory_benchmark.py [--games N] [--players M] [--length SHORT|MEDIUM|LONG] [--budget MB]
+"""
+import argparse
+import random
+import sys
+import tracemalloc
+
+import data_handler
+import question_deck
+import word_bank_manager
+from game import Game, GameLength
+from game_registry import GameRegistry
+
+
+BUDGET = 100  # megabytes, for the default 10k games of 10 players
+
+
+def set_up_game(chat_id: int, players: int, length: str, composer_keys, pasta_keys, rng: random.Random) -> Game:
+	"""A game half-way through, set up as the handlers do (see main.get_length)"""
+	game = Game(chat_id)
+	for user_id in range(players):
+		game.players[chat_id * players + user_id] = f"Player {user_id}"
+	game.set_total_rounds(length)
+	game.initialise_order()
+	game.initialise_scores()
+	game.bank_version = "0123456789abcdef"
+	game.questions = question_deck.build_deck(game.total_rounds, composer_keys, pasta_keys, rng=rng)
+	for _ in range(game.total_rounds // 2):
+		answer = rng.choice((game.correct_answer[0].value, "WRONG"))
+		game.record_answer(game.get_current_player(), answer)
+		if answer == game.correct_answer[0].value:
+			game.increment_current_player_score()
+		game.increment_round_number()
+	return game
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--games", type=int, default=10000, help="games held at once")
+	parser.add_argument("--players", type=int, default=10, help="players in each game")
+	parser.add_argument("--length", choices=GameLength.__members__, default="LONG")
+	parser.add_argument("--budget", type=float, default=BUDGET, help="megabytes for all the games")
+	args = parser.parse_args()
+
+	# Loaded before measuring, as the word banks are shared by every game
+	composer_keys = word_bank_manager.get_keys(data_handler.load_composer())
+	pasta_keys = word_bank_manager.get_keys(data_handler.load_pasta())
+	rng = random.Random(0)
+
+	tracemalloc.start()
+	registry = GameRegistry()
+	for chat_id in range(args.games):
+		registry.add(set_up_game(chat_id, args.players, args.length, composer_keys, pasta_keys, rng))
+	used, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	used_mb = used / 1_000_000
+	print(f"{len(registry)} {args.length} games of {args.players} players: {used_mb:.1f}MB (budget {args.budget:.0f}MB)")
+	print(f"Per game: {used / len(registry) / 1000:.1f}kB, peak while setting up: {peak / 1_000_000:.1f}MB")
+	if used_mb > args.budget:
+		print(f"FAILED: the games took {used_mb:.1f}MB, over the {args.budget:.0f}MB budget")
+	sys.exit(1 if used_mb > args.budget else 0)
+
+
+if __name__ == "__main__":
+	main()
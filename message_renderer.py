@@ -0,0 +1,66 @@
+"""This module renders the game messages, and owns their HTML/MarkdownV2 escaping
+
+As the word banks are static, the fragments of a message that depend only on the
+word are rendered once per word, and kept in a bounded cache.
+"""
+import html
+from functools import lru_cache
+from typing import Mapping
+
+from telegram.utils.helpers import escape_markdown
+
+import logger
+from keyboard_model import KeyboardText
+
+
+kookiie_logger = logger.get_logger(__name__)
+RENDER_CACHE_SIZE = 1024
+
+
+def escape_html(text: str) -> str:
+	return html.escape(str(text), quote=False)
+
+
+def escape_markdown_v2(text: str) -> str:
+	return escape_markdown(str(text), version=2)
+
+
+def escape_markdown_v2_pre(text: str) -> str:
+	"""Escape text for use within a MarkdownV2 code block"""
+	return escape_markdown(str(text), version=2, entity_type="pre")
+
+
+class MessageRenderer:
+	"""Renders the question and answer messages of a set of word banks"""
+
+	def __init__(self, composers: Mapping[str, list[str]], pastas: Mapping[str, str]) -> None:
+		self.composers: Mapping[str, list[str]] = composers
+		self.pastas: Mapping[str, str] = pastas
+		self._cached_answer = lru_cache(maxsize=RENDER_CACHE_SIZE)(self._render_answer)
+		self._cached_question_suffix = lru_cache(maxsize=RENDER_CACHE_SIZE)(self._render_question_suffix)
+
+	def render_question(self, player_name: str, word: str) -> str:
+		"""MarkdownV2 prompt for a question"""
+		return f"*{escape_markdown_v2(player_name)}*, {self._cached_question_suffix(word)}"
+
+	def render_answer(self, category: KeyboardText, word: str) -> str:
+		"""HTML explanation of an answer"""
+		return self._cached_answer(category, word)
+
+	@staticmethod
+	def _render_question_suffix(word: str) -> str:
+		return f"is '_{escape_markdown_v2(word)}_' the name of a composer or a type of pasta?"
+
+	def _render_answer(self, category: KeyboardText, word: str) -> str:
+		if word not in (self.pastas if category == KeyboardText.PASTA else self.composers):
+			# removed from the word banks during the game (see word_bank_manager)
+			return f"{escape_html(word.capitalize())} is {'a type of pasta' if category == KeyboardText.PASTA else 'a composer'}."
+		if category == KeyboardText.PASTA:
+			return f"<b>{escape_html(word.capitalize())}:</b>\n{escape_html(self.pastas.get(word))}"
+
+		composers = [escape_html(composer) for composer in self.composers.get(word)]
+		kookiie_logger.debug("Composers: %s", composers)
+		if len(composers) == 1:
+			return f"{composers[0]} is a composer."
+		composers[-1] = f"and {composers[-1]}"
+		return f"{escape_html(word.capitalize())} is the last name for the following composers: {', '.join(composers)}."
@@ -0,0 +1,164 @@
+"""In-process metrics, exported in the Prometheus text format
+
+Counters and histograms are updated in place, under a lock each, so that
+recording costs a couple of microseconds, and can stay on in production.
+Gauges are read from callbacks when the metrics are exported.
+"""
+import threading
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable
+
+import logger
+
+
+kookiie_logger = logger.get_logger(__name__)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # seconds
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+	def __init__(self, name: str, description: str) -> None:
+		self.name: str = name
+		self.description: str = description
+		self.value: int = 0
+		self._lock = threading.Lock()
+
+	def increment(self, amount: int = 1) -> None:
+		with self._lock:
+			self.value += amount
+
+	def render(self) -> list[str]:
+		return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Gauge:
+	"""A value read from a callback, e.g. the number of active games"""
+
+	def __init__(self, name: str, description: str, read: Callable[[], float]) -> None:
+		self.name: str = name
+		self.description: str = description
+		self.read: Callable[[], float] = read
+
+	def render(self) -> list[str]:
+		return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class Histogram:
+	"""Observations in buckets, kept separately for each value of a label (e.g. each handler)"""
+
+	def __init__(self, name: str, description: str, label: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+		self.name: str = name
+		self.description: str = description
+		self.label: str = label
+		self.buckets: tuple[float, ...] = buckets
+		self._series: dict[str, list] = {}  # label value: [bucket counts (the last one for +Inf), sum, count]
+		self._lock = threading.Lock()
+
+	def observe(self, label_value: str, value: float) -> None:
+		index = bisect_left(self.buckets, value)
+		with self._lock:
+			series = self._series.get(label_value)
+			if series is None:
+				series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+			series[0][index] += 1
+			series[1] += value
+			series[2] += 1
+
+	def time(self, function: Callable) -> Callable:
+		"""Decorator observing the duration of each call, labelled with the name of the function"""
+		name = function.__name__
+
+		@wraps(function)
+		def wrapper(*args, **kwargs):
+			start = perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				self.observe(name, perf_counter() - start)
+		return wrapper
+
+	def summary(self) -> dict[str, tuple[int, float, float]]:
+		"""Get the count, the mean, and (the upper bound of the bucket of) the 95th percentile, per label value"""
+		with self._lock:
+			series = {label_value: ([*counts], total, count) for label_value, (counts, total, count) in self._series.items()}
+		summaries = {}
+		for label_value, (counts, total, count) in series.items():
+			seen = 0
+			for index, bucket_count in enumerate(counts):
+				seen += bucket_count
+				if seen >= 0.95 * count:
+					break
+			p95 = self.buckets[index] if index < len(self.buckets) else float("inf")
+			summaries[label_value] = (count, total / count, p95)
+		return summaries
+
+	def render(self) -> list[str]:
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+		with self._lock:
+			series = {label_value: ([*counts], total, count) for label_value, (counts, total, count) in self._series.items()}
+		for label_value, (counts, total, count) in sorted(series.items()):
+			label = f'{self.label}="{label_value}"'
+			cumulative = 0
+			for bound, bucket_count in zip((*map(str, self.buckets), "+Inf"), counts):
+				cumulative += bucket_count
+				lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+			lines.append(f"{self.name}_sum{{{label}}} {total}")
+			lines.append(f"{self.name}_count{{{label}}} {count}")
+		return lines
+
+
+class MetricsRegistry:
+	def __init__(self) -> None:
+		self.metrics: list[Counter | Gauge | Histogram] = []
+
+	def counter(self, name: str, description: str) -> Counter:
+		return self._register(Counter(name, description))
+
+	def gauge(self, name: str, description: str, read: Callable[[], float]) -> Gauge:
+		return self._register(Gauge(name, description, read))
+
+	def histogram(self, name: str, description: str, label: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+		return self._register(Histogram(name, description, label, buckets))
+
+	def render(self) -> str:
+		lines = []
+		for metric in self.metrics:
+			try:
+				lines += metric.render()
+			except Exception as e:
+				kookiie_logger.error("Error! The following exception was encountered while reading metric %s: %s", metric.name, e)
+		return "\n".join(lines) + "\n"
+
+	def _register(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+
+REGISTRY = MetricsRegistry()
+
+
+def start_server(registry: MetricsRegistry, listen: str, port: int) -> ThreadingHTTPServer:
+	"""Serve the metrics at /metrics, on a background thread"""
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self) -> None:
+			if self.path != "/metrics":
+				self.send_error(404)
+				return
+			body = registry.render().encode()
+			self.send_response(200)
+			self.send_header("Content-Type", CONTENT_TYPE)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *_) -> None:  # scrapes are not worth a log line each
+			pass
+
+	server = ThreadingHTTPServer((listen, port), MetricsHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+	kookiie_logger.info("Metrics served on %s:%s/metrics", listen, server.server_address[1])
+	return server
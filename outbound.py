@@ -0,0 +1,234 @@
+"""Outbound queue for Bot API requests, within Telegram's rate limits
+
+Telegram allows about one message per second in a chat, and about thirty per
+second overall. Requests are queued per chat and sent by a small pool of sender
+threads, each taking a token from the chat's bucket and from the global bucket.
+Requests in a chat are sent in order, and a 429 (RetryAfter) puts the request
+back at the front of its chat, to be retried once Telegram allows it. Network
+errors are retried a few times; requests that Telegram rejects (a bad request, a
+blocked bot, a migrated chat) fail at once, so that the chat's queue moves on.
+
+Adjacent plain messages waiting in the same chat are merged into a single message.
+"""
+import heapq
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from time import monotonic, perf_counter
+from typing import Any
+
+from telegram import Bot
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, Unauthorized
+
+import logger
+import metrics
+
+
+kookiie_logger = logger.get_logger(__name__)
+PER_CHAT_RATE = 1.0  # messages per second
+PER_CHAT_BURST = 3
+GLOBAL_RATE = 30.0  # messages per second
+GLOBAL_BURST = 30
+SENDER_THREADS = 4
+MAX_ATTEMPTS = 3  # for network errors; flood control is always retried, and rejected requests never are
+MAX_MESSAGE_LENGTH = 4096
+API_SECONDS = metrics.REGISTRY.histogram("telegram_api_seconds", "Duration of Bot API requests.", "method")
+
+
+class TokenBucket:
+	"""Allows `rate` events per second, in bursts of up to `capacity`"""
+
+	def __init__(self, rate: float, capacity: float) -> None:
+		self.rate: float = rate
+		self.capacity: float = capacity
+		self.tokens: float = capacity
+		self.updated: float = monotonic()
+
+	def refill(self, now: float) -> None:
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def wait_time(self, now: float) -> float:
+		"""Seconds until a token is available"""
+		self.refill(now)
+		return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+	def consume(self) -> None:
+		self.tokens -= 1
+
+	def is_full(self, now: float) -> bool:
+		self.refill(now)
+		return self.tokens >= self.capacity
+
+
+@dataclass
+class OutboundMessage:
+	"""A Bot API request: the name of the Bot method, and its keyword arguments"""
+
+	chat_id: int
+	method: str
+	kwargs: dict[str, Any]
+	attempts: int = field(default=0)
+
+	def can_merge(self, other: "OutboundMessage") -> bool:
+		"""Whether the other message can be appended to this one"""
+		return (
+			self.method == other.method == "send_message"
+			and "reply_markup" not in self.kwargs
+			and "reply_to_message_id" not in other.kwargs
+			and self.kwargs.get("parse_mode") == other.kwargs.get("parse_mode")
+			and len(self.kwargs["text"]) + len(other.kwargs["text"]) + 2 <= MAX_MESSAGE_LENGTH
+		)
+
+	def merge(self, other: "OutboundMessage") -> None:
+		self.kwargs = {**other.kwargs, **self.kwargs, "text": f"{self.kwargs['text']}\n\n{other.kwargs['text']}"}
+		if "reply_markup" in other.kwargs:
+			self.kwargs["reply_markup"] = other.kwargs["reply_markup"]
+
+
+class OutboundQueue:
+	"""Sends queued Bot API requests, in order per chat, within the rate limits"""
+
+	def __init__(
+			self,
+			bot: Bot | None = None,
+			per_chat_rate: float = PER_CHAT_RATE,
+			per_chat_burst: float = PER_CHAT_BURST,
+			global_rate: float = GLOBAL_RATE,
+			global_burst: float = GLOBAL_BURST,
+			senders: int = SENDER_THREADS,
+	) -> None:
+		self.bot: Bot | None = bot
+		self.per_chat_rate: float = per_chat_rate
+		self.per_chat_burst: float = per_chat_burst
+		self.senders: int = senders
+		self._global = TokenBucket(global_rate, global_burst)
+		self._buckets: dict[int, TokenBucket] = {}
+		self._queues: dict[int, deque[OutboundMessage]] = {}  # pending requests per chat
+		self._ready: list[tuple[float, int, int]] = []  # heap of (ready at, sequence, chat ID)
+		self._in_flight: set[int] = set()  # chats with a request being sent
+		self._sequence: int = 0
+		self._stopping: bool = False
+		self._condition = threading.Condition()
+		self._threads: list[threading.Thread] = []
+		# Counters:
+		self.sent: int = 0
+		self.merged: int = 0
+		self.retried: int = 0
+		self.failed: int = 0
+
+	def attach(self, bot: Bot) -> None:
+		self.bot = bot
+
+	def start(self) -> None:
+		for i in range(self.senders):
+			thread = threading.Thread(target=self._run, name=f"outbound_{i}", daemon=True)
+			thread.start()
+			self._threads.append(thread)
+
+	def stop(self, timeout: float | None = 10) -> None:
+		"""Stop the senders, once the pending requests are sent (or the timeout runs out)"""
+		with self._condition:
+			self._stopping = True
+			self._condition.notify_all()
+		for thread in self._threads:
+			thread.join(timeout)
+
+	def submit(self, method: str, chat_id: int, **kwargs) -> None:
+		"""Queue a call to a Bot method in a chat, e.g. submit("send_message", chat_id, text=...)"""
+		with self._condition:
+			queue = self._queues.setdefault(chat_id, deque())
+			queue.append(OutboundMessage(chat_id, method, {"chat_id": chat_id, **kwargs}))
+			if len(queue) == 1 and chat_id not in self._in_flight:
+				self._push(chat_id, monotonic())
+
+	def pending(self) -> int:
+		with self._condition:
+			return sum(map(len, self._queues.values()))
+
+	def prune(self, _: Any = None) -> None:
+		"""Drop the buckets of idle chats; can be used as a repeating job"""
+		with self._condition:
+			now = monotonic()
+			for chat_id in [k for k, v in self._buckets.items() if k not in self._queues and v.is_full(now)]:
+				del self._buckets[chat_id]
+
+	def _push(self, chat_id: int, ready_at: float) -> None:
+		self._sequence += 1
+		heapq.heappush(self._ready, (ready_at, self._sequence, chat_id))
+		self._condition.notify()
+
+	def _next(self) -> OutboundMessage | None:
+		"""Wait for the next request that may be sent; None once stopped with nothing left to send"""
+		with self._condition:
+			while True:
+				if not self._ready:
+					if self._stopping and not self._in_flight:
+						return None
+					self._condition.wait(1)
+					continue
+				now = monotonic()
+				ready_at, _, chat_id = self._ready[0]
+				wait = max(ready_at - now, self._global.wait_time(now))
+				if wait > 0:
+					self._condition.wait(wait)
+					continue
+				heapq.heappop(self._ready)
+				bucket = self._buckets.setdefault(chat_id, TokenBucket(self.per_chat_rate, self.per_chat_burst))
+				wait = bucket.wait_time(now)
+				if wait > 0:
+					self._push(chat_id, now + wait)
+					continue
+				bucket.consume()
+				self._global.consume()
+				queue = self._queues[chat_id]
+				message = queue.popleft()
+				while queue and message.can_merge(queue[0]):
+					message.merge(queue.popleft())
+					self.merged += 1  # under the lock
+				self._in_flight.add(chat_id)
+				return message
+
+	def _done(self, message: OutboundMessage, outcome: str, retry_at: float | None = None) -> None:
+		"""Release the chat of a sent request, putting the request back first if it is to be retried"""
+		with self._condition:
+			setattr(self, outcome, getattr(self, outcome) + 1)
+			self._in_flight.discard(message.chat_id)
+			queue = self._queues[message.chat_id]
+			if retry_at is not None:
+				queue.appendleft(message)
+			if queue:
+				self._push(message.chat_id, retry_at or monotonic())
+			else:
+				del self._queues[message.chat_id]
+			self._condition.notify_all()
+
+	def _run(self) -> None:
+		while (message := self._next()) is not None:
+			message.attempts += 1
+			try:
+				self._send(message)
+			except RetryAfter as e:
+				kookiie_logger.warning("Flood control in chat %s; retrying in %ss.", message.chat_id, e.retry_after)
+				self._done(message, "retried", monotonic() + e.retry_after)
+			except (BadRequest, Unauthorized, ChatMigrated) as e:  # rejected; sending it again would fail the same way
+				kookiie_logger.error("Error! The following exception was encountered while sending to chat %s: %s", message.chat_id, e)
+				self._done(message, "failed")
+			except NetworkError as e:  # includes time-outs
+				if message.attempts < MAX_ATTEMPTS:
+					self._done(message, "retried", monotonic() + message.attempts)
+				else:
+					kookiie_logger.error("Error! The following exception was encountered while sending to chat %s: %s", message.chat_id, e)
+					self._done(message, "failed")
+			except Exception as e:
+				kookiie_logger.error("Error! The following exception was encountered while sending to chat %s: %s", message.chat_id, e)
+				self._done(message, "failed")
+			else:
+				self._done(message, "sent")
+
+	def _send(self, message: OutboundMessage) -> None:
+		start = perf_counter()
+		try:
+			getattr(self.bot, message.method)(**message.kwargs)
+		finally:
+			API_SECONDS.observe(message.method, perf_counter() - start)
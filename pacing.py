@@ -0,0 +1,95 @@
+"""Per-chat pacing of outgoing messages, without blocking the dispatcher
+
+Handlers used to `sleep()` after sending a message, so that the chat would not be
+flooded. That held a worker for the whole pause, and stalled every other chat.
+Instead, each chat keeps the time at which it may next be messaged, and later
+messages are handed over to the job queue to be sent at that time.
+
+On shutdown, flush() runs the messages still waiting at once, in order, as the
+job queue is about to stop, and would drop them.
+"""
+import itertools
+import threading
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Callable
+
+import logger
+
+if TYPE_CHECKING:  # telegram.ext is slow to import, and only needed once the bot runs
+	from telegram.ext import CallbackContext, JobQueue
+
+
+kookiie_logger = logger.get_logger(__name__)
+
+
+class PacingScheduler:
+	"""Delays the next message in a chat, instead of the worker that sends it"""
+
+	def __init__(self, job_queue: "JobQueue | None" = None, pause_scale: float = 1.0) -> None:
+		self.job_queue: "JobQueue | None" = job_queue
+		self.pause_scale: float = pause_scale  # e.g. 0 for load tests, to send everything at once
+		self._next_slot: dict[int, float] = {}  # chat ID: earliest time for the next message
+		self._waiting: dict[int, tuple[float, Callable[[], Any]]] = {}  # ticket: (time due, callback), scheduled for later
+		self._tickets = itertools.count()
+		self._flushed: bool = False  # once flushed, callbacks are run at once
+		self._lock = threading.Lock()
+
+	def attach(self, job_queue: "JobQueue") -> None:
+		"""Use the job queue of a running Updater for delayed messages"""
+		self.job_queue = job_queue
+
+	def schedule(self, chat_id: int, callback: Callable[[], Any], pause: float = 0) -> None:
+		"""Run the callback as soon as the chat is free, then keep the chat quiet for `pause` seconds"""
+		with self._lock:
+			now = monotonic()
+			start = max(now, self._next_slot.get(chat_id, now))
+			self._next_slot[chat_id] = start + pause * self.pause_scale
+			delay = start - now
+			if delay > 0 and not self._flushed:
+				ticket = next(self._tickets)
+				self._waiting[ticket] = (start, callback)
+		if delay <= 0 or self._flushed:
+			self._run(callback)
+		elif self.job_queue:
+			self.job_queue.run_once(lambda _: self._run_waiting(ticket), delay)
+		else:  # no job queue yet (e.g. scripts), fall back to a timer thread
+			threading.Timer(delay, self._run_waiting, args=(ticket,)).start()
+
+	def flush(self) -> None:
+		"""Run the callbacks still waiting now, in the order they were due, and any later ones at once; e.g. on shutdown"""
+		with self._lock:
+			self._flushed = True
+			waiting = sorted(self._waiting.values(), key=lambda entry: entry[0])  # stable, so each chat keeps its order
+			self._waiting.clear()
+		for _, callback in waiting:
+			self._run(callback)
+
+	def free_at(self, chat_id: int) -> float:
+		"""The time (of monotonic()) at which the chat may next be messaged; in the past if it is free"""
+		with self._lock:
+			return self._next_slot.get(chat_id, 0.0)
+
+	def forget(self, chat_id: int) -> None:
+		"""Drop the pacing record of a chat"""
+		with self._lock:
+			self._next_slot.pop(chat_id, None)
+
+	def prune(self, _: "CallbackContext | None" = None) -> None:
+		"""Drop pacing records that have already expired; can be used as a repeating job"""
+		with self._lock:
+			now = monotonic()
+			for chat_id in [k for k, v in self._next_slot.items() if v <= now]:
+				del self._next_slot[chat_id]
+
+	def _run_waiting(self, ticket: int) -> None:
+		with self._lock:
+			entry = self._waiting.pop(ticket, None)
+		if entry:  # not already run by flush()
+			self._run(entry[1])
+
+	@staticmethod
+	def _run(callback: Callable[[], Any]) -> None:
+		try:
+			callback()
+		except Exception as e:
+			kookiie_logger.error("Error! The following exception was encountered while sending a paced message: %s", e)
@@ -0,0 +1,78 @@
+"""Benchmark of how many concurrent games one process can drive, with the pauses between messages
+
+Runs the load test (see load_test.py) with the pauses kept, at doubling numbers of
+chats, first with the pauses slept in the handlers, as the bot used to, then paced
+by the PacingScheduler, as it does now. A number of chats is sustained while their
+games take no longer than a game played alone, give or take the tolerance: the
+pauses, not the workers, set the pace. Each run is a separate process.
+
+The pauses are scaled down (--pause-scale) to keep the runs short; the sleeping
+handlers hold a worker for the same share of each game either way.
+
+Usage:
+	python pacing_benchmark.py [--players M] [--length SHORT|MEDIUM|LONG] [--workers N]
+		[--pause-scale X] [--max-chats N] [--tolerance X]
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import load_test
+
+
+TOLERANCE = 0.25  # share by which a game may take longer than when played alone
+
+
+def run_games(chats: int, pauses: str, args: argparse.Namespace) -> float | None:
+	"""The median game duration, in seconds, with the chats playing at once; None if the games did not finish"""
+	label = f"pacing_{pauses}_{chats}"
+	subprocess.run(
+		[
+			sys.executable, "load_test.py", "--chats", str(chats), "--players", str(args.players),
+			"--length", args.length, "--workers", str(args.workers), "--pauses", pauses,
+			"--pause-scale", str(args.pause_scale), "--label", label,
+		],
+		check=True, capture_output=True,
+	)
+	with open(load_test.RESULTS_DIRECTORY / f"{label}.json", "r", encoding="utf-8") as results_file:
+		results = json.load(results_file)
+	return results["Game duration (ms)"]["p50"] / 1000 if results["Completed"] else None
+
+
+def sustained_chats(pauses: str, args: argparse.Namespace) -> int:
+	"""The most chats (of those tried) whose games keep the pace of a game played alone"""
+	alone = run_games(1, pauses, args)
+	print(f"{pauses}: a game alone takes {alone:.2f}s")
+	sustained = 1
+	chats = 2
+	while chats <= args.max_chats:
+		duration = run_games(chats, pauses, args)
+		kept_pace = duration is not None and duration <= alone * (1 + args.tolerance)
+		print(f"{pauses}: {chats} chats, " + (f"{duration:.2f}s per game" if duration else "not finished"))
+		if not kept_pace:
+			break
+		sustained = chats
+		chats *= 2
+	return sustained
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--players", type=int, default=1, help="players in each chat")
+	parser.add_argument("--length", choices=("SHORT", "MEDIUM", "LONG"), default="SHORT", help="game length")
+	parser.add_argument("--workers", type=int, default=8, help="threads handling updates, as update_workers in config.yaml")
+	parser.add_argument("--pause-scale", type=float, default=0.1, help="factor for the pauses")
+	parser.add_argument("--max-chats", type=int, default=1024, help="most chats to try")
+	parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="share by which a game may take longer")
+	args = parser.parse_args()
+
+	results = {pauses: sustained_chats(pauses, args) for pauses in ("sleep", "paced")}
+	print(f"Concurrent games sustained by {args.workers} workers:")
+	for pauses, chats in results.items():
+		limit = " (the most tried)" if chats >= args.max_chats else ""
+		print(f"  {'sleeping handlers' if pauses == 'sleep' else 'paced messages'}: {chats}{limit}")
+
+
+if __name__ == "__main__":
+	main()
@@ -1,34 +1,109 @@
 """The class PlayerData models the format for player data storage"""
+import threading
+from typing import Callable, TypeVar
 
+from player_store import PlayerStore, to_player
+from profile_cache import MISSING, ProfileCache
 
-class PlayerData(dict):
-	"""A dictionary with convenience methods for storing gameplay data"""
+
+CACHE_SIZE = 10000  # player profiles
+CACHE_TTL = 600  # seconds
+T = TypeVar("T")
+
+
+def merge_result(player: dict | None, name: str, high_score: int, plays: int) -> dict:
+	"""Apply (name, high score, games played) results to a player record, as the player store does"""
+	if not player:
+		return to_player(name, high_score, plays)
+	return to_player(name, max(high_score, player["High score"]), player["Number of games played"] + plays)
+
+
+class PlayerData:
+	"""Player records, read through a bounded cache from the player store
+
+	Nothing is loaded up front: a player's record is read from the store the first
+	time it is needed, and kept in the cache. Updates are applied to the cached
+	record, and kept aside as pending results, until they are written to storage
+	(see write_behind), so that only the players who have played are written.
+	Records read from the store include the pending results, so a record evicted
+	from the cache before its results are saved is never out of date.
+
+	The lock is never held while waiting on the store, so a save in progress does
+	not hold up the games. A save removes the results it wrote from the pending
+	ones once they are committed (see remove_saved), and a read from the store
+	that overlaps that is retried, so that no result is missed, or counted twice.
+	"""
+
+	def __init__(self, store: PlayerStore, cache_size: int = CACHE_SIZE, cache_ttl: float = CACHE_TTL) -> None:
+		self.store: PlayerStore = store
+		self.cache: ProfileCache = ProfileCache(cache_size, cache_ttl)
+		self.pending: dict[int, tuple[str, int, int]] = {}  # user ID: (name, high score, games played)
+		self.saves: int = 0  # batches of pending results removed once saved
+		self.lock = threading.RLock()  # held to update the cache and the pending results together
+		self.save_lock = threading.Lock()  # held by a save, so that no results are written twice
 
 	def update_player(self, user_id: int, name: str, high_score: int) -> None:
-		"""Adds/replaces entries in the dictionary, with the intended format"""
-		if user_id not in self:
-			self.update({
-				user_id: {
-					"Name": name,
-					"High score": high_score,
-					"Number of games played": 1,
-				}
-			})
-		else:
-			old_score = self.get(user_id).get("High score")
-			new_score = high_score if high_score > old_score else old_score
-			new_plays = self.get(user_id).get("Number of games played") + 1
-			self.update({
-				user_id: {
-					"Name": name,
-					"High score": new_score,
-					"Number of games played": new_plays,
-				}
-			})
-
-	def get_player(self, user_id: int) -> dict:
-		"""Get the player details"""
-		return self.get(user_id)
+		"""Record the result of a game for a player"""
+		self.update_players({user_id: (name, high_score)})
+
+	def update_players(self, results: dict[int, tuple[str, int]]) -> set[int]:
+		"""Record the (name, score) of each player of a game, as one batch; returns the players with a new high score
+
+		Players missing from the cache are read from the store in a single query.
+		"""
+		first_lookup = True
+		while True:
+			with self.lock:
+				players = {user_id: self.cache.get(user_id, count=first_lookup) for user_id in results}
+				missing = [user_id for user_id, player in players.items() if player is MISSING]
+				if not missing:
+					new_high_scores = set()
+					for user_id, (name, score) in results.items():
+						player = players[user_id]
+						if score > (player["High score"] if player else 0):
+							new_high_scores.add(user_id)
+						self.cache.put(user_id, merge_result(player, name, score, 1))
+					self.add_pending({user_id: (name, score, 1) for user_id, (name, score) in results.items()})
+					return new_high_scores
+			self._read_players(missing)  # outside the lock; they are then cached, unless evicted meanwhile
+			first_lookup = False
+
+	def add_pending(self, results: dict[int, tuple[str, int, int]]) -> None:
+		"""Merge (name, high score, games played) results into the pending results"""
+		with self.lock:
+			for user_id, (name, high_score, plays) in results.items():
+				if user_id in self.pending:
+					_, old_score, old_plays = self.pending[user_id]
+					high_score, plays = max(high_score, old_score), plays + old_plays
+				self.pending[user_id] = (name, high_score, plays)
+
+	def copy_pending(self) -> dict[int, tuple[str, int, int]]:
+		"""Get a copy of the pending results, e.g. to write them to storage"""
+		with self.lock:
+			return dict(self.pending)
+
+	def remove_saved(self, saved: dict[int, tuple[str, int, int]]) -> None:
+		"""Remove results from the pending ones, once they are committed to storage
+
+		Results recorded while they were written stay pending.
+		"""
+		with self.lock:
+			for user_id, (_, _, saved_plays) in saved.items():
+				if user_id not in self.pending:
+					continue
+				name, high_score, plays = self.pending[user_id]
+				if plays > saved_plays:
+					self.pending[user_id] = (name, high_score, plays - saved_plays)  # the high score is merged as a maximum
+				else:
+					del self.pending[user_id]
+			self.saves += 1
+
+	def get_player(self, user_id: int) -> dict | None:
+		"""Get the player details; None if they have not played"""
+		player = self.cache.get(user_id)
+		if player is not MISSING:
+			return player
+		return self._read_player(user_id)
 
 	def get_player_high_score(self, user_id: int) -> int:
 		"""Get the player high score; defaults to 0"""
@@ -39,5 +114,83 @@ class PlayerData(dict):
 
 	def get_highest_score(self) -> str:
 		"""Get the player with the highest score, and the relevant details"""
-		player_id = max(self, key=lambda v: self[v]["High score"])
-		return '\n'.join([f"{k}: {v}" for k, v in sorted(self[player_id].items())])
+		top = self.get_top_players(1)
+		if not top:
+			return ""
+		return '\n'.join([f"{k}: {v}" for k, v in sorted(top[0].items())])
+
+	def get_top_players(self, count: int) -> list[dict]:
+		"""Get the details of the players with the highest scores, best first"""
+		with self.lock:
+			pending = list(self.pending)
+		candidates = dict(self.store.top(count))
+		for user_id in pending:  # results not yet in the store can change the order
+			candidates[user_id] = self.get_player(user_id)
+		ranked = sorted(candidates.items(), key=lambda candidate: (-candidate[1]["High score"], candidate[0]))
+		return [player for _, player in ranked[:count]]
+
+	def get_player_rank(self, user_id: int) -> int | None:
+		"""Get the leaderboard rank of the player; None if they have not played
+
+		Counted in the store, so that the results saved by other worker processes
+		count too, and corrected for the results not saved yet.
+		"""
+		player = self.get_player(user_id)
+		if not player:
+			return None
+		high_score = player["High score"]
+
+		def count_above(pending: dict[int, tuple[str, int, int]]) -> int:
+			above = self.store.count_above(high_score)
+			stored = self.store.get_many(list(pending))
+			for pending_id, result in pending.items():
+				stored_player = stored.get(pending_id)
+				was_above = stored_player is not None and stored_player["High score"] > high_score
+				above += merge_result(stored_player, *result)["High score"] > high_score and not was_above
+			return above
+
+		return self._read_consistently(count_above) + 1
+
+	def count_players(self) -> int:
+		"""Get the number of players, including those whose first results are not saved yet"""
+
+		def count(pending: dict[int, tuple[str, int, int]]) -> int:
+			stored = self.store.get_many(list(pending))
+			return self.store.count() + sum(user_id not in stored for user_id in pending)
+
+		return self._read_consistently(count)
+
+	def _read_consistently(self, read: Callable[[dict[int, tuple[str, int, int]]], T]) -> T:
+		"""Read from the store, given a copy of the pending results; retried if a save removed pending results meanwhile"""
+		while True:
+			with self.lock:
+				saves, pending = self.saves, dict(self.pending)
+			result = read(pending)
+			with self.lock:
+				if self.saves == saves:
+					return result
+
+	def _read_player(self, user_id: int) -> dict | None:
+		return self._read_players([user_id])[user_id]
+
+	def _read_players(self, user_ids: list[int]) -> dict[int, dict | None]:
+		"""Read players from the store, with their pending results, and cache them
+
+		Retried if their pending results changed meanwhile, so that an older record
+		never replaces a newer one that has since been evicted from the cache.
+		"""
+		while True:
+			with self.lock:
+				saves, pending = self.saves, {user_id: self.pending.get(user_id) for user_id in user_ids}
+			stored = self.store.get_many(user_ids)
+			with self.lock:
+				if self.saves != saves or any(self.pending.get(user_id) != pending[user_id] for user_id in user_ids):
+					continue
+				players = {}
+				for user_id in user_ids:
+					player = stored.get(user_id)
+					if pending[user_id]:
+						player = merge_result(player, *pending[user_id])
+					players[user_id] = player
+					self.cache.put(user_id, player, replace=False)  # a record cached meanwhile is just as recent
+				return players
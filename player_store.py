@@ -0,0 +1,245 @@
+"""SQLite-backed storage for player data, with per-player upserts
+
+Players are looked up by user ID as they are needed, rather than loaded all at
+once, and the leaderboards are read through indexes on the high scores, and
+through the number of players with each high score (for ranks). Besides the
+players, the database keeps the leaderboard of each chat, and how often each
+word has been answered correctly.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+import logger
+
+
+kookiie_logger = logger.get_logger(__name__)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+	user_id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL,
+	high_score INTEGER NOT NULL,
+	games_played INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS players_by_high_score ON players (high_score DESC, user_id);
+-- The number of players with each high score, kept up to date by the triggers below in the
+-- same transaction as every write (by any process), so that a rank is a sum over the few
+-- distinct scores above it, rather than a count of the players above it
+CREATE TABLE IF NOT EXISTS score_counts (
+	high_score INTEGER PRIMARY KEY,
+	players INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS score_counts_on_insert AFTER INSERT ON players BEGIN
+	INSERT INTO score_counts (high_score, players) VALUES (new.high_score, 1)
+	ON CONFLICT (high_score) DO UPDATE SET players = players + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS score_counts_on_update AFTER UPDATE OF high_score ON players
+WHEN new.high_score != old.high_score BEGIN
+	UPDATE score_counts SET players = players - 1 WHERE high_score = old.high_score;
+	DELETE FROM score_counts WHERE high_score = old.high_score AND players = 0;
+	INSERT INTO score_counts (high_score, players) VALUES (new.high_score, 1)
+	ON CONFLICT (high_score) DO UPDATE SET players = players + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS score_counts_on_delete AFTER DELETE ON players BEGIN
+	UPDATE score_counts SET players = players - 1 WHERE high_score = old.high_score;
+	DELETE FROM score_counts WHERE high_score = old.high_score AND players = 0;
+END;
+CREATE TABLE IF NOT EXISTS chat_players (
+	chat_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
+	name TEXT NOT NULL,
+	high_score INTEGER NOT NULL,
+	games_played INTEGER NOT NULL,
+	PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS chat_players_by_high_score ON chat_players (chat_id, high_score DESC, user_id);
+CREATE TABLE IF NOT EXISTS word_stats (
+	category TEXT NOT NULL,
+	word TEXT NOT NULL,
+	answers INTEGER NOT NULL,
+	correct INTEGER NOT NULL,
+	PRIMARY KEY (category, word)
+)
+"""
+# Merge a batch of results into the stored records, so that concurrent writers never lose games:
+UPSERT = """
+INSERT INTO players (user_id, name, high_score, games_played) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET
+	name = excluded.name,
+	high_score = MAX(high_score, excluded.high_score),
+	games_played = games_played + excluded.games_played
+"""
+UPSERT_CHAT_PLAYER = """
+INSERT INTO chat_players (chat_id, user_id, name, high_score, games_played) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (chat_id, user_id) DO UPDATE SET
+	name = excluded.name,
+	high_score = MAX(high_score, excluded.high_score),
+	games_played = games_played + excluded.games_played
+"""
+UPSERT_WORD_STATS = """
+INSERT INTO word_stats (category, word, answers, correct) VALUES (?, ?, ?, ?)
+ON CONFLICT (category, word) DO UPDATE SET
+	answers = answers + excluded.answers,
+	correct = correct + excluded.correct
+"""
+
+
+def to_player(name: str, high_score: int, games_played: int) -> dict:
+	"""A player record, in the format used by PlayerData"""
+	return {
+		"Name": name,
+		"High score": high_score,
+		"Number of games played": games_played,
+	}
+
+
+class PlayerStore:
+	"""Player records in an SQLite database
+
+	Every write is a single transaction in WAL mode with full syncing, so a crash
+	leaves either all or none of a batch on disk.
+	"""
+
+	def __init__(self, path: Path) -> None:
+		self.path: Path = path
+		self.is_new: bool = not path.is_file()
+		self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._connection.execute("PRAGMA journal_mode=WAL")
+		self._connection.execute("PRAGMA synchronous=FULL")
+		self._connection.executescript(SCHEMA)
+		self._lock = threading.Lock()
+		self._count_scores()
+
+	def get(self, user_id: int) -> dict | None:
+		"""Get a player record, in the format used by PlayerData; None if they have not played"""
+		with self._lock:
+			row = self._connection.execute(
+				"SELECT name, high_score, games_played FROM players WHERE user_id = ?", (user_id,)
+			).fetchone()
+		return to_player(*row) if row else None
+
+	def get_many(self, user_ids: list[int]) -> dict[int, dict]:
+		"""Get the records of several players at once; players who have not played are left out"""
+		if not user_ids:
+			return {}
+		with self._lock:
+			rows = self._connection.execute(
+				"SELECT user_id, name, high_score, games_played FROM players "
+				f"WHERE user_id IN ({', '.join('?' * len(user_ids))})",
+				user_ids,
+			).fetchall()
+		return {user_id: to_player(*player) for user_id, *player in rows}
+
+	def top(self, count: int) -> list[tuple[int, dict]]:
+		"""Get the (user ID, record) of the players with the highest scores, best first"""
+		with self._lock:
+			rows = self._connection.execute(
+				"SELECT user_id, name, high_score, games_played FROM players "
+				"ORDER BY high_score DESC, user_id LIMIT ?",
+				(count,),
+			).fetchall()
+		return [(user_id, to_player(*player)) for user_id, *player in rows]
+
+	def count(self) -> int:
+		"""Get the number of players, from the counts of each high score"""
+		with self._lock:
+			return self._connection.execute("SELECT COALESCE(SUM(players), 0) FROM score_counts").fetchone()[0]
+
+	def count_above(self, high_score: int) -> int:
+		"""Get the number of players with a higher high score, from the counts of the higher scores"""
+		with self._lock:
+			return self._connection.execute(
+				"SELECT COALESCE(SUM(players), 0) FROM score_counts WHERE high_score > ?", (high_score,)
+			).fetchone()[0]
+
+	def upsert(self, results: dict[int, tuple[str, int, int]], on_commit: Callable[[], None] | None = None) -> None:
+		"""Merge (name, high score, games played) results into the stored player records
+
+		`on_commit` is called once they are committed, before any other read of the
+		store, e.g. to stop merging them into the records read from the store.
+		"""
+		if not results:
+			return
+		with self._lock:
+			with self._transaction():
+				self._connection.executemany(
+					UPSERT,
+					[(user_id, *result) for user_id, result in results.items()],
+				)
+			if on_commit:
+				on_commit()
+
+	def add_game_stats(
+			self,
+			chat_results: dict[tuple[int, int], tuple[str, int, int]],
+			word_results: dict[tuple[str, str], tuple[int, int]],
+	) -> None:
+		"""Merge per-chat (name, high score, games played) results, and per-word (answers, correct answers), at once"""
+		if not chat_results and not word_results:
+			return
+		with self._lock:
+			with self._transaction():
+				self._connection.executemany(
+					UPSERT_CHAT_PLAYER,
+					[(*key, *result) for key, result in chat_results.items()],
+				)
+				self._connection.executemany(
+					UPSERT_WORD_STATS,
+					[(*key, *result) for key, result in word_results.items()],
+				)
+
+	def top_in_chat(self, chat_id: int, count: int) -> list[tuple[int, dict]]:
+		"""Get the (user ID, record) of the players with the highest scores in a chat, best first"""
+		with self._lock:
+			rows = self._connection.execute(
+				"SELECT user_id, name, high_score, games_played FROM chat_players WHERE chat_id = ? "
+				"ORDER BY high_score DESC, user_id LIMIT ?",
+				(chat_id, count),
+			).fetchall()
+		return [(user_id, to_player(*player)) for user_id, *player in rows]
+
+	def get_word_stats(self, min_answers: int = 1) -> dict[tuple[str, str], tuple[int, int]]:
+		"""Get the (answers, correct answers) of each (category, word), e.g. to weight the questions by difficulty"""
+		with self._lock:
+			rows = self._connection.execute(
+				"SELECT category, word, answers, correct FROM word_stats WHERE answers >= ?", (min_answers,)
+			).fetchall()
+		return {(category, word): (answers, correct) for category, word, answers, correct in rows}
+
+	def import_players(self, players: dict) -> None:
+		"""Import records in the format used by PlayerData, e.g. from the legacy YAML file"""
+		self.upsert({
+			user_id: (
+				player.get("Name"),
+				player.get("High score"),
+				player.get("Number of games played"),
+			) for user_id, player in players.items()
+		})
+		kookiie_logger.info("Imported %d player records.", len(players))
+
+	def close(self) -> None:
+		with self._lock:
+			self._connection.close()
+
+	def _count_scores(self) -> None:
+		"""Fill in the counts of each high score, for a database written before they were kept"""
+		with self._lock:
+			with self._transaction():
+				if self._connection.execute("SELECT 1 FROM score_counts LIMIT 1").fetchone():
+					return
+				self._connection.execute(
+					"INSERT INTO score_counts (high_score, players) SELECT high_score, COUNT(*) FROM players GROUP BY high_score"
+				)
+
+	@contextmanager
+	def _transaction(self) -> Iterator[sqlite3.Connection]:
+		"""Explicit transaction, as the connection is in autocommit mode"""
+		self._connection.execute("BEGIN IMMEDIATE")
+		try:
+			yield self._connection
+		except BaseException:
+			self._connection.execute("ROLLBACK")
+			raise
+		self._connection.execute("COMMIT")
@@ -0,0 +1,66 @@
+"""A bounded cache of player profiles, in front of the player database
+
+Only a few players are active at any time, out of all those who have ever played,
+so keeping every profile in memory does not scale. The cache keeps the most
+recently used profiles, up to a maximum size, each for a limited time, so that
+changes made by other worker processes sharing the database are picked up.
+Players without a profile are cached too (as None), as new players are looked up
+before they have played.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any
+
+
+MISSING = object()  # not cached; distinct from a cached None
+
+
+class ProfileCache:
+	"""A thread-safe LRU cache, whose entries also expire after a time-to-live"""
+
+	def __init__(self, size: int, ttl: float) -> None:
+		self.size: int = size
+		self.ttl: float = ttl  # seconds
+		self._entries: OrderedDict[int, tuple[float, Any]] = OrderedDict()  # user ID: (expiry time, profile)
+		self._lock = threading.Lock()
+		# Counters:
+		self.hits: int = 0
+		self.misses: int = 0
+		self.evictions: int = 0
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def get(self, user_id: int, count: bool = True) -> Any:
+		"""Get a cached profile (which can be None); MISSING if it isn't cached, or has expired
+
+		Without `count`, the lookup is left out of the hit rate (e.g. when looking a profile up again).
+		"""
+		with self._lock:
+			entry = self._entries.get(user_id)
+			if entry is None or entry[0] < monotonic():
+				self.misses += count
+				return MISSING
+			self._entries.move_to_end(user_id)
+			self.hits += count
+			return entry[1]
+
+	def put(self, user_id: int, profile: Any, replace: bool = True) -> None:
+		"""Cache a profile, evicting the least recently used ones beyond the size
+
+		Without `replace`, a profile cached in the meantime (e.g. by an update) is kept.
+		"""
+		with self._lock:
+			entry = self._entries.get(user_id)
+			if not replace and entry is not None and entry[0] >= monotonic():
+				return
+			self._entries[user_id] = (monotonic() + self.ttl, profile)
+			self._entries.move_to_end(user_id)
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+
+	def hit_rate(self) -> float:
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,119 @@
+"""This module samples the questions for a game, when the game starts
+
+The whole game is drawn up front as a deck of (category, word) questions, so that
+asking a question is just a matter of moving on to the next card. Words are drawn
+without replacement (until a word bank runs out), in a configurable mix of
+composers and pastas (see the questions settings in config.yaml), and optionally
+weighted per word by difficulty, from the answers given in earlier games.
+
+The questions themselves are shared between games (see get_question), as the
+same words come up in many games at once.
+"""
+import random
+from functools import lru_cache
+from typing import Sequence
+
+from keyboard_model import KeyboardText
+
+
+COMPOSER_RATIO = 0.5  # share of questions that are composers
+MAX_REJECTIONS = 8  # weighted draws per question before falling back to unweighted ones
+SHARED_QUESTIONS = 16384  # most recently drawn questions, shared between games
+
+
+class AliasTable:
+	"""Vose's alias method, for O(1) draws from a weighted distribution"""
+
+	def __init__(self, weights: Sequence[float]) -> None:
+		count = len(weights)
+		total = sum(weights)
+		scaled = [weight * count / total for weight in weights]
+		self.probability: list[float] = [1.0] * count
+		self.alias: list[int] = list(range(count))
+		small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+		large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+		while small and large:
+			less, more = small.pop(), large.pop()
+			self.probability[less] = scaled[less]
+			self.alias[less] = more
+			scaled[more] -= 1.0 - scaled[less]
+			(small if scaled[more] < 1.0 else large).append(more)
+
+	def draw(self, rng: random.Random) -> int:
+		i = rng.randrange(len(self.probability))
+		return i if rng.random() < self.probability[i] else self.alias[i]
+
+
+def draw_indices(
+		count: int,
+		population: int,
+		weights: Sequence[float] | None = None,
+		rng: random.Random = random,
+) -> list[int]:
+	"""Draw indices without replacement; the population is reused once every index has been drawn"""
+	if not population:
+		return []
+	indices = []
+	while len(indices) < count:
+		needed = min(count - len(indices), population)
+		if weights is None:
+			indices += rng.sample(range(population), needed)
+			continue
+		table = AliasTable(weights)
+		drawn: dict[int, None] = {}  # ordered set
+		for _ in range(needed * MAX_REJECTIONS):
+			if len(drawn) == needed:
+				break
+			drawn[table.draw(rng)] = None
+		if len(drawn) < needed:  # heavily skewed weights; fill up with the remaining indices
+			remaining = [i for i in range(population) if i not in drawn]
+			drawn.update(dict.fromkeys(rng.sample(remaining, needed - len(drawn))))
+		indices += drawn
+	return indices
+
+
+@lru_cache(maxsize=SHARED_QUESTIONS)
+def get_question(category: KeyboardText, word: str) -> tuple[KeyboardText, str]:
+	"""The shared (category, word) question; words read from a snapshot are new strings each time they are read"""
+	return category, word
+
+
+def get_difficulty_weights(word_stats: dict[tuple[str, str], tuple[int, int]]) -> dict[tuple[str, str], float]:
+	"""Weights of the (category, word) questions by how often they are answered wrongly; 1 on average
+
+	The share of wrong answers is smoothed towards a half (as if every word had also
+	been answered once rightly and once wrongly), so that a few answers don't decide it.
+	"""
+	return {key: 2 * (answers - correct + 1) / (answers + 2) for key, (answers, correct) in word_stats.items()}
+
+
+def build_deck(
+		total_rounds: int,
+		composer_keys: Sequence[str],
+		pasta_keys: Sequence[str],
+		composer_ratio: float = COMPOSER_RATIO,
+		weights: dict[tuple[str, str], float] | None = None,
+		rng: random.Random = random,
+) -> tuple[tuple[KeyboardText, str], ...]:
+	"""Sample all questions of a game, as (correct category, word) tuples
+
+	Weights are optional, by (category, word) as in the word statistics (see
+	get_difficulty_weights), and default to 1 for any word that is not listed.
+	"""
+	if not composer_keys and not pasta_keys:
+		return ()
+	composer_ratio = min(max(composer_ratio, 0.0), 1.0)
+	composer_count = round(total_rounds * composer_ratio) if pasta_keys else total_rounds
+	if not composer_keys:
+		composer_count = 0
+	categories = [KeyboardText.COMPOSER] * composer_count + [KeyboardText.PASTA] * (total_rounds - composer_count)
+	rng.shuffle(categories)
+
+	words = {}
+	for category, keys, count in (
+			(KeyboardText.COMPOSER, composer_keys, composer_count),
+			(KeyboardText.PASTA, pasta_keys, total_rounds - composer_count),
+	):
+		key_weights = [weights.get((category.value, key), 1.0) for key in keys] if weights else None
+		words[category] = iter([keys[i] for i in draw_indices(count, len(keys), key_weights, rng)])
+	return tuple(get_question(category, next(words[category])) for category in categories)
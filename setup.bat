@@ -13,5 +13,8 @@ call venv\scripts\activate.bat
 rem Install requirements
 pip install wheel
 pip install -r requirements.txt
+
+echo Compiling word banks...
+python data_handler.py
 echo Sequence completed! You may now close this window:
 pause
\ No newline at end of file
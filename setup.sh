@@ -14,5 +14,8 @@ source "$PWD"/venv/bin/activate
 
 pip install wheel
 pip install -r requirements.txt
+
+echo "Compiling word banks..."
+python3 data_handler.py
 echo "Sequence completed! You may now close this window:"
 exit
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""Startup time benchmark of the bot, with a time budget
+
+Starts fresh interpreters that import main and call main.create_app(), as the bot
+does before it connects to Telegram. Each is timed, and run with `-X importtime`,
+to show which imports take the longest. Importing main must also leave out
+the modules only needed to run the bot (see LAZY_MODULES), so that scripts,
+tools and health checks that import it stay cheap, and leave their logging
+alone, and their threads: only create_app() and main() set these up.
+
+create_app() is timed on both paths of the word banks: with their snapshots up
+to date, as on most restarts, and with stale snapshots (as after the word banks
+are edited), which are read from the YAML files, and compiled again. The word
+banks are copied to a temporary directory for this, and only the first path
+has a budget.
+
+Exits with 1 if a budget is exceeded, a lazy module is imported too early, or
+importing main has other side effects, so that it can be run in CI. The best of several runs is compared with the budgets,
+as the slower runs are mostly noise from the machine.
+
+Usage:
+	python startup_benchmark.py [--runs N] [--import-budget MS] [--create-budget MS] [--top N]
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+
+IMPORT_BUDGET = 150  # milliseconds to import main
+CREATE_BUDGET = 100  # milliseconds for main.create_app()
+WORD_BANKS = {"composer": "composer_data.yaml", "pasta": "pasta_data.yaml"}
+LAZY_MODULES = ("telegram.ext", "ruamel.yaml", "apscheduler", "tornado")  # must not be imported by `import main`
+# Runs in a fresh interpreter; the player database and the word banks are in a temporary directory
+PROBE = """
+import json, sys
+from time import perf_counter
+start = perf_counter()
+import main
+imported = perf_counter()
+early = [name for name in {lazy_modules!r} if name in sys.modules]
+import logging, threading
+root = logging.getLogger()
+side_effects = [f"added a {{type(handler).__name__}} to the root logger" for handler in root.handlers]
+if root.level != logging.WARNING:
+	side_effects.append(f"set the root logger's level to {{logging.getLevelName(root.level)}}")
+side_effects += [f"started the thread {{thread.name}}" for thread in threading.enumerate() if thread is not threading.main_thread()]
+import data_handler
+from pathlib import Path
+data_handler.PLAYER_DATA_DIRECTORY = Path({directory!r}, "player_data.yaml")
+data_handler.PLAYER_DATABASE_DIRECTORY = Path({directory!r}, "player_data.db")
+import config
+load_config = config.load_config
+config.load_config = lambda: config.merge(load_config(), {{"word_banks": {word_banks!r}}})
+created_start = perf_counter()
+main.create_app()
+created = perf_counter()
+print(json.dumps({{
+	"import": imported - start, "create_app": created - created_start, "early": early, "side_effects": side_effects,
+}}))
+"""
+
+
+def probe(directory: str, word_banks: dict[str, list[str]]) -> tuple[dict, list[tuple[int, int, str]]]:
+	"""Time a startup, and get the (self, cumulative) microseconds of each module imported directly by main"""
+	code = PROBE.format(lazy_modules=LAZY_MODULES, directory=directory, word_banks=word_banks)
+	result = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", code], cwd=Path(__file__).parent, capture_output=True, text=True,
+	)
+	if result.returncode:
+		raise RuntimeError(result.stderr.strip().splitlines()[-1])
+	imports, children = [], []
+	for line in result.stderr.splitlines():
+		fields = line.removeprefix("import time:").split("|")
+		if len(fields) != 3 or not fields[0].strip().isdigit():
+			continue  # the header, or another line on stderr
+		own, cumulative, name = fields
+		depth = (len(name) - len(name.lstrip())) // 2  # imports are listed after the imports they made, indented
+		if depth == 0:
+			if name.strip() == "main":
+				imports = children
+			children = []
+		elif depth == 1:
+			children.append((int(own), int(cumulative), name.strip()))
+	return json.loads(result.stdout.strip().splitlines()[-1]), imports
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--runs", type=int, default=5, help="interpreters to start; the best run is used")
+	parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET, help="milliseconds to import main")
+	parser.add_argument("--create-budget", type=float, default=CREATE_BUDGET, help="milliseconds for main.create_app()")
+	parser.add_argument("--top", type=int, default=10, help="slowest imports of main to list")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		sources = {category: Path(__file__).parent / file for category, file in WORD_BANKS.items()}
+		word_banks = {category: [str(Path(directory, source.name))] for category, source in sources.items()}
+		stale_runs = []
+		for number in range(args.runs):
+			for category, source in sources.items():  # edited, so that the snapshots are stale
+				shutil.copyfile(source, word_banks[category][0])
+				with open(word_banks[category][0], "a", encoding="utf-8") as file:
+					file.write(f"\n# Run {number}\n")
+			stale_runs.append(probe(directory, word_banks))
+		runs = [probe(directory, word_banks) for _ in range(args.runs)]  # with the snapshots compiled by the last run
+	timings, imports = min(runs, key=lambda run: run[0]["import"])
+	import_ms = timings["import"] * 1000
+	create_ms = min(run[0]["create_app"] for run in runs) * 1000
+	stale_ms = min(run[0]["create_app"] for run in stale_runs) * 1000
+
+	print(f"import main: {import_ms:.1f}ms (budget {args.import_budget:.0f}ms)")
+	print(f"main.create_app(): {create_ms:.1f}ms (budget {args.create_budget:.0f}ms)")
+	print(f"main.create_app() with stale word bank snapshots: {stale_ms:.1f}ms (reads the YAML files, and compiles them)")
+	print("Slowest imports of main (including what they import):")
+	for own, cumulative, name in sorted(imports, key=lambda entry: entry[1], reverse=True)[:args.top]:
+		print(f"  {name}: {cumulative / 1000:.1f}ms ({own / 1000:.1f}ms itself)")
+
+	failures = []
+	if import_ms > args.import_budget:
+		failures.append(f"importing main took {import_ms:.1f}ms, over the {args.import_budget:.0f}ms budget")
+	if create_ms > args.create_budget:
+		failures.append(f"main.create_app() took {create_ms:.1f}ms, over the {args.create_budget:.0f}ms budget")
+	if timings["early"]:
+		failures.append(f"importing main imported {', '.join(timings['early'])}, which should only be imported to run the bot")
+	for side_effect in timings["side_effects"]:
+		failures.append(f"importing main {side_effect}, which only create_app() or main() should do")
+	for failure in failures:
+		print(f"FAILED: {failure}")
+	sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+	main()
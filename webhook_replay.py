@@ -0,0 +1,224 @@
+"""Replays recorded Telegram updates to a webhook receiver over HTTP, and measures it
+
+Updates are read from a JSON-lines file (one update per line), or generated as
+synthetic button presses. By default, the replay targets a local stand-in for the
+bot: a WebhookServer feeding a dispatcher with the bot's handlers (see
+main.register_handlers), which send to the fake Bot API of load_test.py, so that
+the bot can be measured offline.
+
+Two latencies are reported: the receive latency, until the receiver has accepted
+the update (its HTTP response), and, with the stand-in, the handling latency,
+until the bot's handlers are done with it. Use --url to target a running bot
+instead; only the receive latency can be measured then.
+
+Usage:
+	python webhook_replay.py [--updates FILE | --synthetic N] [--url URL] [--secret-token TOKEN] [--connections N]
+		[--workers N]
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import threading
+from queue import Queue
+from time import perf_counter, sleep
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import load_test
+from webhook_server import SECRET_TOKEN_HEADER, WebhookServer
+
+
+HANDLING_TIMEOUT = 60  # seconds to wait for the stand-in to handle the accepted updates
+
+
+def synthetic_updates(count: int) -> list[dict]:
+	"""Answer button presses, spread over a hundred group chats"""
+	updates = []
+	for update_id in range(count):
+		chat_id = -1000 - update_id % 100
+		user = {"id": 1 + update_id % 7, "is_bot": False, "first_name": "Player"}
+		updates.append({
+			"update_id": update_id,
+			"callback_query": {
+				"id": str(update_id),
+				"from": user,
+				"chat_instance": str(chat_id),
+				"data": "PASTA:00000000:0" if update_id % 2 else "COMPOSER:00000000:0",
+				"message": {
+					"message_id": update_id,
+					"date": 0,
+					"chat": {"id": chat_id, "type": "group", "title": "Composer or Pasta"},
+					"text": "Composer or pasta?",
+				},
+			},
+		})
+	return updates
+
+
+def load_updates(path: str) -> list[dict]:
+	with open(path, "r", encoding="utf-8") as updates_file:
+		return [json.loads(line) for line in updates_file if line.strip()]
+
+
+async def replay_connection(
+		host: str,
+		port: int,
+		path: str,
+		secret_token: str,
+		updates: list[dict],
+		latencies: dict[str, list[float]],
+		statuses: dict[int, int],
+		sent_at: dict[int, float],
+) -> None:
+	"""Post the updates one after another over a single keep-alive connection"""
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		for update in updates:
+			body = json.dumps(update).encode()
+			headers = f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+			if secret_token:
+				headers += f"{SECRET_TOKEN_HEADER}: {secret_token}\r\n"
+			start = sent_at[update["update_id"]] = perf_counter()
+			writer.write(f"{headers}\r\n".encode("latin-1") + body)
+			await writer.drain()
+			status = int((await reader.readline()).split()[1])
+			length = 0
+			while (line := await reader.readline()) not in (b"\r\n", b""):
+				name, _, value = line.decode("latin-1").partition(":")
+				if name.strip().lower() == "content-length":
+					length = int(value)
+			await reader.readexactly(length)
+			latencies.setdefault(get_kind(update), []).append(perf_counter() - start)
+			statuses[status] = statuses.get(status, 0) + 1
+	finally:
+		writer.close()
+
+
+def get_kind(update: dict) -> str:
+	return "callback_query" if "callback_query" in update else "other"
+
+
+async def replay(url: str, secret_token: str, updates: list[dict], connections: int) -> dict:
+	target = urlsplit(url)
+	latencies: dict[str, list[float]] = {}
+	statuses: dict[int, int] = {}
+	sent_at: dict[int, float] = {}  # update ID: when it was posted
+	start = perf_counter()
+	await asyncio.gather(*[
+		replay_connection(
+			target.hostname, target.port or 80, target.path or "/", secret_token,
+			updates[i::connections], latencies, statuses, sent_at,
+		) for i in range(connections)
+	])
+	elapsed = perf_counter() - start
+	return {
+		"Updates": len(updates), "Seconds": elapsed, "Statuses": statuses,
+		"Receive latencies": latencies, "Sent at": sent_at,
+	}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(results: dict, updates: list[dict], handled_at: dict[int, float] | None = None) -> None:
+	"""Print the throughput and the latencies; the handling latencies too, given when each update was handled"""
+	print(f"Updates: {results['Updates']} in {results['Seconds']:.3f}s "
+		f"({results['Updates'] / results['Seconds']:.0f} updates/sec)")
+	print(f"HTTP statuses: {results['Statuses']}")
+	print_latencies("receive", results["Receive latencies"])
+	if handled_at is None:
+		return
+	latencies: dict[str, list[float]] = {}
+	for update in updates:
+		update_id = update["update_id"]
+		if update_id in handled_at:
+			latencies.setdefault(get_kind(update), []).append(handled_at[update_id] - results["Sent at"][update_id])
+	print_latencies("handling", latencies)
+	if len(handled_at) < results["Statuses"].get(200, 0):
+		print(f"WARNING: only {len(handled_at)} of the accepted updates were handled within {HANDLING_TIMEOUT}s")
+
+
+def print_latencies(name: str, latencies: dict[str, list[float]]) -> None:
+	for kind, values in latencies.items():
+		print(
+			f"{kind} {name} latency: p50 {percentile(values, 0.5) * 1000:.2f}ms, "
+			f"p99 {percentile(values, 0.99) * 1000:.2f}ms, max {max(values) * 1000:.2f}ms"
+		)
+
+
+class StandIn:
+	"""A local stand-in for the bot: a webhook receiver, and the bot's handlers on a dispatcher
+
+	The handlers send to the fake Bot API of the load test, without rate limits or pauses.
+	"""
+
+	def __init__(self, secret_token: str, workers: int) -> None:
+		import main
+		import pacing
+
+		self.main = main
+		self.directory = tempfile.TemporaryDirectory()
+		load_test.isolate_player_data(self.directory.name)
+		main.create_app()  # after isolate_player_data(), as it opens the player database
+		main.pacer = pacing.PacingScheduler(pause_scale=0)
+		self.api = load_test.FakeBotApi()
+		threading.Thread(target=self.api.serve_forever, name="fake_bot_api", daemon=True).start()
+		update_queue = Queue()
+		self.dispatcher = load_test.set_up_bot(main, self.api, update_queue, workers)
+		self.handled_at: dict[int, float] = {}  # update ID: when the handlers were done with it
+		self.dispatcher.add_handler(TypeHandler(Update, self.record), group=1)
+		main.router.attach(self.dispatcher)
+		threading.Thread(target=self.dispatcher.start, name="dispatcher", daemon=True).start()
+		self.server = WebhookServer(self.dispatcher.bot, update_queue, "127.0.0.1", 0, "/telegram", secret_token)
+		self.server.start()
+		self.url = f"http://127.0.0.1:{self.server.port}/telegram"
+
+	def record(self, update: Update, _) -> None:
+		"""Runs after the bot's handlers for each update"""
+		self.handled_at[update.update_id] = perf_counter()
+
+	def wait_until_handled(self, count: int) -> None:
+		waited = 0.0
+		while len(self.handled_at) < count and waited < HANDLING_TIMEOUT:
+			sleep(0.01)
+			waited += 0.01
+
+	def stop(self) -> None:
+		self.server.shutdown()
+		load_test.stop_bot(self.main, self.dispatcher)
+		self.api.shutdown()
+		load_test.data_handler.get_player_store().close()
+		self.directory.cleanup()
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	source = parser.add_mutually_exclusive_group()
+	source.add_argument("--updates", help="JSON-lines file of recorded updates")
+	source.add_argument("--synthetic", type=int, default=10000, help="number of synthetic updates to generate")
+	parser.add_argument("--url", help="webhook URL of a running bot; a local stand-in is used if left out")
+	parser.add_argument("--secret-token", default="", help="secret token expected by the receiver")
+	parser.add_argument("--connections", type=int, default=8, help="concurrent connections")
+	parser.add_argument("--workers", type=int, default=8, help="threads handling updates in the stand-in (see chat_router)")
+	args = parser.parse_args()
+
+	updates = load_updates(args.updates) if args.updates else synthetic_updates(args.synthetic)
+	if args.url:
+		report(asyncio.run(replay(args.url, args.secret_token, updates, args.connections)), updates)
+		return
+	stand_in = StandIn(args.secret_token, args.workers)
+	try:
+		results = asyncio.run(replay(stand_in.url, args.secret_token, updates, args.connections))
+		stand_in.wait_until_handled(results["Statuses"].get(200, 0))
+		report(results, updates, stand_in.handled_at)
+	finally:
+		stand_in.stop()
+
+
+if __name__ == "__main__":
+	main()
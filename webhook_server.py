@@ -0,0 +1,157 @@
+"""An asyncio HTTP receiver for Telegram webhook updates
+
+This is an alternative to long polling: Telegram posts each update to the bot,
+which validates the secret token and hands it to the dispatcher's update queue.
+When too many updates are waiting to be handled, in that queue or further on
+(e.g. in the chat router's mailboxes; see `backlog`), updates are refused with
+503, so that Telegram retries them later instead of the bot buffering without bound.
+"""
+import asyncio
+import hmac
+import json
+import threading
+from queue import Queue
+from typing import Callable
+
+from telegram import Bot, Update
+
+import logger
+
+
+kookiie_logger = logger.get_logger(__name__)
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY_SIZE = 1 << 20  # bytes
+REASONS = {
+	200: "OK",
+	400: "Bad Request",
+	403: "Forbidden",
+	404: "Not Found",
+	405: "Method Not Allowed",
+	413: "Payload Too Large",
+	503: "Service Unavailable",
+}
+
+
+class WebhookServer:
+	"""Receives webhook updates on its own event loop thread
+
+	Provides `shutdown()`, so that it can stand in for the Updater's own webhook
+	server, and be stopped by `Updater.stop()`.
+	"""
+
+	def __init__(
+			self,
+			bot: Bot,
+			update_queue: Queue,
+			listen: str,
+			port: int,
+			url_path: str,
+			secret_token: str = "",
+			max_queue_size: int = 1000,
+			backlog: Callable[[], int] | None = None,
+	) -> None:
+		self.bot: Bot = bot
+		self.update_queue: Queue = update_queue
+		self.listen: str = listen
+		self.port: int = port
+		self.url_path: str = url_path
+		self.secret_token: str = secret_token
+		self.max_queue_size: int = max_queue_size
+		self.backlog: Callable[[], int] = backlog or (lambda: 0)  # updates taken off the queue, but not handled yet
+		self.refused: int = 0  # updates refused because of backpressure
+		self._loop: asyncio.AbstractEventLoop | None = None
+		self._server: asyncio.AbstractServer | None = None
+		self._thread: threading.Thread | None = None
+		self._writers: set[asyncio.StreamWriter] = set()  # open connections
+		self._ready = threading.Event()
+
+	def start(self) -> None:
+		self._thread = threading.Thread(target=self._run, name="webhook", daemon=True)
+		self._thread.start()
+		self._ready.wait()
+
+	def shutdown(self) -> None:
+		if self._loop and self._server:
+			self._loop.call_soon_threadsafe(self._close)
+		if self._thread:
+			self._thread.join()
+
+	def _run(self) -> None:
+		self._loop = asyncio.new_event_loop()
+		try:
+			self._server = self._loop.run_until_complete(
+				asyncio.start_server(self._handle_connection, self.listen, self.port)
+			)
+			if not self.port:  # bound to a free port
+				self.port = self._server.sockets[0].getsockname()[1]
+			kookiie_logger.info("Webhook receiver listening on %s:%s%s", self.listen, self.port, self.url_path)
+			self._ready.set()
+			self._loop.run_until_complete(self._server.wait_closed())
+		finally:
+			self._ready.set()
+			self._loop.close()
+
+	def _close(self) -> None:
+		self._server.close()
+		for writer in list(self._writers):  # idle keep-alive connections
+			writer.close()
+
+	async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		"""Serve requests on a (keep-alive) connection until the client closes it"""
+		self._writers.add(writer)
+		try:
+			while self._server.is_serving():
+				request_line = await reader.readline()
+				if not request_line:
+					break
+				headers = {}
+				while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+					name, _, value = line.decode("latin-1").partition(":")
+					headers[name.strip().lower()] = value.strip()
+				length = int(headers.get("content-length", 0))
+				if length > MAX_BODY_SIZE:
+					self._respond(writer, 413, close=True)
+					break
+				body = await reader.readexactly(length)
+				self._respond(writer, self._process(request_line.decode("latin-1").split(), headers, body))
+				await writer.drain()
+				if headers.get("connection", "").lower() == "close":
+					break
+		except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+			pass
+		finally:
+			self._writers.discard(writer)
+			writer.close()
+
+	def _process(self, request_line: list[str], headers: dict[str, str], body: bytes) -> int:
+		"""Validate a request and queue its update; returns the HTTP status code"""
+		if len(request_line) != 3:
+			return 400
+		method, path, _ = request_line
+		if path != self.url_path:
+			return 404
+		if method != "POST":
+			return 405
+		if self.secret_token and not hmac.compare_digest(
+				headers.get(SECRET_TOKEN_HEADER, "").encode(), self.secret_token.encode()
+		):
+			kookiie_logger.warning("Webhook request with an invalid secret token refused.")
+			return 403
+		if self.update_queue.qsize() + self.backlog() >= self.max_queue_size:
+			self.refused += 1
+			return 503  # backpressure; Telegram will retry the update later
+		try:
+			update = Update.de_json(json.loads(body), self.bot)
+		except Exception as e:
+			kookiie_logger.error("Error! The following exception was encountered while trying to parse an update: %s", e)
+			return 400
+		self.update_queue.put(update)
+		return 200
+
+	@staticmethod
+	def _respond(writer: asyncio.StreamWriter, status: int, close: bool = False) -> None:
+		writer.write(
+			f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+			"Content-Length: 0\r\n"
+			f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("latin-1")
+		)
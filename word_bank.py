@@ -0,0 +1,222 @@
+"""Precompiled snapshots of the word banks, for fast startup and low memory use
+
+Parsing the YAML word banks with the pure-Python loader is slow, so they are
+compiled into snapshots next to the source files. A snapshot records the hash of
+the YAML it was compiled from, and is only used while that hash matches.
+
+A snapshot is laid out to be used in place, from a read-only memory map: the keys
+are stored sorted, at recorded offsets, so that a key is found by binary search,
+and the i-th key is read directly. Nothing is unpacked when a snapshot is opened,
+so opening one takes microseconds, and worker processes mapping the same snapshot
+share its pages, instead of each building its own copy of the word banks.
+
+Snapshot layout:
+	header length (8 bytes, little-endian)
+	header: marshal of (version, source hash, number of keys)
+	padding, up to a multiple of 8 bytes
+	key offsets: number of keys + 1 (8 bytes each, native order)
+	description offsets: number of keys + 1 (8 bytes each, native order)
+	keys: UTF-8, sorted by their encoding
+	descriptions: marshal of each description, in the order of the keys
+"""
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+from pathlib import Path
+from typing import Any, Iterator, Sequence
+
+import logger
+
+
+kookiie_logger = logger.get_logger(__name__)
+SNAPSHOT_VERSION = 3  # bump when the snapshot layout changes
+SNAPSHOT_SUFFIX = ".snapshot"
+HEADER_LENGTH = struct.Struct("<Q")
+OFFSET_SIZE = 8
+DESCRIPTION_CACHE_SIZE = 256
+
+
+def align(position: int) -> int:
+	return -(-position // OFFSET_SIZE) * OFFSET_SIZE
+
+
+class WordBankKeys(Sequence):
+	"""The keys of a word bank, read from its snapshot by index"""
+
+	__slots__ = ("bank",)
+
+	def __init__(self, bank: "WordBank") -> None:
+		self.bank: WordBank = bank
+
+	def __len__(self) -> int:
+		return len(self.bank)
+
+	def __getitem__(self, index: int) -> str:
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		return self.bank.get_key(index)
+
+	def __contains__(self, key: object) -> bool:
+		return key in self.bank
+
+
+class EncodedKeys(Sequence):
+	"""The encoded keys of a word bank, in order, for binary searches"""
+
+	__slots__ = ("bank",)
+
+	def __init__(self, bank: "WordBank") -> None:
+		self.bank: WordBank = bank
+
+	def __len__(self) -> int:
+		return len(self.bank)
+
+	def __getitem__(self, index: int) -> bytes:
+		return self.bank.get_encoded_key(index)
+
+
+class WordBank:
+	"""A word bank used in place from its snapshot; descriptions are cached once read"""
+
+	def __init__(self, path: Path) -> None:
+		with open(path, "rb") as snapshot:
+			self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+		header_length, = HEADER_LENGTH.unpack_from(self._map)
+		_, self.source_hash, self._count = marshal.loads(self._map[HEADER_LENGTH.size:HEADER_LENGTH.size + header_length])
+		offsets_base = align(HEADER_LENGTH.size + header_length)
+		offsets_length = (self._count + 1) * OFFSET_SIZE
+		self._view = memoryview(self._map)
+		self._key_offsets = self._view[offsets_base:offsets_base + offsets_length].cast("Q")
+		self._description_offsets = self._view[offsets_base + offsets_length:offsets_base + 2 * offsets_length].cast("Q")
+		self._keys_base: int = offsets_base + 2 * offsets_length
+		self._descriptions_base: int = self._keys_base + self._key_offsets[self._count]
+		self._keys = WordBankKeys(self)
+		self._encoded_keys = EncodedKeys(self)
+		self._get_description = lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)(self._read_description)
+
+	def __len__(self) -> int:
+		return self._count
+
+	def __contains__(self, key: object) -> bool:
+		return self.find(key) is not None
+
+	def __iter__(self) -> Iterator[str]:
+		return map(self.get_key, range(self._count))
+
+	def __getitem__(self, key: str) -> Any:
+		i = self.find(key)
+		if i is None:
+			raise KeyError(key)
+		return self._get_description(i)
+
+	def keys(self) -> WordBankKeys:
+		return self._keys
+
+	def get(self, key: str, default: Any = None) -> Any:
+		"""Get the description of a word"""
+		i = self.find(key)
+		if i is None:
+			return default
+		return self._get_description(i)
+
+	def find(self, key: object) -> int | None:
+		"""Get the index of a key, by binary search; None if it isn't in the word bank"""
+		if not isinstance(key, str):
+			return None
+		encoded = key.encode()
+		i = bisect_left(self._encoded_keys, encoded)
+		return i if i < self._count and self.get_encoded_key(i) == encoded else None
+
+	def get_key(self, i: int) -> str:
+		return self.get_encoded_key(i).decode()
+
+	def get_encoded_key(self, i: int) -> bytes:
+		if i < 0:
+			i += self._count
+		if not 0 <= i < self._count:
+			raise IndexError("word bank index out of range")
+		return self._map[self._keys_base + self._key_offsets[i]:self._keys_base + self._key_offsets[i + 1]]
+
+	def close(self) -> None:
+		for view in (self._key_offsets, self._description_offsets, self._view):
+			view.release()  # the map can't be closed while views of it exist
+		self._map.close()
+
+	def _read_description(self, i: int) -> Any:
+		base = self._descriptions_base
+		return marshal.loads(self._map[base + self._description_offsets[i]:base + self._description_offsets[i + 1]])
+
+
+def get_snapshot_path(source: Path) -> Path:
+	return source.with_suffix(SNAPSHOT_SUFFIX)
+
+
+def get_source_hash(source: Path) -> str:
+	return hashlib.sha256(source.read_bytes()).hexdigest()
+
+
+def read_snapshot_hash(path: Path) -> tuple[int, str] | None:
+	"""Get the version and source hash of a snapshot, without mapping it"""
+	try:
+		with open(path, "rb") as snapshot:
+			header_length, = HEADER_LENGTH.unpack(snapshot.read(HEADER_LENGTH.size))
+			version, source_hash, *_ = marshal.loads(snapshot.read(header_length))
+		return version, source_hash
+	except FileNotFoundError:
+		return None
+	except Exception as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to read a snapshot: %s", e)
+		return None
+
+
+def read_snapshot(source: Path, source_hash: str) -> WordBank | None:
+	"""Get the word bank from its snapshot; None if it is missing or stale"""
+	path = get_snapshot_path(source)
+	if read_snapshot_hash(path) != (SNAPSHOT_VERSION, source_hash):
+		kookiie_logger.info("Snapshot of %s is missing or stale.", source)
+		return None
+	try:
+		return WordBank(path)
+	except Exception as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to map a snapshot: %s", e)
+		return None
+
+
+def write_snapshot(source: Path, source_hash: str, data: dict) -> None:
+	"""Compile the word bank into its snapshot; written to a temporary file first, so it is never partial
+
+	The temporary file has a name of its own, so that worker processes compiling the
+	same snapshot at once never write to the same file, or replace it half-written.
+	"""
+	target = get_snapshot_path(source)
+	keys = sorted(data, key=str.encode)
+	encoded_keys = [key.encode() for key in keys]
+	descriptions = [marshal.dumps(data[key]) for key in keys]
+	key_offsets = array("Q", accumulate(map(len, encoded_keys), initial=0))
+	description_offsets = array("Q", accumulate(map(len, descriptions), initial=0))
+	header = marshal.dumps((SNAPSHOT_VERSION, source_hash, len(keys)))
+	temp = None
+	try:
+		descriptor, temp = tempfile.mkstemp(prefix=f"{target.name}.", suffix=".tmp", dir=target.parent)
+		with open(descriptor, "wb") as snapshot:
+			snapshot.write(HEADER_LENGTH.pack(len(header)))
+			snapshot.write(header)
+			snapshot.write(bytes(align(HEADER_LENGTH.size + len(header)) - HEADER_LENGTH.size - len(header)))
+			snapshot.write(key_offsets.tobytes())
+			snapshot.write(description_offsets.tobytes())
+			snapshot.writelines(encoded_keys)
+			snapshot.writelines(descriptions)
+		os.chmod(temp, 0o644)  # mkstemp() makes it private to the user
+		os.replace(temp, target)
+		kookiie_logger.debug("Snapshot of %s written.", source)
+	except Exception as e:
+		kookiie_logger.error("Error! The following exception was encountered while trying to write a snapshot: %s", e)
+		if temp:
+			Path(temp).unlink(missing_ok=True)
@@ -0,0 +1,140 @@
+"""Word banks that can be edited while the bot is running
+
+The composer and pasta names can each come from several sources: YAML files, or
+directories of them (e.g. per language, or themed). The sources are checked for
+changes every so often; when they change, the word banks are rebuilt on a
+background thread, and swapped in at once, so handlers never wait for a reload.
+
+Each build is an immutable WordBanks, with a version. A game keeps the version of
+the word banks it drew its questions from, and keeps using that build, so that
+a reload never changes the questions or answers of a game in progress.
+"""
+import hashlib
+import threading
+from collections import ChainMap, OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Mapping, Sequence
+
+import data_handler
+import logger
+import message_renderer
+import word_bank
+
+
+kookiie_logger = logger.get_logger(__name__)
+KEPT_VERSIONS = 8  # builds kept for games in progress, besides the current one
+
+
+@dataclass(frozen=True)
+class WordBanks:
+	"""A consistent build of the word banks, and everything derived from them"""
+
+	version: str
+	composers: Mapping[str, list[str]]
+	pastas: Mapping[str, str]
+	composer_keys: Sequence[str] = field(init=False)
+	pasta_keys: Sequence[str] = field(init=False)
+	renderer: message_renderer.MessageRenderer = field(init=False)
+
+	def __post_init__(self) -> None:
+		object.__setattr__(self, "composer_keys", get_keys(self.composers))
+		object.__setattr__(self, "pasta_keys", get_keys(self.pastas))
+		object.__setattr__(self, "renderer", message_renderer.MessageRenderer(self.composers, self.pastas))
+
+
+def get_keys(bank: Mapping) -> Sequence[str]:
+	"""The keys of a word bank, by index; those of a snapshot are read from it in place, rather than copied"""
+	if isinstance(bank, word_bank.WordBank):
+		return bank.keys()
+	return list(bank.keys())
+
+
+def list_source_files(sources: list[str]) -> list[Path]:
+	"""The YAML files of the sources; a directory stands for the YAML files in it"""
+	files = []
+	for source in map(Path, sources):
+		if source.is_dir():
+			files += sorted(source.glob("*.yaml"))
+		elif source.is_file():
+			files.append(source)
+	return files
+
+
+def load_category(files: list[Path]) -> Mapping:
+	"""Load the word banks of one category; where they share a name, the first file wins"""
+	banks = [bank for bank in map(data_handler.load_word_bank, files) if bank]
+	if len(banks) == 1:
+		return banks[0]
+	return ChainMap(*banks)
+
+
+class WordBankManager:
+	"""Holds the current word banks, and rebuilds them in the background when their sources change"""
+
+	def __init__(self, sources: dict[str, list[str]], on_reload: Callable[[WordBanks], Any] | None = None) -> None:
+		self.sources: dict[str, list[str]] = sources  # category (composer or pasta): files or directories
+		self.on_reload: Callable[[WordBanks], Any] | None = on_reload
+		self._signature: tuple = self._get_signature()
+		self.current: WordBanks = self._build()
+		self._versions: OrderedDict[str, WordBanks] = OrderedDict({self.current.version: self.current})
+		self._reloading = threading.Lock()
+
+	def get(self, version: str) -> WordBanks:
+		"""The build of the given version, or the current one if it is no longer kept"""
+		return self._versions.get(version, self.current)
+
+	def check(self, _: Any = None) -> None:
+		"""Start a reload if the sources have changed; can be used as a repeating job"""
+		signature = self._get_signature()
+		if signature == self._signature or not self._reloading.acquire(blocking=False):
+			return
+		threading.Thread(target=self._reload, args=(signature,), name="word_bank_reload", daemon=True).start()
+
+	def _reload(self, signature: tuple) -> None:
+		self._signature = signature  # a failed reload is retried once the sources change again
+		try:
+			banks = self._build()
+			if not banks.composer_keys or not banks.pasta_keys:
+				raise ValueError("a category is empty, so the current word banks are kept")
+			if banks.version != self.current.version:
+				self._versions[banks.version] = banks
+				while len(self._versions) > KEPT_VERSIONS + 1:
+					self._versions.popitem(last=False)
+				self.current = banks  # the swap; new games use the new build from here on
+				kookiie_logger.info(
+					"Word banks reloaded: %d composers, %d pastas.", len(banks.composer_keys), len(banks.pasta_keys),
+				)
+				if self.on_reload:
+					self.on_reload(banks)
+		except Exception as e:
+			kookiie_logger.error("Error! The following exception was encountered while reloading the word banks: %s", e)
+		finally:
+			self._reloading.release()
+
+	def _build(self) -> WordBanks:
+		files = {category: list_source_files(sources) for category, sources in self.sources.items()}
+		for category, category_files in files.items():
+			if not category_files:
+				kookiie_logger.error("No %s data found in %s!", category, ", ".join(self.sources[category]))
+		digest = hashlib.sha256()
+		for path in (path for category_files in files.values() for path in category_files):
+			digest.update(str(path).encode())
+			digest.update(path.read_bytes())
+		return WordBanks(
+			digest.hexdigest()[:16],
+			load_category(files.get("composer", [])),
+			load_category(files.get("pasta", [])),
+		)
+
+	def _get_signature(self) -> tuple:
+		"""Cheap fingerprint of the sources (paths, sizes and modification times), to notice changes"""
+		signature = []
+		for category, sources in self.sources.items():
+			for path in list_source_files(sources):
+				try:
+					stat = path.stat()
+				except OSError:  # removed since it was listed
+					continue
+				signature.append((category, str(path), stat.st_size, stat.st_mtime_ns))
+		return tuple(signature)
@@ -0,0 +1,100 @@
+"""Write-behind batching of player data saves
+
+Instead of saving after every game, the games mark the player data as dirty, and a
+background thread saves all accumulated results at once, either on an interval or
+once enough updates have built up.
+"""
+import threading
+from time import perf_counter
+
+import data_handler
+import logger
+from player_data import PlayerData
+
+
+kookiie_logger = logger.get_logger(__name__)
+FLUSH_INTERVAL = 30  # seconds
+MAX_PENDING_UPDATES = 100
+
+
+class WriteBehindSaver:
+	"""Coalesces player data saves, and flushes them on a background thread"""
+
+	def __init__(
+			self,
+			player_data: PlayerData,
+			interval: float = FLUSH_INTERVAL,
+			max_pending: int = MAX_PENDING_UPDATES,
+	) -> None:
+		self.player_data: PlayerData = player_data
+		self.interval: float = interval
+		self.max_pending: int = max_pending
+		self._dirty: int = 0  # updates since the last flush
+		self._stopping: bool = False
+		self._condition = threading.Condition()
+		self._thread: threading.Thread | None = None
+		# Counters:
+		self.flushes: int = 0
+		self.updates: int = 0
+		self.last_flush_latency: float = 0.0
+		self.max_flush_latency: float = 0.0
+		self.total_flush_latency: float = 0.0
+
+	def start(self) -> None:
+		self._thread = threading.Thread(target=self._run, name="write_behind", daemon=True)
+		self._thread.start()
+
+	def stop(self) -> None:
+		"""Stop the background thread, after a final flush"""
+		with self._condition:
+			self._stopping = True
+			self._condition.notify()
+		if self._thread:
+			self._thread.join()
+		self.flush()  # in case the thread was never started, or updates arrived during shutdown
+
+	def mark_dirty(self, updates: int = 1) -> None:
+		"""Record that there are unsaved updates in the player data"""
+		with self._condition:
+			self._dirty += updates
+			if self._dirty >= self.max_pending:
+				self._condition.notify()
+
+	def flush(self) -> None:
+		"""Save all accumulated updates now"""
+		with self._condition:
+			updates, self._dirty = self._dirty, 0
+		if not updates:
+			return
+		start = perf_counter()
+		data_handler.save_player_data(self.player_data)
+		latency = perf_counter() - start
+		self.flushes += 1
+		self.updates += updates
+		self.last_flush_latency = latency
+		self.max_flush_latency = max(self.max_flush_latency, latency)
+		self.total_flush_latency += latency
+		kookiie_logger.debug("Flushed %d player data updates in %.3fs.", updates, latency)
+
+	def stats(self) -> dict[str, int | float]:
+		return {
+			"Flushes": self.flushes,
+			"Updates": self.updates,
+			"Coalesced updates": self.updates - self.flushes,
+			"Last flush latency": self.last_flush_latency,
+			"Max flush latency": self.max_flush_latency,
+			"Mean flush latency": self.total_flush_latency / self.flushes if self.flushes else 0.0,
+		}
+
+	def _run(self) -> None:
+		while True:
+			with self._condition:
+				if not self._stopping and self._dirty < self.max_pending:
+					self._condition.wait(self.interval)
+				stopping = self._stopping
+			if stopping:
+				return  # the final flush is done by stop()
+			try:
+				self.flush()
+			except Exception as e:
+				kookiie_logger.error("Error! The following exception was encountered while flushing player data: %s", e)